@@ -1 +1,3 @@
-from .km003c import *
\ No newline at end of file
+from .km003c import *
+from .aio import AsyncPowerZ_KM003C
+from .daemon import DaemonClient
@@ -0,0 +1,85 @@
+import asyncio
+import usb.core
+from concurrent.futures import ThreadPoolExecutor
+from .km003c import *
+from .scheduler import PollScheduler
+
+class AsyncPowerZ_KM003C:
+    """
+    asyncio front end for PowerZ_KM003C.
+
+    Every USB transfer of a meter runs on one dedicated I/O thread, so the event loop is never
+    blocked for a round trip and no thread is created per call. Several meters may share an executor.
+    """
+
+    def __init__(self, dev: usb.core.Device | None = None, executor: ThreadPoolExecutor | None = None):
+        self._dev = dev
+        self._own_executor = executor is None
+        self._executor = executor or ThreadPoolExecutor(max_workers=1, thread_name_prefix='km003c-io')
+        self.meter = None
+        self.scheduler = None
+
+    async def _run(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
+
+    async def connect(self):
+        """
+        Opens the meter and runs the connect and unlock handshake of PowerZ_KM003C.
+        """
+        self.meter = await self._run(PowerZ_KM003C, self._dev)
+        return self
+
+    #Only after stopping an acquisition can the rate be changed
+    async def stop(self):
+        await self._run(self.meter.stop)
+
+    #Setting rate also starts the acquisition
+    async def set_rate(self, rate: Rate):
+        await self._run(self.meter.set_rate, rate)
+
+    async def get_data(self, att: int = AttributeDataType.ATT_ADC_QUEUE):
+        return await self._run(self.meter.get_data, att)
+
+    async def poll(self, att: int = AttributeDataType.ATT_ADC | AttributeDataType.ATT_ADC_QUEUE):
+        return await self._run(self.meter.poll, att)
+
+    async def stream(self, rate: Rate, interval: float | None = None, att: int | None = None):
+        """
+        Starts the acquisition at rate and yields every decoded batch of att, by default the queue attribute of rate.
+        Without a fixed interval, a PollScheduler adapts the poll period to the chunk fill level.
+        The acquisition is stopped when the generator is closed, use contextlib.aclosing() to do so deterministically.
+        """
+        if att is None:
+            att = queue_attribute(rate)
+        if att not in (AttributeDataType.ATT_ADC_QUEUE, AttributeDataType.ATT_ADC_QUEUE_10K):
+            raise ValueError(f'att must be ATT_ADC_QUEUE or ATT_ADC_QUEUE_10K, got {att}')
+        self.scheduler = PollScheduler(rate) if interval is None else None
+        await self.set_rate(rate)
+        try:
+            while True:
+                entries = 0
+                for seg_att, obj in await self.get_data(att):
+                    if seg_att == att:
+                        entries += len(obj)
+                        yield obj
+                if self.scheduler is not None:
+                    interval = self.scheduler.update(entries)
+                await asyncio.sleep(interval)
+        finally:
+            if self.meter is not None:
+                await self.stop()
+
+    async def close(self):
+        if self.meter is not None:
+            await self._run(self.meter.close)
+            self.meter = None
+        if self._own_executor:
+            self._executor.shutdown(wait=False)
+
+    async def __aenter__(self):
+        if self.meter is None:
+            await self.connect()
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
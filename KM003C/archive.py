@@ -0,0 +1,400 @@
+#! /usr/bin/env python3
+
+from .defs import *
+from .export import CsvWriter
+from .recording import MAGIC as RECORDING_MAGIC, Recording, TimestampUnwrapper
+from array import array
+from bisect import bisect_left
+import argparse
+import lzma
+import struct
+import sys
+import time
+import zlib
+
+#Archive layout: HEADER_STRUCT, then blocks of BLOCK_STRUCT followed by their compressed payload.
+#A payload holds the varints of one block column after the other, in AdcQueueBatch.COLUMNS order.
+#Every column is delta encoded from 0, so its first value is absolute, and zigzag mapped so small
+#negative deltas stay small. Timestamps are unwrapped past the uint32 rollover before the deltas.
+#
+#The index sidecar (path + INDEX_SUFFIX) holds one INDEX_STRUCT per block. It is only written after
+#its block, and is completed from the block headers if it is missing or behind.
+MAGIC = b'KM003CA\x00'
+VERSION = 1
+HEADER_STRUCT = struct.Struct('<8sHHHd')   # magic, version, rate, compression, start time
+BLOCK_STRUCT = struct.Struct('<IIqq')      # records, payload size, first and last unwrapped timestamp_ms
+INDEX_STRUCT = struct.Struct('<qqQI')      # first and last unwrapped timestamp_ms, block offset, records
+INDEX_SUFFIX = '.idx'
+BLOCK_RECORDS = 16384
+
+COMPRESSIONS = ('zlib', 'lzma')
+_COMPRESS = {
+    'zlib': lambda data, level: zlib.compress(data, 6 if level is None else level),
+    'lzma': lambda data, level: lzma.compress(data, preset=6 if level is None else level),
+}
+_DECOMPRESS = {'zlib': zlib.decompress, 'lzma': lzma.decompress}
+
+def encode_varints(values):
+    """
+    Returns the LEB128 varints of non-negative integers, a uint64 array or a list.
+    """
+    if np is not None and isinstance(values, np.ndarray):
+        values = values.astype(np.uint64, copy=False)
+        sizes = np.ones(len(values), dtype=np.int64)
+        rest = values >> np.uint64(7)
+        while rest.any():
+            sizes += rest != 0
+            rest >>= np.uint64(7)
+        offsets = np.cumsum(sizes) - sizes
+        out = np.empty(int(sizes.sum()), dtype=np.uint8)
+        #One pass per byte position, only over the values that are that long
+        for k in range(int(sizes.max(initial=0))):
+            selected = np.flatnonzero(sizes > k)
+            chunk = (values[selected] >> np.uint64(7 * k)) & np.uint64(0x7F)
+            more = (sizes[selected] > k + 1).astype(np.uint64) << np.uint64(7)
+            out[offsets[selected] + k] = chunk | more
+        return out.tobytes()
+    out = bytearray()
+    for value in values:
+        while value > 0x7F:
+            out.append(value & 0x7F | 0x80)
+            value >>= 7
+        out.append(value)
+    return bytes(out)
+
+def decode_varints(data, count):
+    """
+    Decodes count varints from data, as a uint64 array with numpy or a list.
+    """
+    if np is not None:
+        raw = np.frombuffer(data, dtype=np.uint8)
+        ends = np.flatnonzero(raw < 0x80)[:count]
+        if len(ends) < count:
+            raise ValueError(f'Expected {count} varints, found {len(ends)}')
+        if not count:
+            return np.empty(0, dtype=np.uint64)
+        raw = raw[:ends[-1] + 1]
+        starts = np.empty(count, dtype=np.int64)
+        starts[0] = 0
+        starts[1:] = ends[:-1] + 1
+        if len(raw) == count:
+            return raw.astype(np.uint64)
+        shifts = 7 * (np.arange(len(raw)) - np.repeat(starts, ends - starts + 1))
+        parts = (raw & 0x7F).astype(np.uint64) << shifts.astype(np.uint64)
+        return np.bitwise_or.reduceat(parts, starts)
+    values = []
+    value = shift = 0
+    for byte in data:
+        value |= (byte & 0x7F) << shift
+        shift += 7
+        if byte < 0x80:
+            values.append(value)
+            if len(values) == count:
+                return values
+            value = shift = 0
+    raise ValueError(f'Expected {count} varints, found {len(values)}')
+
+def encode_column(values):
+    """
+    Delta encodes and zigzag maps one column into varints.
+    """
+    if np is not None and isinstance(values, np.ndarray):
+        deltas = np.diff(values.astype(np.int64), prepend=np.int64(0))
+        return encode_varints(((deltas << 1) ^ (deltas >> 63)).view(np.uint64))
+    deltas = []
+    previous = 0
+    for value in values:
+        delta = value - previous
+        deltas.append(delta << 1 if delta >= 0 else (-delta << 1) - 1)
+        previous = value
+    return encode_varints(deltas)
+
+def encode_block(columns, compression='zlib', level=None):
+    """
+    Returns the compressed payload of a block of columns, the timestamps already unwrapped.
+    """
+    return _COMPRESS[compression](b''.join(encode_column(column) for column in columns), level)
+
+def decode_block(payload, count, compression='zlib'):
+    """
+    Returns the columns of a block: int64 arrays with numpy, lists otherwise.
+    """
+    data = _DECOMPRESS[compression](payload)
+    values = decode_varints(data, count * len(AdcQueueBatch.COLUMNS))
+    if np is not None:
+        deltas = (values >> np.uint64(1)).view(np.int64) ^ -(values & np.uint64(1)).view(np.int64)
+        return list(np.cumsum(deltas.reshape(len(AdcQueueBatch.COLUMNS), count), axis=1))
+    columns = []
+    for i in range(len(AdcQueueBatch.COLUMNS)):
+        column = []
+        value = 0
+        for zigzag in values[i * count:(i + 1) * count]:
+            value += zigzag >> 1 if not zigzag & 1 else -(zigzag >> 1) - 1
+            column.append(value)
+        columns.append(column)
+    return columns
+
+def _search(column, t):
+    """
+    Returns the position of the first value >= t in a sorted column.
+    """
+    if np is not None and isinstance(column, np.ndarray):
+        return int(np.searchsorted(column, t))
+    return bisect_left(column, t)
+
+def columns_to_batch(columns):
+    """
+    Builds an AdcQueueBatch from decoded columns, wrapping the timestamps back to uint32.
+    """
+    if np is not None:
+        records = np.empty(len(columns[0]), dtype=AdcQueueBatch.DTYPE)
+        for name, column in zip(AdcQueueBatch.COLUMNS, columns):
+            records[name] = column & 0xFFFFFFFF if name == 'timestamp_ms' else column
+        return AdcQueueBatch.from_records(records)
+    columns = [[t & 0xFFFFFFFF for t in columns[0]]] + list(columns[1:])
+    return AdcQueueBatch(*(array(code, column) for code, column in zip(AdcQueueBatch.ARRAY_TYPECODES, columns)))
+
+class ArchiveWriter:
+    """
+    Appends AdcQueueBatch objects to a compressed archive.
+
+    Records are buffered until block_records have accumulated, then every column is delta, zigzag
+    and varint encoded and the block is compressed with zlib or lzma. Cutting a shorter block at every
+    flush() would hurt the compression at low rates, so flush() only does once the oldest pending record
+    arrived max_block_age_s ago. That bounds what a crash loses by time rather than by block_records.
+    """
+
+    def __init__(self, path, rate: Rate, compression='zlib', level=None, block_records=BLOCK_RECORDS,
+                 max_block_age_s=60.0):
+        if compression not in COMPRESSIONS:
+            raise ValueError(f'Unknown compression {compression}')
+        self.compression = compression
+        self.level = level
+        self.block_records = block_records
+        self.max_block_age_s = max_block_age_s
+        self._file = open(path, 'wb')
+        self._file.write(HEADER_STRUCT.pack(MAGIC, VERSION, rate, COMPRESSIONS.index(compression), time.time()))
+        self._index = open(path + INDEX_SUFFIX, 'wb')
+        self._offset = HEADER_STRUCT.size
+        self._pending = []
+        self._pending_records = 0
+        self._pending_since = None  # Host time.monotonic() when the oldest pending record arrived
+        self._unwrap = TimestampUnwrapper()
+        self.count = 0
+        self.size = HEADER_STRUCT.size  # Bytes written to the archive so far
+
+    def write(self, batch):
+        n = len(batch)
+        if not n:
+            return
+        columns = [self._unwrap.unwrap(batch.timestamp_ms)]
+        if np is not None:
+            columns += [np.asarray(getattr(batch, name), dtype=np.int64) for name in AdcQueueBatch.COLUMNS[1:]]
+        else:
+            columns += [getattr(batch, name).tolist() for name in AdcQueueBatch.COLUMNS[1:]]
+        if not self._pending_records:
+            self._pending_since = time.monotonic()
+        self._pending.append(columns)
+        self._pending_records += n
+        self.count += n
+        while self._pending_records >= self.block_records:
+            self._write_block(self.block_records)
+        if self._pending_records and self._pending_records < n:
+            #The remainder of this batch starts a new block
+            self._pending_since = time.monotonic()
+
+    def _take(self, count):
+        """
+        Removes the first count pending records and returns them as columns.
+        """
+        if np is not None:
+            joined = [np.concatenate(parts) for parts in zip(*self._pending)]
+            rest = [column[count:] for column in joined]
+            columns = [column[:count] for column in joined]
+        else:
+            joined = [[value for part in parts for value in part] for parts in zip(*self._pending)]
+            rest = [column[count:] for column in joined]
+            columns = [column[:count] for column in joined]
+        self._pending = [rest] if len(rest[0]) else []
+        self._pending_records -= count
+        return columns
+
+    def _write_block(self, count):
+        columns = self._take(count)
+        payload = encode_block(columns, self.compression, self.level)
+        first, last = int(columns[0][0]), int(columns[0][-1])
+        self._file.write(BLOCK_STRUCT.pack(count, len(payload), first, last))
+        self._file.write(payload)
+        self._file.flush()
+        #The index may only point at blocks already in the archive
+        self._index.write(INDEX_STRUCT.pack(first, last, self._offset, count))
+        self._index.flush()
+        self._offset += BLOCK_STRUCT.size + len(payload)
+        self.size = self._offset
+
+    def flush(self):
+        if (self._pending_records and self.max_block_age_s is not None
+                and time.monotonic() - self._pending_since >= self.max_block_age_s):
+            self._write_block(self._pending_records)
+        self._file.flush()
+        self._index.flush()
+
+    def close(self):
+        if self._pending_records:
+            self._write_block(self._pending_records)
+        self._file.close()
+        self._index.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+class Archive:
+    """
+    Reads a compressed archive. Only the blocks overlapping a requested range are decompressed.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, 'rb')
+        magic, version, rate, compression, start_time = HEADER_STRUCT.unpack(self._file.read(HEADER_STRUCT.size))
+        if magic != MAGIC:
+            raise ValueError(f'{path} is not a KM003C archive')
+        if version != VERSION:
+            raise ValueError(f'Unsupported archive version {version}')
+        self.rate = Rate(rate)
+        self.compression = COMPRESSIONS[compression]
+        self.start_time = start_time  # Host time.time() when archiving started
+        self._load_index()
+
+    def _load_index(self):
+        try:
+            with open(self.path + INDEX_SUFFIX, 'rb') as f:
+                data = f.read()
+            data = data[:len(data) - len(data) % INDEX_STRUCT.size]
+            entries = list(INDEX_STRUCT.iter_unpack(data))
+        except OSError:
+            entries = []
+        end = self._file.seek(0, 2)
+        #Blocks past the end of a truncated archive are dropped, blocks missing from the index are added
+        while entries and self._block_end(entries[-1][2]) > end:
+            entries.pop()
+        offset = self._block_end(entries[-1][2]) if entries else HEADER_STRUCT.size
+        while offset + BLOCK_STRUCT.size <= end:
+            self._file.seek(offset)
+            count, size, first, last = BLOCK_STRUCT.unpack(self._file.read(BLOCK_STRUCT.size))
+            if offset + BLOCK_STRUCT.size + size > end:
+                break
+            entries.append((first, last, offset, count))
+            offset += BLOCK_STRUCT.size + size
+        self._firsts = [entry[0] for entry in entries]
+        self._lasts = [entry[1] for entry in entries]
+        self._offsets = [entry[2] for entry in entries]
+        self._counts = [entry[3] for entry in entries]
+        self.count = sum(self._counts)
+
+    def _block_end(self, offset):
+        self._file.seek(offset)
+        header = self._file.read(BLOCK_STRUCT.size)
+        if len(header) < BLOCK_STRUCT.size:
+            return offset + BLOCK_STRUCT.size
+        return offset + BLOCK_STRUCT.size + BLOCK_STRUCT.unpack(header)[1]
+
+    def __len__(self):
+        return self.count
+
+    @property
+    def blocks(self):
+        return len(self._offsets)
+
+    def block_columns(self, block):
+        """
+        Returns the decoded columns of a block, with unwrapped timestamps.
+        """
+        self._file.seek(self._offsets[block])
+        count, size, first, last = BLOCK_STRUCT.unpack(self._file.read(BLOCK_STRUCT.size))
+        return decode_block(self._file.read(size), count, self.compression)
+
+    def iter_range(self, t0=None, t1=None):
+        """
+        Yields the records with t0 <= unwrapped timestamp_ms < t1 as one AdcQueueBatch per block.
+        """
+        first = 0 if t0 is None else bisect_left(self._lasts, t0)
+        stop = self.blocks if t1 is None else bisect_left(self._firsts, t1)
+        for block in range(first, stop):
+            columns = self.block_columns(block)
+            timestamps = columns[0]
+            start = 0 if t0 is None or self._firsts[block] >= t0 else _search(timestamps, t0)
+            end = len(timestamps) if t1 is None or self._lasts[block] < t1 else _search(timestamps, t1)
+            if start < end:
+                yield columns_to_batch([column[start:end] for column in columns])
+
+    def time_range(self, t0=None, t1=None):
+        """
+        Returns the records with t0 <= unwrapped timestamp_ms < t1 as an AdcQueueBatch.
+        """
+        batches = list(self.iter_range(t0, t1))
+        if len(batches) == 1:
+            return batches[0]
+        if np is not None:
+            records = np.concatenate([batch.records for batch in batches]) if batches else np.empty(0, AdcQueueBatch.DTYPE)
+            return AdcQueueBatch.from_records(records)
+        columns = [array(code) for code in AdcQueueBatch.ARRAY_TYPECODES]
+        for batch in batches:
+            for column, name in zip(columns, AdcQueueBatch.COLUMNS):
+                column.extend(getattr(batch, name))
+        return AdcQueueBatch(*columns)
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+def is_archive(path):
+    with open(path, 'rb') as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+def archive_recording(path, output, compression='zlib', level=None, block_records=BLOCK_RECORDS):
+    """
+    Compresses a binary recording into an archive and returns the archive size.
+    """
+    with Recording(path) as recording, ArchiveWriter(output, recording.rate, compression, level, block_records) as writer:
+        for start in range(0, len(recording), block_records):
+            writer.write(recording.batch(start, start + block_records))
+    return writer.size
+
+def extract_csv(path, output, t0=None, t1=None):
+    """
+    Writes the records of an archive between t0 and t1 as logger CSV.
+    """
+    with Archive(path) as archive, CsvWriter(output) as writer:
+        for batch in archive.iter_range(t0, t1):
+            writer.write(batch)
+
+def main():
+    parser = argparse.ArgumentParser(description="Compress a KM003C binary recording into an archive, or extract an archive to CSV")
+    parser.add_argument('input', type=str, help="Binary recording written by km003c_logger --format bin, or an archive.")
+    parser.add_argument('output', type=str, help="Archive to write for a recording, CSV file to write for an archive.")
+    parser.add_argument('--compression', '-c', choices=COMPRESSIONS, default='zlib',
+                        help="Block compression of a new archive: zlib, or lzma for smaller and slower (default: zlib).")
+    parser.add_argument('--start', type=int, default=None, help="First timestamp_ms to extract (unwrapped).")
+    parser.add_argument('--end', type=int, default=None, help="Timestamp_ms to stop extracting at, exclusive (unwrapped).")
+
+    args = parser.parse_args()
+    if is_archive(args.input):
+        extract_csv(args.input, args.output, args.start, args.end)
+        return
+    with open(args.input, 'rb') as f:
+        if f.read(len(RECORDING_MAGIC)) != RECORDING_MAGIC:
+            parser.error(f'{args.input} is neither a KM003C recording nor an archive')
+    size = archive_recording(args.input, args.output, args.compression)
+    print(f'{args.output}: {size} bytes', file=sys.stderr)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,400 @@
+#! /usr/bin/env python3
+
+from .km003c import *
+from .recording import RECORD_STRUCT, batch_to_bytes
+import argparse
+import json
+import os
+import queue
+import socket
+import struct
+import sys
+import threading
+
+#Wire format, in both directions a sequence of MESSAGE_STRUCT headers each followed by its payload:
+#  HELLO      daemon -> client, JSON with the rate and queue attribute of the stream
+#  SUBSCRIBE  client -> daemon, JSON with the attributes, drop policy and queue size of the subscriber
+#  BATCH      daemon -> client, BATCH_STRUCT followed by AdcQueueEntry records
+#  ADC        daemon -> client, ADC_STRUCT followed by the AdcData bytes of the latest poll
+#  ERROR      daemon -> client, JSON with the reason a SUBSCRIBE was rejected, then the daemon hangs up
+MESSAGE_STRUCT = struct.Struct('<BI')  # kind, payload size
+BATCH_STRUCT = struct.Struct('<dQ')    # host time.monotonic() of the poll, messages dropped for this subscriber so far
+ADC_STRUCT = struct.Struct('<d')       # host time.monotonic() of the poll
+HELLO = 0
+SUBSCRIBE = 1
+BATCH = 2
+ADC = 3
+ERROR = 4
+
+DEFAULT_SOCKET = os.path.join(os.environ.get('XDG_RUNTIME_DIR', '/tmp'), 'km003c.sock')
+POLICIES = ('drop', 'block')
+
+def _message(kind, payload):
+    return MESSAGE_STRUCT.pack(kind, len(payload)) + payload
+
+def _recv_exact(sock, size):
+    data = bytearray()
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise ConnectionError('Connection closed')
+        data += chunk
+    return bytes(data)
+
+def _subscription(request, att):
+    """
+    Validates a SUBSCRIBE request, returning its attributes, policy and queue size.
+    """
+    if not isinstance(request, dict):
+        raise ValueError('SUBSCRIBE must be a JSON object')
+    try:
+        att = int(request.get('att', att))
+        queue_size = int(request.get('queue_size', 256))
+    except (TypeError, ValueError):
+        raise ValueError('att and queue_size must be integers')
+    policy = request.get('policy', 'drop')
+    if not 0 < att < 1 << 15:
+        raise ValueError(f'Invalid attributes {att}')
+    if policy not in POLICIES:
+        raise ValueError(f'Unknown policy {policy!r}, expected one of {", ".join(POLICIES)}')
+    if queue_size < 1:
+        raise ValueError(f'Invalid queue size {queue_size}')
+    return att, policy, queue_size
+
+class Subscriber:
+    """
+    One connected client with its own bounded queue of encoded messages and sender thread.
+
+    With the drop policy a full queue discards its oldest message, which the client sees in the dropped
+    counter of the next batch. With the block policy the daemon waits for the client, which backs up
+    the stream ring of the meter until it overruns, so one slow client then holds back every other.
+    """
+
+    def __init__(self, conn, att, policy='drop', queue_size=256):
+        if policy not in POLICIES:
+            raise ValueError(f'Unknown policy {policy}')
+        self.conn = conn
+        self.att = att
+        self.policy = policy
+        self.dropped = 0
+        self.closed = False
+        self._queue = queue.Queue(queue_size)
+        self._thread = threading.Thread(target=self._send, name='km003c-subscriber', daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def offer(self, message, optional=False):
+        """
+        Queues an encoded message. When the queue is full, an optional message is skipped, otherwise
+        the drop policy discards the oldest message and the block policy waits for room.
+        """
+        if optional:
+            try:
+                self._queue.put_nowait(message)
+            except queue.Full:
+                pass
+            return
+        block = self.policy == 'block'
+        while not self.closed:
+            try:
+                self._queue.put(message, block, 0.1)
+                return
+            except queue.Full:
+                if block:
+                    continue
+            try:
+                self._queue.get_nowait()
+                self.dropped += 1
+            except queue.Empty:
+                pass
+
+    def _send(self):
+        try:
+            while not self.closed:
+                message = self._queue.get()
+                if message is None:
+                    break
+                self.conn.sendall(message() if callable(message) else message)
+        except OSError:
+            pass
+        except Exception as e:
+            print(f'Dropped subscriber: {e!r}', file=sys.stderr)
+        finally:
+            self.closed = True
+            self.conn.close()
+
+    def close(self):
+        self.closed = True
+        try:
+            self._queue.put_nowait(None)
+        except queue.Full:
+            self.conn.close()
+
+class Daemon:
+    """
+    Owns the PowerZ_KM003C connection and streams every sample batch to any number of
+    DaemonClient subscribers on a Unix domain socket.
+
+    The meter is polled for the queue attribute of rate and ATT_ADC in a single round trip.
+    Every batch is encoded once and shared by all subscribers.
+    """
+
+    def __init__(self, meter: PowerZ_KM003C, path=DEFAULT_SOCKET, rate: Rate = Rate._1KSPS, capacity=1024):
+        self.meter = meter
+        self.path = path
+        self.rate = rate
+        self.capacity = capacity
+        self.att = queue_attribute(rate)
+        self.subscribers = []
+        self._lock = threading.Lock()
+        self._server = None
+        self._accept_thread = None
+
+    def start(self):
+        """
+        Binds the socket, replacing a stale one, and starts the acquisition.
+        """
+        if os.path.exists(self.path):
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(self.path)
+            except OSError:
+                os.unlink(self.path)
+            else:
+                raise RuntimeError(f'A daemon is already listening on {self.path}')
+            finally:
+                probe.close()
+        self._server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._server.bind(self.path)
+        self._server.listen()
+        self._accept_thread = threading.Thread(target=self._accept, name='km003c-accept', daemon=True)
+        self._accept_thread.start()
+        self.meter.start_stream(self.rate, self.capacity, extra_att=AttributeDataType.ATT_ADC,
+                                on_response=self._on_response)
+
+    def _accept(self):
+        while True:
+            try:
+                conn, _ = self._server.accept()
+            except OSError:
+                return
+            threading.Thread(target=self._subscribe, args=(conn,), name='km003c-subscribe', daemon=True).start()
+
+    def _subscribe(self, conn):
+        try:
+            conn.settimeout(5.0)
+            kind, size = MESSAGE_STRUCT.unpack(_recv_exact(conn, MESSAGE_STRUCT.size))
+            request = _recv_exact(conn, size)
+        except OSError as e:
+            print(f'Rejected subscriber: {e}', file=sys.stderr)
+            conn.close()
+            return
+        try:
+            if kind != SUBSCRIBE:
+                raise ValueError(f'Expected SUBSCRIBE, got {kind}')
+            subscriber = Subscriber(conn, *_subscription(json.loads(request), self.att))
+        except ValueError as e:
+            print(f'Rejected subscriber: {e}', file=sys.stderr)
+            try:
+                conn.sendall(_message(ERROR, json.dumps({'error': str(e)}).encode()))
+            except OSError:
+                pass
+            conn.close()
+            return
+        conn.settimeout(None)
+        hello = json.dumps({'rate': int(self.rate), 'att': int(self.att)}).encode()
+        subscriber.offer(_message(HELLO, hello))
+        subscriber.start()
+        with self._lock:
+            self.subscribers.append(subscriber)
+
+    def _live(self):
+        with self._lock:
+            self.subscribers = [subscriber for subscriber in self.subscribers if not subscriber.closed]
+            return list(self.subscribers)
+
+    def _on_response(self, response):
+        #Runs on the polling thread, so the latest ADC reading is never waited for
+        adc = response.get(AttributeDataType.ATT_ADC)
+        if adc is None:
+            return
+        message = _message(ADC, ADC_STRUCT.pack(response.host_time) + adc.to_bytes())
+        for subscriber in self._live():
+            self._deliver(subscriber, AttributeDataType.ATT_ADC, message, True)
+
+    def _deliver(self, subscriber, att, message, optional=False):
+        #A failing subscriber is dropped on its own, so it never stops the poll thread or the fan-out
+        try:
+            if subscriber.att & att:
+                subscriber.offer(message, optional)
+        except Exception as e:
+            print(f'Dropped subscriber: {e!r}', file=sys.stderr)
+            subscriber.close()
+
+    def serve_forever(self):
+        """
+        Fans every streamed batch out to the subscribers until the stream stops or fails.
+        """
+        queue_bits = AttributeDataType.ATT_ADC_QUEUE | AttributeDataType.ATT_ADC_QUEUE_10K
+        for batch in self.meter.iter_stream():
+            records = batch_to_bytes(batch)
+            for subscriber in self._live():
+                #Packed by the sender thread, so the dropped counter is current when it leaves
+                #The defaults bind this batch, a queued message may be packed after the loop moved on
+                self._deliver(subscriber, queue_bits, lambda s=subscriber, t=batch.host_time, r=records: _message(
+                    BATCH, BATCH_STRUCT.pack(t, s.dropped) + r))
+
+    def close(self):
+        if self._server is not None:
+            self._server.close()
+            self._server = None
+            if os.path.exists(self.path):
+                os.unlink(self.path)
+        for subscriber in self._live():
+            subscriber.close()
+        self.meter.stop_stream()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+class DaemonClient:
+    """
+    Subscriber of a Daemon with the get_data()/poll() interface of PowerZ_KM003C.
+
+    Like the meter's own queue, get_data() returns everything received since the previous call without
+    waiting. Batches not fetched in time back up in the socket and then in the daemon, where policy
+    decides whether they are dropped ('drop', counted in dropped) or hold the acquisition back ('block').
+    """
+
+    def __init__(self, path=DEFAULT_SOCKET, att: int = AttributeDataType.ATT_ADC | AttributeDataType.ATT_ADC_QUEUE,
+                 policy='drop', queue_size=256):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(path)
+        #Both queue attributes select the stream, whichever the rate of the daemon uses
+        if att & (AttributeDataType.ATT_ADC_QUEUE | AttributeDataType.ATT_ADC_QUEUE_10K):
+            att |= AttributeDataType.ATT_ADC_QUEUE | AttributeDataType.ATT_ADC_QUEUE_10K
+        request = json.dumps({'att': int(att), 'policy': policy, 'queue_size': queue_size}).encode()
+        self.sock.sendall(_message(SUBSCRIBE, request))
+        self._buffer = bytearray()
+        self._batches = []   # (host time, records) received and not returned yet
+        self.adc = None      # Latest AdcData
+        self.dropped = 0
+        self.meta = None
+        try:
+            while self.meta is None:
+                self._receive(True)
+        except (OSError, ValueError):
+            self.sock.close()
+            raise
+        self.rate = Rate(self.meta['rate'])
+        self.att = self.meta['att']
+
+    def _receive(self, block):
+        """
+        Reads what the socket holds, waiting for at least one message if block is set.
+        """
+        while True:
+            try:
+                chunk = self.sock.recv(1 << 16, 0 if block else socket.MSG_DONTWAIT)
+            except BlockingIOError:
+                return
+            if not chunk:
+                raise ConnectionError('Daemon closed the connection')
+            self._buffer += chunk
+            if self._dispatch() and block:
+                return
+
+    def _dispatch(self):
+        buffer = self._buffer
+        offset = handled = 0
+        while len(buffer) - offset >= MESSAGE_STRUCT.size:
+            kind, size = MESSAGE_STRUCT.unpack_from(buffer, offset)
+            end = offset + MESSAGE_STRUCT.size + size
+            if len(buffer) < end:
+                break
+            payload = bytes(buffer[offset + MESSAGE_STRUCT.size:end])
+            if kind == BATCH:
+                host_time, self.dropped = BATCH_STRUCT.unpack_from(payload)
+                self._batches.append((host_time, payload[BATCH_STRUCT.size:]))
+            elif kind == ADC:
+                adc = AdcData.from_bytes(payload[ADC_STRUCT.size:])
+                adc.host_time = ADC_STRUCT.unpack_from(payload)[0]
+                self.adc = adc
+            elif kind == HELLO:
+                self.meta = json.loads(payload)
+            elif kind == ERROR:
+                raise ValueError(f'Daemon rejected the subscription: {json.loads(payload)["error"]}')
+            offset = end
+            handled += 1
+        del buffer[:offset]
+        return handled
+
+    def _take_batch(self):
+        batches, self._batches = self._batches, []
+        records = b''.join(records for _, records in batches)
+        batch = AdcQueueBatch.from_bytes(records, len(records) // RECORD_STRUCT.size)
+        batch.host_time = batches[-1][0]
+        return batch
+
+    def get_data(self, att: int = AttributeDataType.ATT_ADC_QUEUE):
+        """
+        Returns the segments of att received so far, like PowerZ_KM003C.get_data().
+        The ADC queue segment carries the attribute of the daemon's rate.
+        """
+        self._receive(False)
+        segments = []
+        if att & AttributeDataType.ATT_ADC and self.adc is not None:
+            segments.append((AttributeDataType.ATT_ADC, self.adc))
+        if att & (AttributeDataType.ATT_ADC_QUEUE | AttributeDataType.ATT_ADC_QUEUE_10K) and self._batches:
+            segments.append((self.att, self._take_batch()))
+        return segments
+
+    def poll(self, att: int = AttributeDataType.ATT_ADC | AttributeDataType.ATT_ADC_QUEUE):
+        return DataResponse(self.get_data(att))
+
+    def iter_stream(self):
+        """
+        Yields every batch as soon as it arrives, until the daemon closes the connection.
+        """
+        while True:
+            while not self._batches:
+                try:
+                    self._receive(True)
+                except ConnectionError:
+                    return
+            for host_time, records in self._batches:
+                batch = AdcQueueBatch.from_bytes(records, len(records) // RECORD_STRUCT.size)
+                batch.host_time = host_time
+                yield batch
+            self._batches = []
+
+    def close(self):
+        self.sock.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+def main():
+    parser = argparse.ArgumentParser(description="Share one KM003C with any number of clients over a Unix socket")
+    parser.add_argument('--socket', '-s', type=str, default=DEFAULT_SOCKET,
+                        help=f"Path of the Unix domain socket (default: {DEFAULT_SOCKET}).")
+    parser.add_argument('--rate', '-r', type=int, choices=[0, 1, 2, 3, 4], default=3,
+                        help="Data logging rate: 0 for 2SPS, 1 for 10SPS, 2 for 50SPS, 3 for 1KSPS, 4 for 10KSPS (default: 3).")
+
+    args = parser.parse_args()
+    try:
+        with PowerZ_KM003C() as power_meter, Daemon(power_meter, args.socket, Rate(args.rate)) as daemon:
+            print(f'Serving on {args.socket}', file=sys.stderr)
+            daemon.serve_forever()
+    except KeyboardInterrupt: pass
+
+if __name__ == '__main__':
+    main()
@@ -1,7 +1,13 @@
 
 import struct
+from array import array
 from enum import IntEnum
 
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
 class CommandRejected(Exception):
     pass
 
@@ -46,9 +52,45 @@ class Rate(IntEnum):
     _10SPS = 1
     _50SPS = 2
     _1KSPS = 3
+    _10KSPS = 4
+
+# Nominal samples per second of every Rate
+RATE_SPS = {
+    Rate._2SPS: 2,
+    Rate._10SPS: 10,
+    Rate._50SPS: 50,
+    Rate._1KSPS: 1000,
+    Rate._10KSPS: 10000,
+}
+
+# Most entries a single ADC queue segment can carry (6 bit chunk field)
+QUEUE_CHUNK_MAX = 0x3F
+
+def queue_attribute(rate: Rate):
+    """
+    Returns the ADC queue attribute that carries the samples of rate.
+    """
+    if rate == Rate._10KSPS:
+        return AttributeDataType.ATT_ADC_QUEUE_10K
+    return AttributeDataType.ATT_ADC_QUEUE
+
+_ENUM_NAMES = {}
+
+def enum_name(enum, value):
+    """
+    Returns the name of value in enum, or Unknown(value), from a table built once per enum.
+    """
+    names = _ENUM_NAMES.get(enum)
+    if names is None:
+        names = _ENUM_NAMES[enum] = {member.value: member.name for member in enum}
+    name = names.get(value)
+    return name if name is not None else f"Unknown({value})"
 
 # Header class definition
 class MsgHeader:
+    STRUCT = struct.Struct('<I')
+    __slots__ = ('type', 'extend', 'id', 'att', 'obj')
+
     def __init__(self, type, extend, id, att=None, obj=None):
         self.type = type      # 7 bits
         self.extend = extend  # 1 bit
@@ -65,7 +107,7 @@ class MsgHeader:
             raise ValueError("Data must be exactly 4 bytes.")
 
         # Unpack the 4 bytes into a 32-bit unsigned integer
-        packed = struct.unpack('<I', data)[0]
+        packed = cls.STRUCT.unpack(data)[0]
 
         # Extract common fields
         type = packed & 0x7F
@@ -98,14 +140,14 @@ class MsgHeader:
                 ((self.id & 0xFF) << 8) |         # ID (8 bits)
                 ((self.att & 0x7FFF) << 17)       # Attribute (15 bits)
             )
-        return struct.pack('<I', header)
+        return self.STRUCT.pack(header)
 
     def __str__(self):
         """
         Returns a readable string representation of the MsgHeader object.
         """
         if self.type > 63:  # Data message
-            type_name = CmdDataMsgType(self.type).name if self.type in CmdDataMsgType._value2member_map_ else f"Unknown({self.type})"
+            type_name = enum_name(CmdDataMsgType, self.type)
             return (
                 f"MsgHeader (Data):\n"
                 f"  Type: {type_name} (Data Message)\n"
@@ -114,8 +156,8 @@ class MsgHeader:
                 f"  Object: {self.obj*4}"
             )
         else:  # Control message
-            type_name = CmdCtrlMsgType(self.type).name if self.type in CmdCtrlMsgType._value2member_map_ else f"Unknown({self.type})"
-            att_name = AttributeDataType(self.att).name if self.att in AttributeDataType._value2member_map_ else f"Unknown({self.att})"
+            type_name = enum_name(CmdCtrlMsgType, self.type)
+            att_name = enum_name(AttributeDataType, self.att)
 
             return (
                 f"MsgHeader (Control):\n"
@@ -125,11 +167,27 @@ class MsgHeader:
                 f"  Attribute: {att_name} ({self.att})"
             )
 
+#Header words of the control commands sent so far, without their id
+_COMMAND_HEADERS = {}
+
+def command_frame(type, id, att=0):
+    """
+    Returns the 4 byte frame of a control command. The header of every type and attribute
+    is encoded once, only the id byte is patched in per call.
+    """
+    header = _COMMAND_HEADERS.get((type, att))
+    if header is None:
+        header = _COMMAND_HEADERS[type, att] = MsgHeader.STRUCT.unpack(MsgHeader(type, 0, 0, att=att).to_bytes())[0]
+    return MsgHeader.STRUCT.pack(header | (id & 0xFF) << 8)
+
 class AdcData:
     """
     Represents the AdcData_TypeDef structure.
     """
     STRUCT_FORMAT = '<6ih5HI'  # Format string for struct.unpack based on the AdcData structure.
+    STRUCT = struct.Struct(STRUCT_FORMAT)
+    __slots__ = ('vbus', 'ibus', 'vbus_avg', 'ibus_avg', 'vbus_ori_avg', 'ibus_ori_avg', 'temp_raw', 'temp',
+                 'vcc1', 'vcc2', 'vdp', 'vdm', 'vdd', 'rate', 'host_time')
 
     def __init__(self, vbus, ibus, vbus_avg, ibus_avg, vbus_ori_avg, ibus_ori_avg,
                  temp, vcc1, vcc2, vdp, vdm, vdd, rate):
@@ -139,6 +197,7 @@ class AdcData:
         self.ibus_avg = ibus_avg        # Smoothed average current (1 µA)
         self.vbus_ori_avg = vbus_ori_avg  # Uncalibrated average voltage (1 µV)
         self.ibus_ori_avg = ibus_ori_avg  # Uncalibrated average current (1 µA)
+        self.temp_raw = temp            # Raw INA228/9 temperature register
         # INA228/9 datasheet LSB = 7.8125 m°C = 1000/128
         msb = (temp >> 8) & 0xFF
         lsb = temp & 0xFF
@@ -148,19 +207,27 @@ class AdcData:
         self.vdp = vdp
         self.vdm = vdm
         self.vdd = vdd                  # Internal VDD voltage
-        self.rate = (rate >> 16) & 0x3  # Rate: 2 bits
+        self.rate = (rate >> 16) & 0x7  # Rate: 3 bits, as Rate._10KSPS is 4
+        self.host_time = None           # Host time.monotonic() of the request, when known
 
     @classmethod
     def from_bytes(cls, data):
         """
         Parses bytes into an AdcData object.
         """
-        if len(data) < struct.calcsize(cls.STRUCT_FORMAT):
-            raise ValueError(f"Data size ({len(data)}) is smaller than expected for AdcData ({struct.calcsize(cls.STRUCT_FORMAT)}).")
+        if len(data) < cls.STRUCT.size:
+            raise ValueError(f"Data size ({len(data)}) is smaller than expected for AdcData ({cls.STRUCT.size}).")
 
         # Unpack the data based on the format string
-        unpacked = struct.unpack(cls.STRUCT_FORMAT, data[:40])
-        return cls(*unpacked)
+        return cls(*cls.STRUCT.unpack_from(data))
+
+    def to_bytes(self):
+        """
+        Packs the AdcData object back into its 40 byte layout.
+        """
+        return self.STRUCT.pack(self.vbus, self.ibus, self.vbus_avg, self.ibus_avg,
+                                self.vbus_ori_avg, self.ibus_ori_avg, self.temp_raw, self.vcc1, self.vcc2,
+                                self.vdp, self.vdm, self.vdd, self.rate << 16)
 
     def __str__(self):
         """
@@ -190,6 +257,8 @@ class MsgHeaderHeader:
     Represents the header subtype of MsgHeader.
     """
     STRUCT_FORMAT = '<I'  # 4 bytes (uint32_t)
+    STRUCT = struct.Struct(STRUCT_FORMAT)
+    __slots__ = ('att', 'next_flag', 'chunk', 'size')
 
     def __init__(self, att, next_flag, chunk, size):
         self.att = att              # 15 bits: Attribute code
@@ -206,7 +275,7 @@ class MsgHeaderHeader:
             raise ValueError("Data must be exactly 4 bytes.")
 
         # Unpack the 4 bytes into a 32-bit unsigned integer
-        packed = struct.unpack(cls.STRUCT_FORMAT, data)[0]
+        packed = cls.STRUCT.unpack(data)[0]
 
         # Extract individual fields using bit masking and shifting
         att = packed & 0x7FFF                 # 15 bits for att
@@ -226,13 +295,13 @@ class MsgHeaderHeader:
             ((self.chunk & 0x3F) << 16) |    # 6 bits for chunk
             ((self.size & 0x03FF) << 22)     # 10 bits for size
         )
-        return struct.pack(self.STRUCT_FORMAT, header)
+        return self.STRUCT.pack(header)
 
     def __str__(self):
         """
         Returns a readable string representation of the MsgHeaderHeader object.
         """
-        att_name = AttributeDataType(self.att).name if self.att in AttributeDataType._value2member_map_ else f"Unknown({self.att})"
+        att_name = enum_name(AttributeDataType, self.att)
         return (
             f"MsgHeader (Header Subtype):\n"
             f"  Attribute: {att_name}\n"
@@ -246,6 +315,8 @@ class AdcQueueEntry:
     Represents an extended ADC data structure, including timestamp and multiple voltage/current measurements.
     """
     STRUCT_FORMAT = '<I2i4H'  # Format: Timestamp (uint32), 2 signed integers, 4 unsigned shorts.
+    STRUCT = struct.Struct(STRUCT_FORMAT)
+    __slots__ = ('timestamp_ms', 'vbus', 'ibus', 'vcc1', 'vcc2', 'vdp', 'vdm')
 
     def __init__(self, timestamp_ms, vbus, ibus, vcc1, vcc2, vdp, vdm):
         self.timestamp_ms = timestamp_ms  # Timestamp in milliseconds
@@ -261,14 +332,13 @@ class AdcQueueEntry:
         """
         Parses bytes into an AdcQueueEntry object.
         """
-        if len(data) < struct.calcsize(cls.STRUCT_FORMAT):
+        if len(data) < cls.STRUCT.size:
             raise ValueError(
-                f"Data size ({len(data)}) is smaller than expected for AdcQueueEntry ({struct.calcsize(cls.STRUCT_FORMAT)})."
+                f"Data size ({len(data)}) is smaller than expected for AdcQueueEntry ({cls.STRUCT.size})."
             )
 
         # Unpack the data based on the format string
-        unpacked = struct.unpack(cls.STRUCT_FORMAT, data)
-        return cls(*unpacked)
+        return cls(*cls.STRUCT.unpack_from(data))
 
     def __str__(self):
         """
@@ -285,6 +355,191 @@ class AdcQueueEntry:
             f"  Vdm: {self.vdm} mV"
         )
 
+class AdcQueueBatch:
+    """
+    Columnar representation of a whole ADC_QUEUE chunk.
+
+    Every column holds one value per sample, either as a numpy array or, when numpy is
+    not available, as an array.array. Iterating or indexing yields AdcQueueEntry objects.
+    """
+    COLUMNS = ('timestamp_ms', 'vbus', 'ibus', 'vcc1', 'vcc2', 'vdp', 'vdm')
+    ARRAY_TYPECODES = ('I', 'i', 'i', 'H', 'H', 'H', 'H')  # Matches AdcQueueEntry.STRUCT_FORMAT
+    DTYPE = np.dtype([
+        ('timestamp_ms', '<u4'),
+        ('vbus', '<i4'),
+        ('ibus', '<i4'),
+        ('vcc1', '<u2'),
+        ('vcc2', '<u2'),
+        ('vdp', '<u2'),
+        ('vdm', '<u2'),
+    ]) if np is not None else None
+
+    def __init__(self, timestamp_ms, vbus, ibus, vcc1, vcc2, vdp, vdm):
+        self.timestamp_ms = timestamp_ms  # Timestamp in milliseconds
+        self.vbus = vbus                  # Voltage bus in µV
+        self.ibus = ibus                  # Current bus in µA
+        self.vcc1 = vcc1                  # Vcc1 in 0.1mV
+        self.vcc2 = vcc2                  # Vcc2 in 0.1mV
+        self.vdp = vdp                    # Voltage on D+ line in mV
+        self.vdm = vdm                    # Voltage on D- line in mV
+        self.records = None               # Backing numpy structured array, if any
+        self.host_time = None             # Host time.monotonic() of the request, set when streaming
+
+    @classmethod
+    def from_bytes(cls, data, count, stride=None):
+        """
+        Decodes count consecutive AdcQueueEntry records into a batch in one step.
+        stride is the record size reported by the device, defaults to the packed record size.
+        """
+        size = AdcQueueEntry.STRUCT.size
+        if stride is None:
+            stride = size
+        if stride < size:
+            raise ValueError(f"Record size ({stride}) is smaller than expected for AdcQueueEntry ({size}).")
+        if len(data) < count * stride:
+            raise ValueError(f"Data size ({len(data)}) is smaller than expected for {count} AdcQueueEntry records ({count * stride}).")
+
+        if np is not None:
+            dtype = cls.DTYPE
+            if stride != size:
+                dtype = np.dtype({'names': dtype.names, 'formats': [dtype[n] for n in dtype.names],
+                                  'offsets': [dtype.fields[n][1] for n in dtype.names], 'itemsize': stride})
+            records = np.frombuffer(data, dtype=dtype, count=count).copy()
+            return cls.from_records(records)
+
+        # Fallback without numpy: transpose the unpacked records into typed arrays
+        if stride != size:
+            data = b''.join(data[i*stride:i*stride+size] for i in range(count))
+        rows = AdcQueueEntry.STRUCT.iter_unpack(data[:count*size])
+        columns = zip(*rows) if count else [()] * len(cls.COLUMNS)
+        return cls(*(array(code, column) for code, column in zip(cls.ARRAY_TYPECODES, columns)))
+
+    @classmethod
+    def from_records(cls, records):
+        """
+        Wraps a numpy structured array with the DTYPE fields without copying it.
+        """
+        batch = cls(*(records[name] for name in cls.COLUMNS))
+        batch.records = records
+        return batch
+
+    @classmethod
+    def from_entries(cls, entries):
+        """
+        Builds a batch from a sequence of AdcQueueEntry objects.
+        """
+        columns = [[getattr(entry, name) for entry in entries] for name in cls.COLUMNS]
+        if np is not None:
+            records = np.empty(len(entries), dtype=cls.DTYPE)
+            for name, column in zip(cls.COLUMNS, columns):
+                records[name] = column
+            return cls.from_records(records)
+        return cls(*(array(code, column) for code, column in zip(cls.ARRAY_TYPECODES, columns)))
+
+    def columns(self):
+        """
+        Returns a dict mapping the column names to the column arrays.
+        """
+        return {name: getattr(self, name) for name in self.COLUMNS}
+
+    def lists(self):
+        """
+        Returns the columns as plain Python lists, in COLUMNS order.
+        """
+        return [getattr(self, name).tolist() for name in self.COLUMNS]
+
+    def entries(self):
+        """
+        Returns the batch as a list of AdcQueueEntry objects.
+        """
+        return list(self)
+
+    def __len__(self):
+        return len(self.timestamp_ms)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            if self.records is not None:
+                batch = self.from_records(self.records[index])
+            else:
+                batch = type(self)(*(getattr(self, name)[index] for name in self.COLUMNS))
+            batch.host_time = self.host_time
+            return batch
+        return AdcQueueEntry(*(int(getattr(self, name)[index]) for name in self.COLUMNS))
+
+    def __iter__(self):
+        for values in zip(*self.lists()):
+            yield AdcQueueEntry(*values)
+
+    def __str__(self):
+        """
+        Returns a readable string representation of the AdcQueueBatch object.
+        """
+        if not len(self):
+            return "AdcQueueBatch: empty"
+        return (
+            f"AdcQueueBatch:\n"
+            f"  Samples: {len(self)}\n"
+            f"  Timestamp: {self.timestamp_ms[0]} - {self.timestamp_ms[-1]} ms"
+        )
+
+class DataResponse:
+    """
+    Typed, keyed view of every segment of one PUT_DATA response.
+
+    segments maps each AttributeDataType to the object parse_data decoded for it. The typed
+    attributes hold AdcData, AdcQueueBatch or, for the attributes without a decoder, the raw payload bytes.
+    """
+    ATTRIBUTE_NAMES = {
+        AttributeDataType.ATT_ADC: 'adc',
+        AttributeDataType.ATT_ADC_QUEUE: 'adc_queue',
+        AttributeDataType.ATT_ADC_QUEUE_10K: 'adc_queue_10k',
+        AttributeDataType.ATT_SETTINGS: 'settings',
+        AttributeDataType.ATT_PD_PACKET: 'pd_packet',
+        AttributeDataType.ATT_PD_STATUS: 'pd_status',
+        AttributeDataType.ATT_QC_PACKET: 'qc_packet',
+    }
+
+    def __init__(self, segments=None):
+        self.segments = {}
+        self.adc = None             # AdcData
+        self.adc_queue = None       # AdcQueueBatch
+        self.adc_queue_10k = None   # AdcQueueBatch
+        self.settings = None        # bytes
+        self.pd_packet = None       # bytes
+        self.pd_status = None       # bytes
+        self.qc_packet = None       # bytes
+        self.host_time = None       # Host time.monotonic() of the request, set when streaming
+        for att, obj in segments or []:
+            self.add(att, obj)
+
+    def add(self, att, obj):
+        self.segments[att] = obj
+        name = self.ATTRIBUTE_NAMES.get(att)
+        if name is not None:
+            if isinstance(obj, tuple):
+                obj = obj[1]
+            setattr(self, name, obj)
+
+    def __getitem__(self, att):
+        return self.segments[att]
+
+    def __contains__(self, att):
+        return att in self.segments
+
+    def __len__(self):
+        return len(self.segments)
+
+    def get(self, att, default=None):
+        return self.segments.get(att, default)
+
+    def __str__(self):
+        """
+        Returns a readable string representation of the DataResponse object.
+        """
+        names = ', '.join(enum_name(AttributeDataType, att) for att in self.segments)
+        return f"DataResponse: {names or 'empty'}"
+
 def print_data(data, obj_size):
     #obj size is not reliable
     if len(data) <= 0:
@@ -298,7 +553,7 @@ def print_data(data, obj_size):
     if ext_header.att == AttributeDataType.ATT_ADC:
         adc_data = AdcData.from_bytes(data[4:4+ext_header.size])
         print(adc_data)
-    elif ext_header.att == AttributeDataType.ATT_ADC_QUEUE:
+    elif ext_header.att in (AttributeDataType.ATT_ADC_QUEUE, AttributeDataType.ATT_ADC_QUEUE_10K):
         for i in range(max(ext_header.chunk, 1)):
             entry = AdcQueueEntry.from_bytes(data[4+(i*ext_header.size):4+((i+1)*ext_header.size)])
             print(entry)
@@ -312,27 +567,35 @@ def print_data(data, obj_size):
             print('data remaining')
     return
 
-def parse_data(data: bytes):
-    if len(data) == 0:
-        return []
-    ext_header = MsgHeaderHeader.from_bytes(data[:4])
-    obj = None
-    if ext_header.att == AttributeDataType.ATT_ADC:
-        obj = AdcData.from_bytes(data[4:4+ext_header.size])
-    elif ext_header.att == AttributeDataType.ATT_ADC_QUEUE:
-        entries = []
-        for i in range(max(ext_header.chunk, 1)):
-            entries.append(AdcQueueEntry.from_bytes(data[4+(i*ext_header.size):4+((i+1)*ext_header.size)]))
-        obj = entries
-    else:
-        obj = (ext_header.att, data[4:4+ext_header.size])
+def iter_data(data):
+    """
+    Lazily yields (att, obj) for every segment of a PUT_DATA payload.
+    The buffer is walked by offset through a single memoryview, so nothing but the decoded objects is allocated.
+    Decoded objects never reference the buffer, which may therefore be reused afterwards.
+    """
+    view = memoryview(data)
+    offset = 0
+    while offset < len(view):
+        ext_header = MsgHeaderHeader.from_bytes(view[offset:offset+4])
+        offset += 4
+        if ext_header.att == AttributeDataType.ATT_ADC:
+            obj = AdcData.from_bytes(view[offset:offset+ext_header.size])
+        elif ext_header.att in (AttributeDataType.ATT_ADC_QUEUE, AttributeDataType.ATT_ADC_QUEUE_10K):
+            #The 10K queue uses the same record layout, the header size gives the stride
+            obj = AdcQueueBatch.from_bytes(view[offset:], max(ext_header.chunk, 1), ext_header.size)
+        else:
+            obj = (ext_header.att, bytes(view[offset:offset+ext_header.size]))
+        yield ext_header.att, obj
+
+        if not ext_header.next_flag:
+            return
+        size = ext_header.size
+        if ext_header.chunk:
+            size *= ext_header.chunk
+        offset += size
 
-    size = ext_header.size
-    if ext_header.chunk:
-        size *= ext_header.chunk
-    if ext_header.next_flag:
-        return [(ext_header.att, obj)] + parse_data(data[4+size:])
-    return [(ext_header.att, obj)]
+def parse_data(data: bytes):
+    return list(iter_data(data))
 
 def interpret_response(data):
     header = MsgHeader.from_bytes(data[:4])
@@ -0,0 +1,234 @@
+import math
+import random
+import struct
+import time
+import usb.core
+from array import array
+from collections import deque
+from .defs import *
+from .pd import (CATEGORY_CONTROL, CATEGORY_DATA, PdControlType, PdDataType, message_header,
+                 pack_record)
+
+ENTRY_STRUCT = struct.Struct(AdcQueueEntry.STRUCT_FORMAT)
+TIMESTAMP_STRUCT = struct.Struct('<I')
+ADC_STRUCT = struct.Struct(AdcData.STRUCT_FORMAT)
+#Fixed 5 V, 9 V and 15 V at 3 A and PPS 3.3-11 V at 3 A
+SOURCE_PDOS = (100 << 10 | 300, 180 << 10 | 300, 300 << 10 | 300, 3 << 30 | 110 << 17 | 33 << 8 | 60)
+
+class VirtualContext:
+    """
+    Stands in for the pyusb context, so usb.util.claim_interface and dispose_resources accept virtual devices.
+    """
+
+    def managed_claim_interface(self, device, interface):
+        pass
+
+    def managed_release_interface(self, device, interface):
+        pass
+
+    def dispose(self, device, close_handle=True):
+        pass
+
+class VirtualDevice:
+    """
+    Minimal usb.core.Device look-alike. Every write() is passed to handler, which returns the IN frames
+    answering it, and without a handler nothing is answered, so reads time out. Subclasses may override
+    write() instead, queueing IN frames with respond().
+    """
+
+    def __init__(self, bus=1, address=1, port_numbers=(1,), handler=None):
+        self._ctx = VirtualContext()
+        self.handler = handler
+        self.bus = bus
+        self.address = address
+        self.port_numbers = port_numbers
+        self._frames = deque()
+
+    def is_kernel_driver_active(self, interface):
+        return False
+
+    def detach_kernel_driver(self, interface):
+        pass
+
+    def respond(self, frame):
+        self._frames.append(frame)
+
+    def write(self, endpoint, data, timeout=None):
+        if self.handler is not None:
+            for frame in self.handler(bytes(data)):
+                self.respond(frame)
+        return len(data)
+
+    def read(self, endpoint, size_or_buffer, timeout=None):
+        if not self._frames:
+            raise usb.core.USBTimeoutError('Operation timed out', errno=110)
+        frame = self._frames.popleft()
+        if isinstance(size_or_buffer, int):
+            return array('B', frame[:size_or_buffer])
+        size = min(len(frame), len(size_or_buffer))
+        memoryview(size_or_buffer)[:size] = frame[:size]
+        return size
+
+class EmulatedKM003C(VirtualDevice):
+    """
+    Software KM003C speaking the connect handshake, SET_RATE, STOP, DISCONNECT and GET_DATA for
+    ATT_ADC, ATT_ADC_QUEUE and ATT_ADC_QUEUE_10K, and with pd_interval_s ATT_PD_PACKET.
+
+    Samples accumulate in a queue of queue_depth entries at the configured rate, following clock.
+    With free_run every ADC queue request returns a full chunk instead, for throughput measurements.
+    The signal is a vbus level with ripple and noise and an ibus load alternating between two steps.
+    With pd_interval_s a PD negotiation alternating between the 5 V and 9 V PDOs starts every pd_interval_s
+    seconds, in the framing assumed by the PD decoder.
+    """
+
+    def __init__(self, free_run=False, clock=time.monotonic, queue_depth=4 * QUEUE_CHUNK_MAX,
+                 chunk=QUEUE_CHUNK_MAX, timestamp_start=0, vbus=5000000, ripple=20000, ripple_hz=120.0,
+                 ibus=(500000, 1500000), step_s=1.0, noise=2000, seed=0, pd_interval_s=None, **kwargs):
+        super().__init__(**kwargs)
+        self.free_run = free_run
+        self.clock = clock
+        self.queue_depth = queue_depth
+        self.chunk = chunk
+        self.timestamp_start = timestamp_start
+        self.vbus = vbus
+        self.ripple = ripple
+        self.ripple_hz = ripple_hz
+        self.ibus = ibus
+        self.step_s = step_s
+        self.noise = noise
+        self.pd_interval_s = pd_interval_s
+        self._random = random.Random(seed)
+        self._pd = deque()
+        self.negotiations = 0
+        self.rate = Rate._2SPS
+        self.running = False
+        self.sent = 0       # Samples returned in ADC queue responses since SET_RATE
+        self.dropped = 0    # Samples lost to a full device queue
+        self.requests = 0
+        self._start = 0.0
+        self._render()
+
+    def _render(self):
+        """
+        Pre-packs one load cycle of samples without their timestamp, so responses are cheap to build.
+        """
+        sps = RATE_SPS[self.rate]
+        period = max(1, min(100000, int(sps * self.step_s * len(self.ibus))))
+        rows = []
+        for n in range(period):
+            t = n / sps
+            vbus = self.vbus + int(self.ripple * math.sin(2 * math.pi * self.ripple_hz * t))
+            vbus += self._random.randint(-self.noise, self.noise)
+            ibus = self.ibus[int(t / self.step_s) % len(self.ibus)] + self._random.randint(-self.noise, self.noise)
+            rows.append(ENTRY_STRUCT.pack(0, vbus, ibus, 3300 + (n & 0x3), 0, 600, 600)[4:])
+        self._rows = rows
+
+    def _entry(self, n):
+        timestamp = (self.timestamp_start + n * 1000 // RATE_SPS[self.rate]) & 0xFFFFFFFF
+        return TIMESTAMP_STRUCT.pack(timestamp) + self._rows[n % len(self._rows)]
+
+    def _queue_entries(self):
+        if self.free_run:
+            count = self.chunk
+        else:
+            due = int((self.clock() - self._start) * RATE_SPS[self.rate])
+            backlog = due - self.sent
+            if backlog > self.queue_depth:
+                self.dropped += backlog - self.queue_depth
+                self.sent = due - self.queue_depth
+                backlog = self.queue_depth
+            count = min(backlog, self.chunk)
+        entries = [self._entry(self.sent + i) for i in range(count)]
+        self.sent += count
+        return entries
+
+    def _adc_data(self):
+        timestamp, vbus, ibus, vcc1, vcc2, vdp, vdm = ENTRY_STRUCT.unpack(self._entry(self.sent))
+        return ADC_STRUCT.pack(vbus, ibus, vbus, ibus, vbus, ibus, 0x1900, vcc1, vcc2, vdp, vdm, 3300,
+                               self.rate << 16)
+
+    def _negotiate(self, timestamp):
+        """
+        Queues the PD records of one negotiation, as seen on the CC line.
+        """
+        n = self.negotiations
+        position = 1 + n % 2
+        source, sink = {'power_role': 1, 'data_role': 1, 'message_id': n}, {'message_id': n}
+        messages = [
+            (0, message_header(CATEGORY_DATA, PdDataType.Source_Capabilities, len(SOURCE_PDOS), **source) +
+                struct.pack(f'<{len(SOURCE_PDOS)}I', *SOURCE_PDOS)),
+            (1, message_header(CATEGORY_CONTROL, PdControlType.GoodCRC, **sink)),
+            (2, message_header(CATEGORY_DATA, PdDataType.Request, 1, **sink) + struct.pack('<I', position << 28 | 300 << 10 | 300)),
+            (3, message_header(CATEGORY_CONTROL, PdControlType.GoodCRC, **source)),
+            (4, message_header(CATEGORY_CONTROL, PdControlType.Accept, **source)),
+            (5, message_header(CATEGORY_CONTROL, PdControlType.GoodCRC, **sink)),
+            (30, message_header(CATEGORY_CONTROL, PdControlType.PS_RDY, **source)),
+            (31, message_header(CATEGORY_CONTROL, PdControlType.GoodCRC, **sink)),
+        ]
+        self._pd.extend(pack_record(timestamp + offset, 0, message) for offset, message in messages)
+        self.negotiations += 1
+
+    def _pd_packet(self):
+        elapsed = self.clock() - self._start
+        while elapsed >= self.negotiations * self.pd_interval_s:
+            self._negotiate(self.timestamp_start + int(self.negotiations * self.pd_interval_s * 1000))
+        payload = b''
+        #The segment size field has 10 bits
+        while self._pd and len(payload) + len(self._pd[0]) < 1024:
+            payload += self._pd.popleft()
+        return payload
+
+    def _put_data(self, id, att):
+        segments = []
+        for bit in (AttributeDataType.ATT_ADC, AttributeDataType.ATT_ADC_QUEUE, AttributeDataType.ATT_ADC_QUEUE_10K):
+            if not att & bit:
+                continue
+            if bit == AttributeDataType.ATT_ADC:
+                payload = self._adc_data()
+                segments.append([MsgHeaderHeader(bit, 0, 0, len(payload)), payload])
+            elif self.running:
+                entries = self._queue_entries()
+                if entries:
+                    segments.append([MsgHeaderHeader(bit, 0, len(entries), len(entries[0])), b''.join(entries)])
+        if att & AttributeDataType.ATT_PD_PACKET and self.running and self.pd_interval_s:
+            payload = self._pd_packet()
+            if payload:
+                segments.append([MsgHeaderHeader(AttributeDataType.ATT_PD_PACKET, 0, 0, len(payload)), payload])
+        for segment in segments[:-1]:
+            segment[0].next_flag = 1
+        body = b''.join(header.to_bytes() + payload for header, payload in segments)
+        return MsgHeader(CmdDataMsgType.CMD_PUT_DATA, 0, id, obj=len(body) // 4).to_bytes() + body
+
+    def _control(self, type, id, att=0):
+        return command_frame(type, id, att)
+
+    def write(self, endpoint, data, timeout=None):
+        data = bytes(data)
+        header = MsgHeader.from_bytes(data[:4])
+        self.requests += 1
+        if header.type == CmdCtrlMsgType.CMD_CONNECT or header.type == CmdCtrlMsgType.CMD_DISCONNECT:
+            self.running = False
+            self.respond(self._control(CmdCtrlMsgType.CMD_ACCEPT, header.id))
+        elif header.type == 76:
+            #Unlock needed for ADC_QUEUE, echoed with the same type
+            self.respond(data[:4])
+        elif header.type == CmdCtrlMsgType.CMD_SET_RATE:
+            if self.running or header.att not in Rate._value2member_map_:
+                self.respond(self._control(CmdCtrlMsgType.CMD_REJECT, header.id))
+            else:
+                self.rate = Rate(header.att)
+                self._render()
+                self.running = True
+                self.sent = 0
+                self.negotiations = 0
+                self._pd.clear()
+                self._start = self.clock()
+                self.respond(self._control(CmdCtrlMsgType.CMD_ACCEPT, header.id))
+        elif header.type == CmdCtrlMsgType.CMD_STOP:
+            self.running = False
+            self.respond(self._control(CmdCtrlMsgType.CMD_ACCEPT, header.id))
+        elif header.type == CmdCtrlMsgType.CMD_GET_DATA:
+            self.respond(self._put_data(header.id, header.att))
+        else:
+            self.respond(self._control(CmdCtrlMsgType.CMD_REJECT, header.id))
+        return len(data)
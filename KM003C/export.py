@@ -0,0 +1,172 @@
+from .defs import *
+from itertools import chain
+import queue
+import threading
+import time
+
+# Columns and units of the logger's text output
+CSV_FIELDNAMES = ['timestamp_ms', 'vbus_µV', 'ibus_µA', 'vcc1_mV', 'vcc2_mV', 'vdp_mV', 'vdm_mV']
+FORMATS = ('csv', 'jsonl')
+
+#vcc1 and vcc2 are in 0.1 mV and written as mV. Splitting them into whole and tenth mV keeps
+#every column an integer, so a whole batch is formatted by a single % operation. The output
+#matches the str() of the float division for the uint16 range of the device.
+CSV_ROW = '%d,%d,%d,%d.%d,%d.%d,%d,%d\r\n'
+JSONL_ROW = ('{"timestamp_ms": %d, "vbus_µV": %d, "ibus_µA": %d, "vcc1_mV": %d.%d, '
+             '"vcc2_mV": %d.%d, "vdp_mV": %d, "vdm_mV": %d}\n')
+
+def _row_values(batch):
+    """
+    Returns the values of every row in output order, flattened into one list.
+    """
+    if np is not None:
+        vcc1 = np.asarray(batch.vcc1, dtype=np.int64)
+        vcc2 = np.asarray(batch.vcc2, dtype=np.int64)
+        columns = np.empty((len(batch), 9), dtype=np.int64)
+        columns[:, 0] = batch.timestamp_ms
+        columns[:, 1] = batch.vbus
+        columns[:, 2] = batch.ibus
+        columns[:, 3], columns[:, 4] = np.divmod(vcc1, 10)
+        columns[:, 5], columns[:, 6] = np.divmod(vcc2, 10)
+        columns[:, 7] = batch.vdp
+        columns[:, 8] = batch.vdm
+        return columns.ravel().tolist()
+    timestamp_ms, vbus, ibus, vcc1, vcc2, vdp, vdm = batch.lists()
+    return list(chain.from_iterable(zip(timestamp_ms, vbus, ibus,
+                                        [v // 10 for v in vcc1], [v % 10 for v in vcc1],
+                                        [v // 10 for v in vcc2], [v % 10 for v in vcc2], vdp, vdm)))
+
+def format_csv(batch):
+    """
+    Returns the batch as CSV rows in the logger's columns and units.
+    """
+    return (CSV_ROW * len(batch)) % tuple(_row_values(batch))
+
+def format_jsonl(batch):
+    """
+    Returns the batch as one JSON object per line, keyed by the CSV column names.
+    """
+    return (JSONL_ROW * len(batch)) % tuple(_row_values(batch))
+
+FORMATTERS = {'csv': format_csv, 'jsonl': format_jsonl}
+
+class CsvWriter:
+    """
+    Writes AdcQueueBatch objects as CSV rows with the logger's columns and units.
+    """
+
+    def __init__(self, path):
+        self._file = open(path, 'w', newline='')
+        self._file.write(','.join(CSV_FIELDNAMES) + '\r\n')
+
+    def write(self, batch):
+        self._file.write(format_csv(batch))
+
+    def flush(self):
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+class TextExportWriter:
+    """
+    Writes AdcQueueBatch objects as CSV or JSON lines from a background thread.
+
+    write() only queues the batch. The thread formats whole batches and writes the text in blocks,
+    once flush_bytes have accumulated or flush_interval seconds have passed since the last write,
+    so disk writes never hold back the caller. A full queue of backlog batches blocks write().
+    An error of the thread is raised by the next write(), flush() or close().
+    """
+
+    def __init__(self, path, format='csv', flush_interval=1.0, flush_bytes=1 << 20, backlog=1024):
+        if format not in FORMATTERS:
+            raise ValueError(f'Unknown format {format}')
+        self.format = format
+        self.flush_interval = flush_interval
+        self.flush_bytes = flush_bytes
+        self._formatter = FORMATTERS[format]
+        self._file = open(path, 'w', newline='', encoding='utf-8')
+        if format == 'csv':
+            self._file.write(','.join(CSV_FIELDNAMES) + '\r\n')
+        self._queue = queue.Queue(backlog)
+        self.error = None
+        self.written = 0  # Samples handed to the file so far
+        self._thread = threading.Thread(target=self._run, name='km003c-export', daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        pending = []
+        size = 0
+        last_write = time.monotonic()
+        try:
+            while True:
+                timeout = max(0.0, last_write + self.flush_interval - time.monotonic()) if pending else None
+                try:
+                    item = self._queue.get(timeout=timeout)
+                except queue.Empty:
+                    item = ()
+                if item is None:
+                    break
+                if isinstance(item, threading.Event):
+                    force = item
+                else:
+                    force = None
+                    if item:
+                        text = self._formatter(item)
+                        pending.append(text)
+                        size += len(text)
+                        self.written += len(item)
+                if pending and (force or size >= self.flush_bytes or time.monotonic() - last_write >= self.flush_interval):
+                    self._file.write(''.join(pending))
+                    self._file.flush()
+                    pending = []
+                    size = 0
+                    last_write = time.monotonic()
+                if force:
+                    force.set()
+        except Exception as e:
+            self.error = e
+            #Keep draining so the producer never blocks on a dead writer
+            while self._queue.get() is not None:
+                pass
+            return
+        if pending:
+            self._file.write(''.join(pending))
+
+    def _check(self):
+        if self.error is not None:
+            raise self.error
+
+    def write(self, batch):
+        self._check()
+        if len(batch):
+            self._queue.put(batch)
+
+    def flush(self):
+        """
+        Waits until everything queued so far is written to the file.
+        """
+        self._check()
+        done = threading.Event()
+        self._queue.put(done)
+        while not done.wait(0.1):
+            self._check()
+
+    def close(self):
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+        self._file.close()
+        self._check()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
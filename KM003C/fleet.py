@@ -0,0 +1,111 @@
+import csv
+import threading
+import time
+from .km003c import *
+
+def find_all():
+    """
+    Returns every connected KM003C.
+    """
+    return list(usb.core.find(find_all=True, idVendor=VENDOR_ID, idProduct=PRODUCT_ID))
+
+def device_id(dev):
+    """
+    Returns a stable name for a meter from its bus and port path, e.g. '1-2.4'.
+    """
+    ports = getattr(dev, 'port_numbers', None)
+    if ports:
+        return f"{dev.bus}-{'.'.join(str(port) for port in ports)}"
+    return f'{dev.bus}-{dev.address}'
+
+class Fleet:
+    """
+    Drives several meters at once, each polled by its own stream thread.
+
+    All meters share one host clock reference: host_time() maps the time.monotonic() stamp of a
+    streamed batch to wall clock seconds consistently across devices.
+    """
+
+    def __init__(self, devices=None):
+        if devices is None:
+            devices = find_all()
+        self.meters = {}
+        try:
+            for dev in devices:
+                self.meters[device_id(dev)] = PowerZ_KM003C(dev)
+        except:
+            self.close()
+            raise
+        if not self.meters:
+            raise RuntimeError('Unable to locate any POWER-Z KM003C meter')
+        self.wall_start = time.time()
+        self.clock_start = time.monotonic()
+        self._workers = []
+
+    def host_time(self, monotonic):
+        return self.wall_start + (monotonic - self.clock_start)
+
+    def start_stream(self, rate: Rate, **kwargs):
+        for meter in self.meters.values():
+            meter.start_stream(rate, **kwargs)
+
+    def run(self, worker):
+        """
+        Starts worker(device_id, meter) on its own thread for every meter.
+        """
+        for name, meter in self.meters.items():
+            thread = threading.Thread(target=worker, args=(name, meter), name=f'km003c-{name}', daemon=True)
+            self._workers.append(thread)
+            thread.start()
+
+    def join(self, timeout=None):
+        for thread in self._workers:
+            thread.join(timeout)
+
+    def stop_stream(self):
+        for meter in self.meters.values():
+            meter.stop_stream()
+        self.join()
+        self._workers = []
+
+    def stream_stats(self):
+        return {name: meter.stream_stats() for name, meter in self.meters.items()}
+
+    def close(self):
+        for meter in self.meters.values():
+            meter.close()
+        self.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+class ClockSyncWriter:
+    """
+    Writes one row per streamed batch relating the host clock to the device timestamp_ms,
+    so per-device files can be aligned on a common time base.
+    """
+
+    def __init__(self, path, fleet: Fleet):
+        self._file = open(path, 'w', newline='')
+        self._writer = csv.writer(self._file)
+        self._writer.writerow(['host_time_s', 'timestamp_ms', 'samples'])
+        self._fleet = fleet
+
+    def write(self, batch):
+        if len(batch) and batch.host_time is not None:
+            self._writer.writerow([f'{self._fleet.host_time(batch.host_time):.6f}', int(batch.timestamp_ms[-1]), len(batch)])
+
+    def flush(self):
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -0,0 +1,175 @@
+#! /usr/bin/env python3
+
+from .km003c import *
+from .emulator import VirtualDevice
+from collections import deque
+import argparse
+import struct
+import sys
+import time
+import usb.core
+
+#Journal layout: MAGIC, then one FRAME_STRUCT header per raw USB frame followed by the frame bytes.
+#A read that timed out is recorded as an empty TIMEOUT frame in its place.
+MAGIC = b'KM003CJ\x01'
+FRAME_STRUCT = struct.Struct('<dBI')  # host time.monotonic(), direction, size
+OUT = 0
+IN = 1
+TIMEOUT = 2
+
+class JournalWriter:
+    """
+    Appends raw OUT/IN frames with their host monotonic timestamp to a binary journal.
+    """
+
+    def __init__(self, path):
+        self._file = open(path, 'wb')
+        self._file.write(MAGIC)
+
+    def write(self, direction, frame):
+        self._file.write(FRAME_STRUCT.pack(time.monotonic(), direction, len(frame)))
+        self._file.write(frame)
+
+    def flush(self):
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+def iter_journal(path):
+    """
+    Yields (timestamp, direction, frame) for every frame of a journal.
+    A frame cut short by a crash ends the iteration.
+    """
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f'{path} is not a KM003C journal')
+        while True:
+            header = f.read(FRAME_STRUCT.size)
+            if len(header) < FRAME_STRUCT.size:
+                return
+            timestamp, direction, size = FRAME_STRUCT.unpack(header)
+            frame = f.read(size)
+            if len(frame) < size:
+                return
+            yield timestamp, direction, frame
+
+class ReplayDevice(VirtualDevice):
+    """
+    Feeds the IN frames of a journal back to PowerZ_KM003C.
+
+    Every write() is answered with the IN frames that followed the next recorded OUT frame, and a read
+    that timed out during the capture raises USBTimeoutError again.
+    A journal started after the handshake gets the handshake answered on its behalf.
+    With speed set, frames are delivered at their recorded pace divided by speed, otherwise at full speed.
+    """
+
+    def __init__(self, path, speed=None, **kwargs):
+        super().__init__(**kwargs)
+        self.speed = speed
+        self.exchanges = []  # (out frame, [(timestamp, in frame), ...])
+        for timestamp, direction, frame in iter_journal(path):
+            if direction == OUT:
+                self.exchanges.append((frame, []))
+            elif self.exchanges:
+                self.exchanges[-1][1].append((timestamp, None if direction == TIMEOUT else frame))
+        self.position = 0
+        self._timestamps = deque()  # Recorded timestamp of every queued frame, None if synthesized
+        self._origin = None
+
+    @property
+    def exhausted(self):
+        return self.position >= len(self.exchanges)
+
+    def pending(self):
+        """
+        Returns the OUT frames not replayed yet.
+        """
+        return [out for out, _ in self.exchanges[self.position:]]
+
+    def write(self, endpoint, data, timeout=None):
+        header = MsgHeader.from_bytes(bytes(data[:4]))
+        if header.type in (CmdCtrlMsgType.CMD_CONNECT, 76):
+            if self.exhausted or MsgHeader.from_bytes(self.exchanges[self.position][0][:4]).type != header.type:
+                self._timestamps.append(None)
+                if header.type == 76:
+                    self.respond(bytes(data[:4]))
+                else:
+                    self.respond(command_frame(CmdCtrlMsgType.CMD_ACCEPT, header.id))
+                return len(data)
+        if self.exhausted:
+            raise usb.core.USBTimeoutError('Journal exhausted', errno=110)
+        _, frames = self.exchanges[self.position]
+        self.position += 1
+        for timestamp, frame in frames:
+            self._timestamps.append(timestamp)
+            self.respond(frame)
+        return len(data)
+
+    def read(self, endpoint, size_or_buffer, timeout=None):
+        if self._timestamps:
+            timestamp = self._timestamps.popleft()
+            if self.speed and timestamp is not None:
+                if self._origin is None:
+                    self._origin = (timestamp, time.monotonic())
+                delay = self._origin[1] + (timestamp - self._origin[0]) / self.speed - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+        if self._frames and self._frames[0] is None:
+            self._frames.popleft()
+            raise usb.core.USBTimeoutError('Operation timed out during capture', errno=110)
+        return super().read(endpoint, size_or_buffer, timeout)
+
+def replay(path, speed=None):
+    """
+    Re-decodes the GET_DATA responses of a journal through PowerZ_KM003C.send and parse_data.
+    Yields (timestamp, segments) with the recorded host monotonic timestamp of every response.
+    A read that timed out during the capture raises usb.core.USBTimeoutError, as it did then.
+    """
+    dev = ReplayDevice(path, speed)
+    with PowerZ_KM003C(dev) as meter:
+        while not dev.exhausted:
+            out, frames = dev.exchanges[dev.position]
+            if MsgHeader.from_bytes(out[:4]).type == CmdCtrlMsgType.CMD_DISCONNECT:
+                break
+            if not frames:
+                #Nothing was read back, e.g. the capture stopped right after this request
+                dev.position += 1
+                continue
+            hdr, data = meter.send(out)
+            if hdr.type == CmdDataMsgType.CMD_PUT_DATA:
+                yield frames[0][0], parse_data(data)
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay a KM003C raw frame journal and summarize the decoded data")
+    parser.add_argument('journal', type=str, help="Journal written by km003c_logger --journal.")
+    parser.add_argument('--speed', '-s', type=float, default=None,
+                        help="Replay at the recorded pace times speed (1 for real time), default is full speed.")
+
+    args = parser.parse_args()
+    start = time.perf_counter()
+    responses = samples = 0
+    first = last = None
+    try:
+        for timestamp, segments in replay(args.journal, args.speed):
+            responses += 1
+            first = timestamp if first is None else first
+            last = timestamp
+            for att, obj in segments:
+                if att in (AttributeDataType.ATT_ADC_QUEUE, AttributeDataType.ATT_ADC_QUEUE_10K):
+                    samples += len(obj)
+    except usb.core.USBTimeoutError:
+        print(f'Stopped at a read that timed out during the capture, after {responses} responses', file=sys.stderr)
+    elapsed = time.perf_counter() - start
+    recorded = last - first if responses else 0.0
+    print(f'{responses} responses, {samples} samples, recorded over {recorded:.1f} s, replayed in {elapsed:.2f} s'
+          + (f' ({recorded / elapsed:.0f}x real time)' if elapsed > 0 and recorded else ''))
+
+if __name__ == '__main__':
+    main()
@@ -1,10 +1,20 @@
 import usb.core, usb.util
+import threading
+import time
+from array import array
 from .defs import *
+from .ring import BatchRing
+from .scheduler import PollScheduler
+from .stats import MeasurementStats
+
+RX_BUFFER_SIZE = 10240
+VENDOR_ID = 0x5fc9
+PRODUCT_ID = 0x0063
 
 class PowerZ_KM003C:
-    def __init__(self, dev: usb.core.Device | None = None):
+    def __init__(self, dev: usb.core.Device | None = None, journal=None, metrics=None):
         if dev is None:
-            found = usb.core.find(idVendor=0x5fc9, idProduct=0x0063)
+            found = usb.core.find(idVendor=VENDOR_ID, idProduct=PRODUCT_ID)
             if not isinstance(found, usb.core.Device):
                 raise RuntimeError('Unable to locate POWER-Z KM003C meter')
             dev = found
@@ -14,17 +24,28 @@ class PowerZ_KM003C:
         usb.util.claim_interface(dev, 0)
 
         self.dev = dev
+        self.journal = journal  # JournalWriter recording every raw frame, see start_recording()
+        self.metrics = metrics  # Metrics filled in by send(), get_data() and the polling thread
         self.in_endpoint = 0x81
         self.out_endpoint = 0x01
 
+        #Preallocated receive buffers reused by every send()
+        self._rx = array('B', bytes(RX_BUFFER_SIZE))
+        self._rx_view = memoryview(self._rx)
+        self._rx_ext = array('B', bytes(RX_BUFFER_SIZE))
+        self._rx_ext_view = memoryview(self._rx_ext)
+        self._rx_joined = memoryview(bytearray(2 * RX_BUFFER_SIZE))
+
+        self._ring = None
+        self._stream_threads = []
+        self._stream_stop = threading.Event()
+        self.stream_error = None
+        self.scheduler = None
+        self.statistics = None
+
         try:
-            cmd = MsgHeader(
-                type=CmdCtrlMsgType.CMD_CONNECT,
-                extend=0,
-                id=1,
-                att=0
-            ).to_bytes()
-            response_header, response_data = self.send(cmd)
+            cmd = command_frame(CmdCtrlMsgType.CMD_CONNECT, 1)
+            response_header, response_data = self._send(cmd)
             if response_header.type == CmdCtrlMsgType.CMD_REJECT:
                 raise CommandRejected(response_header)
             if response_header.type != CmdCtrlMsgType.CMD_ACCEPT:
@@ -32,7 +53,7 @@ class PowerZ_KM003C:
 
             #Needed to make ADC_QUEUE work
             cmd = b'L\x02\x00\x02-\t\x9f\xb2\xff\xe3g\xdbGr\x84)\x9b\xc6"\xec?\xa1\xea\xf7B\xddY6(\xca\xe3\xd9\x82z\xec\x81'
-            response_header, response_data = self.send(cmd)
+            response_header, response_data = self._send(cmd)
             if response_header.type == CmdCtrlMsgType.CMD_REJECT:
                 raise CommandRejected(response_header)
             if response_header.type != 76:
@@ -45,14 +66,9 @@ class PowerZ_KM003C:
 
     #Only after stopping an acquisition can the rate be changed
     def stop(self):
-        cmd = MsgHeader(
-            type=CmdCtrlMsgType.CMD_STOP,
-            extend=0,
-            id=self.id,
-            att=0
-        ).to_bytes()
+        cmd = command_frame(CmdCtrlMsgType.CMD_STOP, self.id)
         self.id += 1
-        response_header, response_data = self.send(cmd)
+        response_header, response_data = self._send(cmd)
 
         if response_header.type == CmdCtrlMsgType.CMD_REJECT:
             raise CommandRejected(response_header)
@@ -61,47 +77,170 @@ class PowerZ_KM003C:
 
     #Setting rate also starts the acquisition
     def set_rate(self, rate: Rate):
-        cmd = MsgHeader(
-            type=CmdCtrlMsgType.CMD_SET_RATE,
-            extend=0,
-            id=self.id,
-            att=rate
-        ).to_bytes()
+        cmd = command_frame(CmdCtrlMsgType.CMD_SET_RATE, self.id, rate)
         self.id += 1
-        response_header, response_data = self.send(cmd)
+        response_header, response_data = self._send(cmd)
 
         if response_header.type == CmdCtrlMsgType.CMD_REJECT:
             raise CommandRejected(response_header)
         if response_header.type != CmdCtrlMsgType.CMD_ACCEPT:
             raise IOError(response_header)
+        if self.metrics is not None:
+            self.metrics.set_rate(rate)
 
+    #att may OR several attributes together, the response then carries one segment per attribute
     def get_data(self, att: int = AttributeDataType.ATT_ADC_QUEUE):
-        cmd = MsgHeader(
-            type=CmdCtrlMsgType.CMD_GET_DATA,
-            extend=0,
-            id=self.id,
-            att=att
-        ).to_bytes()
+        cmd = command_frame(CmdCtrlMsgType.CMD_GET_DATA, self.id, att)
         self.id += 1
 
-        hdr, data = self.send(cmd)
+        hdr, data = self._send(cmd)
         if hdr.type == CmdDataMsgType.CMD_PUT_DATA:
-            return parse_data(data)
+            metrics = self.metrics
+            if metrics is None:
+                return parse_data(data)
+            start = time.perf_counter()
+            segments = parse_data(data)
+            metrics.parse.observe(time.perf_counter() - start)
+            for seg_att, obj in segments:
+                if isinstance(obj, AdcQueueBatch):
+                    metrics.observe_batch(obj)
+            return segments
 
         return []
 
+    def poll(self, att: int = AttributeDataType.ATT_ADC | AttributeDataType.ATT_ADC_QUEUE):
+        """
+        Requests the OR-combined attributes in a single round trip and returns a DataResponse.
+        """
+        return DataResponse(self.get_data(att))
+
+    def start_stream(self, rate: Rate, capacity: int = 1024, interval: float | None = None, callback=None,
+                     att: int | None = None, extra_att: int = 0, on_response=None, statistics: bool = False):
+        """
+        Starts the acquisition and a polling thread that pushes every decoded ADC queue batch
+        into a bounded ring of capacity batches. att is ATT_ADC_QUEUE or ATT_ADC_QUEUE_10K, by default
+        the one of rate. Other attributes are polled in the same request with extra_att and seen by on_response.
+        Without a fixed interval, a PollScheduler adapts the poll period to the chunk fill level. Batches are read with iter_stream(), or passed to
+        callback on a separate dispatch thread so a slow consumer never delays polling.
+        """
+        if self._stream_threads:
+            raise RuntimeError('Stream already running')
+        if att is None:
+            att = queue_attribute(rate)
+        if att not in (AttributeDataType.ATT_ADC_QUEUE, AttributeDataType.ATT_ADC_QUEUE_10K):
+            raise ValueError(f'att must be ATT_ADC_QUEUE or ATT_ADC_QUEUE_10K, got {att}; '
+                             'poll other attributes with extra_att and read them in on_response')
+        self.scheduler = PollScheduler(rate) if interval is None else None
+        self.statistics = MeasurementStats() if statistics else None
+        self.set_rate(rate)
+        self._ring = BatchRing(capacity)
+        self._stream_stop.clear()
+        self.stream_error = None
+        threads = [threading.Thread(target=self._stream_poll, args=(att, extra_att, interval, on_response),
+                                    name='km003c-poll', daemon=True)]
+        if callback is not None:
+            threads.append(threading.Thread(target=self._stream_dispatch, args=(callback,),
+                                            name='km003c-dispatch', daemon=True))
+        self._stream_threads = threads
+        for thread in threads:
+            thread.start()
+
+    def _stream_poll(self, att, extra_att, interval, on_response):
+        ring = self._ring
+        scheduler = self.scheduler
+        statistics = self.statistics
+        try:
+            while not self._stream_stop.is_set():
+                polled = time.monotonic()
+                entries = 0
+                segments = self.get_data(att | extra_att)
+                for seg_att, obj in segments:
+                    if seg_att == att:
+                        entries += len(obj)
+                        obj.host_time = polled
+                        ring.push(obj)
+                        if self.metrics is not None:
+                            self.metrics.observe_backlog(len(ring))
+                        if statistics is not None:
+                            statistics.update(obj)
+                if on_response is not None:
+                    response = DataResponse(segments)
+                    response.host_time = polled
+                    on_response(response)
+                if scheduler is not None:
+                    interval = scheduler.update(entries)
+                self._stream_stop.wait(interval - (time.monotonic() - polled))
+        except Exception as e:
+            self.stream_error = e
+        finally:
+            ring.close()
+
+    def _stream_dispatch(self, callback):
+        for batch in self._ring:
+            callback(batch)
+
+    def iter_stream(self):
+        """
+        Yields the streamed batches until stop_stream() is called or polling fails.
+        An error raised by the polling thread is re-raised once the ring is drained.
+        """
+        if self._ring is None:
+            raise RuntimeError('Stream not running')
+        if len(self._stream_threads) > 1:
+            raise RuntimeError('Stream is consumed by a callback')
+        yield from self._ring
+        if self.stream_error is not None:
+            raise self.stream_error
+
+    def stream_stats(self):
+        """
+        Returns the ring fill level, overrun counters and poll scheduler statistics of the current or last stream.
+        """
+        stats = self._ring.stats() if self._ring is not None else {}
+        if self.scheduler is not None:
+            stats.update(self.scheduler.stats())
+        return stats
+
+    def stop_stream(self):
+        """
+        Stops the polling and dispatch threads and the acquisition.
+        """
+        if not self._stream_threads:
+            return
+        self._stream_stop.set()
+        for thread in self._stream_threads:
+            if thread is not threading.current_thread():
+                thread.join()
+        self._stream_threads = []
+        if self.stream_error is None:
+            self.stop()
+
+    def start_recording(self, path):
+        """
+        Appends every raw OUT/IN frame from now on to the journal at path.
+        Pass a journal to the constructor to include the handshake.
+        """
+        from .journal import JournalWriter
+        self.stop_recording()
+        self.journal = JournalWriter(path)
+
+    def stop_recording(self):
+        if self.journal is not None:
+            self.journal.close()
+            self.journal = None
+
     def close(self):
         try:
-            cmd = MsgHeader(
-                type=CmdCtrlMsgType.CMD_DISCONNECT,
-                extend=0,
-                id=1,
-                att=0
-            ).to_bytes()
-            self.send(cmd)
+            self.stop_stream()
+        except:
+            pass
+        try:
+            cmd = command_frame(CmdCtrlMsgType.CMD_DISCONNECT, 1)
+            self._send(cmd)
         except:
             pass
         usb.util.dispose_resources(self.dev)
+        self.stop_recording()
 
     def __enter__(self):
         return self
@@ -130,13 +269,57 @@ class PowerZ_KM003C:
         return (hdr, data[4:])
 
     def send(self, msg: bytes):
+        """
+        Sends msg and returns (header, payload) of the response, the payload as bytes.
+        """
+        hdr, data = self._send(msg)
+        return (hdr, bytes(data))
+
+    def _send(self, msg: bytes):
+        """
+        Like send(), but without a copy: the payload is a memoryview into a receive buffer
+        that is reused by the next call, so it must be decoded before then.
+        """
+        metrics = self.metrics
+        if metrics is not None:
+            start = time.perf_counter()
         if self.dev.write(self.out_endpoint, msg) != len(msg):
             raise IOError(f'sent bytes != {len(msg)}')
-        data = self.dev.read(self.in_endpoint, 10240)
-        data = bytes(data)
+        if metrics is not None:
+            metrics.usb_write.observe(time.perf_counter() - start)
+            metrics.bytes_out += len(msg)
+        journal = self.journal
+        if journal is not None:
+            journal.write(0, msg)  # OUT
+        if metrics is not None:
+            start = time.perf_counter()
+        try:
+            size = self.dev.read(self.in_endpoint, self._rx)
+        except usb.core.USBTimeoutError:
+            if journal is not None:
+                journal.write(2, b'')  # TIMEOUT
+            raise
+        data = self._rx_view[:size]
+        if journal is not None:
+            journal.write(1, data)  # IN
         hdr = MsgHeader.from_bytes(data[:4])
         if hdr.extend:
-            ext_data = self.dev.read(self.in_endpoint, 10240)
-            ext_data = bytes(ext_data)
-            return (hdr, data[4:] + ext_data)
-        return (hdr, data[4:])
\ No newline at end of file
+            try:
+                ext_size = self.dev.read(self.in_endpoint, self._rx_ext)
+            except usb.core.USBTimeoutError:
+                if journal is not None:
+                    journal.write(2, b'')  # TIMEOUT
+                raise
+            if metrics is not None:
+                metrics.usb_read.observe(time.perf_counter() - start)
+                metrics.bytes_in += size + ext_size
+            if journal is not None:
+                journal.write(1, self._rx_ext_view[:ext_size])  # IN
+            joined = self._rx_joined
+            joined[:size] = data
+            joined[size:size+ext_size] = self._rx_ext_view[:ext_size]
+            return (hdr, joined[4:size+ext_size])
+        if metrics is not None:
+            metrics.usb_read.observe(time.perf_counter() - start)
+            metrics.bytes_in += size
+        return (hdr, data[4:])
@@ -1,50 +1,302 @@
 #! /usr/bin/env python3
 
 from .km003c import *
+from .export import TextExportWriter
+from .recording import RecordingWriter
+from .archive import ArchiveWriter, COMPRESSIONS
+from .fleet import Fleet, ClockSyncWriter
+from .journal import JournalWriter
+from .pyramid import Pyramid
+from .metrics import Metrics
+from .shm import SharedRing
+from .trigger import TriggerEngine, Threshold, Slope, Change
+from .spectrum import RippleAnalyzer, format_result
+from .pd import PdCapture
+import os
+import queue
 import traceback
 import argparse
 import time
+import sys
 import csv
 
-def log_data(power_meter: PowerZ_KM003C, output_file, rate):
-    power_meter.set_rate(rate)
-
-    with open(output_file, 'w', newline='') as csvfile:
-        fieldnames = ['timestamp_ms', 'vbus_µV', 'ibus_µA', 'vcc1_mV', 'vcc2_mV', 'vdp_mV', 'vdm_mV']
-        writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
-        writer.writeheader()
-
-        while True:
-
-            data_objs = power_meter.get_data()
-            if len(data_objs):
-                for entry in data_objs[0][1]:
-                    writer.writerow({
-                        'timestamp_ms': entry.timestamp_ms,
-                        'vbus_µV': entry.vbus,
-                        'ibus_µA': entry.ibus,
-                        'vcc1_mV': entry.vcc1/10,
-                        'vcc2_mV': entry.vcc2/10,
-                        'vdp_mV': entry.vdp,
-                        'vdm_mV': entry.vdm
-                    })
-
-            csvfile.flush()
-            #Small enough for 10ksps
-            time.sleep(0.01)
+class SegmentLog:
+    """
+    Collects the segments of att from every poll on the polling thread and writes them
+    as CSV rows with their payload in hex on the logging thread.
+    """
+
+    def __init__(self, path, att):
+        self.att = att
+        self._queue = queue.SimpleQueue()
+        self._start = time.monotonic()
+        self._file = open(path, 'w', newline='')
+        self._writer = csv.writer(self._file)
+        self._writer.writerow(['host_time_s', 'attribute', 'payload_hex'])
+
+    def on_response(self, response):
+        for att, obj in response.segments.items():
+            if att & self.att:
+                self._queue.put((response.host_time, att, obj[1] if isinstance(obj, tuple) else obj))
+
+    def write_pending(self):
+        while not self._queue.empty():
+            host_time, att, payload = self._queue.get_nowait()
+            self._writer.writerow([f'{host_time - self._start:.6f}', AttributeDataType(att).name, bytes(payload).hex()])
+        self._file.flush()
+
+    def close(self):
+        self.write_pending()
+        self._file.close()
+
+def report_rate(samples, elapsed, rate, stats=None):
+    achieved = samples / elapsed if elapsed > 0 else 0.0
+    nominal = RATE_SPS[rate]
+    polling = ''
+    if stats and 'poll_rate' in stats:
+        polling = (f", {stats['poll_rate']:.1f} polls/s, {stats['requests_per_sample']:.3f} requests/sample, "
+                   f"interval {1000 * stats['interval']:.1f} ms")
+    print(f'{samples} samples in {elapsed:.1f} s: {achieved:.1f} SPS of {nominal} SPS nominal '
+          f'({100 * achieved / nominal:.1f}%){polling}', file=sys.stderr)
+
+def report_metrics(power_meter: PowerZ_KM003C, prefix='', metrics_file=None, name=''):
+    metrics = power_meter.metrics
+    if metrics is None:
+        return
+    if metrics_file:
+        metrics.write_prometheus(metrics_file, {'device': name} if name else None)
+    else:
+        print(f'{prefix}{metrics}', file=sys.stderr)
+
+def report_ripple(sinks, prefix=''):
+    for sink in sinks:
+        if isinstance(sink, RippleAnalyzer) and sink.latest is not None:
+            print(f'{prefix}{format_result(sink.latest)}', file=sys.stderr)
+
+def open_writer(output_file, rate, format='csv', trigger=None, flush_interval=1.0, compression='zlib', block_age=60.0):
+    if format == 'bin':
+        writer = RecordingWriter(output_file, rate)
+    elif format == 'archive':
+        writer = ArchiveWriter(output_file, rate, compression, max_block_age_s=block_age)
+    else:
+        writer = TextExportWriter(output_file, format, flush_interval)
+    if trigger is None:
+        return writer
+    #Conditions keep per stream state, so every writer gets its own
+    conditions = [condition(*args) for condition, args in trigger['conditions']]
+    return TriggerEngine(writer, rate, conditions, trigger['pre_s'], trigger['post_s'], trigger['holdoff_s'],
+                         output_file + '.triggers.csv')
+
+def trigger_spec(args):
+    """
+    Returns the trigger settings of the command line arguments, None without any trigger condition.
+    """
+    conditions = []
+    if args.trigger_ibus_above is not None:
+        conditions.append((Threshold, ('ibus', int(args.trigger_ibus_above * 1e6), True)))
+    if args.trigger_ibus_below is not None:
+        conditions.append((Threshold, ('ibus', int(args.trigger_ibus_below * 1e6), False)))
+    if args.trigger_vbus_slope is not None:
+        conditions.append((Slope, ('vbus', args.trigger_vbus_slope * 1e6)))
+    if args.trigger_data_lines is not None:
+        conditions += [(Change, ('vdp', args.trigger_data_lines)), (Change, ('vdm', args.trigger_data_lines))]
+    if not conditions:
+        return None
+    return {'conditions': conditions, 'pre_s': args.pre, 'post_s': args.post, 'holdoff_s': args.holdoff}
+
+def write_stream(power_meter: PowerZ_KM003C, writer, rate, report_interval=10.0, sinks=(), name='', segment_logs=(),
+                 metrics_file=None):
+    start = last_report = time.monotonic()
+    samples = 0
+    prefix = f'{name}: ' if name else ''
+    try:
+        for batch in power_meter.iter_stream():
+            #Writers flush on their own by chunk or flush interval, and at every report
+            writer.write(batch)
+            for sink in sinks:
+                sink.write(batch)
+            for segment_log in segment_logs:
+                segment_log.write_pending()
+
+            samples += len(batch)
+            now = time.monotonic()
+            if report_interval and now - last_report >= report_interval:
+                print(prefix, end='', file=sys.stderr)
+                report_rate(samples, now - start, rate, power_meter.stream_stats())
+                if power_meter.statistics is not None:
+                    print(f'{prefix}{power_meter.statistics}', file=sys.stderr)
+                report_metrics(power_meter, prefix, metrics_file, name)
+                report_ripple(sinks, prefix)
+                writer.flush()
+                for sink in sinks:
+                    sink.flush()
+                last_report = now
+    finally:
+        stats = power_meter.stream_stats()
+        print(prefix, end='', file=sys.stderr)
+        report_rate(samples, time.monotonic() - start, rate, stats)
+        if power_meter.statistics is not None:
+            print(f'{prefix}{power_meter.statistics}', file=sys.stderr)
+        report_metrics(power_meter, prefix, metrics_file, name)
+        if isinstance(writer, TriggerEngine):
+            print(f'{prefix}{writer.windows} trigger windows with {writer.triggers} triggers, '
+                  f'{writer.samples_written} of {samples} samples written', file=sys.stderr)
+        if stats.get('overruns'):
+            print(f"{prefix}Ring buffer overruns: {stats['overruns']} batches, {stats['dropped_samples']} samples "
+                  f"(capacity {stats['capacity']}, high water {stats['high_water']})", file=sys.stderr)
+
+def log_data(power_meter: PowerZ_KM003C, output_file, rate, report_interval=10.0, format='csv', pd_output=None,
+             statistics=False, pyramid=None, metrics_file=None, shm=None, trigger=None, flush_interval=1.0,
+             ripple=None, ripple_window=1024, pd_log=None, compression='zlib', block_age=60.0):
+    #PD packets are requested in the same round trip as the ADC queue
+    segment_logs = []
+    if pd_output:
+        segment_logs.append(SegmentLog(pd_output, AttributeDataType.ATT_PD_PACKET))
+    if pd_log:
+        segment_logs.append(PdCapture(pd_log))
+    #USB polling runs on its own thread, so slow disk writes here do not lose samples
+    if segment_logs:
+        def on_response(response):
+            for segment_log in segment_logs:
+                segment_log.on_response(response)
+        extra_att = 0
+        for segment_log in segment_logs:
+            extra_att |= segment_log.att
+        power_meter.start_stream(rate, extra_att=extra_att, on_response=on_response, statistics=statistics)
+    else:
+        power_meter.start_stream(rate, statistics=statistics)
+    sinks = [Pyramid(pyramid)] if pyramid else []
+    if ripple:
+        #Above mains frequencies, but below Nyquist at the low rates too
+        sinks.append(RippleAnalyzer(rate, ripple_window, min_hz=min(10.0, RATE_SPS[rate] / 4), path=ripple))
+    if shm:
+        sinks.append(SharedRing(rate=rate, name=shm))
+        print(f'Publishing samples to shared memory ring {shm}', file=sys.stderr)
+    try:
+        with open_writer(output_file, rate, format, trigger, flush_interval, compression, block_age) as writer:
+            write_stream(power_meter, writer, rate, report_interval, sinks, segment_logs=segment_logs,
+                         metrics_file=metrics_file)
+    finally:
+        power_meter.stop_stream()
+        for segment_log in segment_logs:
+            segment_log.close()
+        for sink in sinks:
+            sink.close()
+
+def device_output(output_file, name):
+    if '{device}' in output_file:
+        return output_file.replace('{device}', name)
+    root, ext = os.path.splitext(output_file)
+    return f'{root}_{name}{ext}'
+
+def log_all(fleet: Fleet, output_file, rate, report_interval=10.0, format='csv', statistics=False,
+            metrics_file=None, trigger=None, flush_interval=1.0, compression='zlib', block_age=60.0):
+    """
+    Logs every meter of the fleet to its own file, next to a .sync.csv file that
+    relates its device timestamps to the common host clock.
+    """
+    def worker(name, power_meter):
+        path = device_output(output_file, name)
+        with open_writer(path, rate, format, trigger, flush_interval, compression, block_age) as writer, ClockSyncWriter(path + '.sync.csv', fleet) as sync:
+            write_stream(power_meter, writer, rate, report_interval, [sync], name,
+                         metrics_file=device_output(metrics_file, name) if metrics_file else None)
+
+    print(f"Logging {len(fleet.meters)} meters: {', '.join(fleet.meters)}", file=sys.stderr)
+    fleet.start_stream(rate, statistics=statistics)
+    try:
+        fleet.run(worker)
+        fleet.join()
+    finally:
+        fleet.stop_stream()
 
 def main():
     parser = argparse.ArgumentParser(description="KM003C Data Logger")
     parser.add_argument('output', type=str,
-                        help="Path to a CSV file to save the output. This parameter is mandatory.")
-    parser.add_argument('--rate', '-r', type=int, choices=[0, 1, 2, 3], default=0,
-                        help="Data logging rate: 0 for 2SPS, 1 for 10SPS, 2 for 50SPS, 3 for 1KSPS (default: 0).")
+                        help="Path to a CSV or binary file to save the output. With --all, '{device}' is replaced by "
+                             "the bus-port name of every meter, which is otherwise appended to the file name. This parameter is mandatory.")
+    parser.add_argument('--rate', '-r', type=int, choices=[0, 1, 2, 3, 4], default=0,
+                        help="Data logging rate: 0 for 2SPS, 1 for 10SPS, 2 for 50SPS, 3 for 1KSPS, 4 for 10KSPS (default: 0).")
+    parser.add_argument('--format', '-f', choices=['csv', 'jsonl', 'bin', 'archive'], default='csv',
+                        help="Output format: csv, jsonl for one JSON object per sample, bin for an indexed binary recording readable with KM003C.recording and convertible with km003c_convert, "
+                             "or archive for delta encoded, compressed blocks for long term storage, readable with KM003C.archive and extractable with km003c_archive (default: csv).")
+    parser.add_argument('--compression', choices=COMPRESSIONS, default='zlib',
+                        help="Block compression of the archive format: zlib, or lzma for smaller and slower (default: zlib).")
+    parser.add_argument('--block-age', type=float, default=60.0,
+                        help="Seconds after which the archive format writes the samples received so far as a shorter block, "
+                             "bounding what a crash loses. Shorter blocks compress worse, most of all at low rates (default: 60).")
+    parser.add_argument('--all', '-a', action='store_true',
+                        help="Log every connected KM003C, each on its own worker thread. "
+                             "Not available with --pd, --pd-log, --pyramid, --ripple, --shm or --journal.")
+    parser.add_argument('--pd', type=str, default=None,
+                        help="Also poll PD packets in the same request as the samples and write them to this CSV file.")
+    parser.add_argument('--pd-log', type=str, default=None,
+                        help="Also poll PD packets in the same request as the samples, decode them and append the messages "
+                             "to this indexed PD log, to be queried with km003c_pd.")
+    parser.add_argument('--stats', action='store_true',
+                        help="Keep running energy, charge and vbus/ibus min/max/mean/RMS and print them with every report.")
+    parser.add_argument('--pyramid', type=str, default=None,
+                        help="Also build a min/max pyramid with this path prefix for fast range queries with KM003C.pyramid.")
+    parser.add_argument('--ripple', type=str, default=None,
+                        help="Also analyze vbus/ibus ripple and their strongest spectral line above 10 Hz (a quarter of the rate at 2 and 10 SPS) over overlapping windows, "
+                             "writing one CSV row per window to this file and printing the latest with every report. Requires numpy.")
+    parser.add_argument('--ripple-window', type=int, default=1024,
+                        help="Samples per ripple analysis window, consecutive windows overlap by half (default: 1024).")
+    parser.add_argument('--shm', type=str, default=None,
+                        help="Also publish the samples to a shared memory ring of this name, readable with KM003C.shm.SharedRingReader.")
+    parser.add_argument('--metrics', action='store_true',
+                        help="Time USB transfers and parsing, count gaps and writer backlog, and print them with every report.")
+    parser.add_argument('--metrics-file', type=str, default=None,
+                        help="Instead of printing the metrics, rewrite this Prometheus text file with every report (implies --metrics).")
+    parser.add_argument('--journal', '-j', type=str, default=None,
+                        help="Also record every raw USB frame to this journal, replayable with km003c_replay.")
+    parser.add_argument('--trigger-ibus-above', type=float, default=None, metavar='AMPS',
+                        help="Only write the samples around ibus rising through this current.")
+    parser.add_argument('--trigger-ibus-below', type=float, default=None, metavar='AMPS',
+                        help="Only write the samples around ibus falling through this current.")
+    parser.add_argument('--trigger-vbus-slope', type=float, default=None, metavar='V_PER_MS',
+                        help="Only write the samples around vbus changing by at least this many V per ms.")
+    parser.add_argument('--trigger-data-lines', type=int, default=None, metavar='MV',
+                        help="Only write the samples around vdp or vdm changing by at least this many mV.")
+    parser.add_argument('--pre', type=float, default=1.0,
+                        help="Seconds of samples written before a trigger (default: 1).")
+    parser.add_argument('--post', type=float, default=2.0,
+                        help="Seconds of samples written after the last trigger of a window (default: 2).")
+    parser.add_argument('--holdoff', type=float, default=0.0,
+                        help="Seconds after a trigger window during which triggers are ignored (default: 0).")
+    parser.add_argument('--flush-interval', type=float, default=1.0,
+                        help="Seconds between writes of csv and jsonl output, which is formatted and written in blocks on a background thread (default: 1).")
+    parser.add_argument('--report-interval', type=float, default=10.0,
+                        help="Seconds between achieved sample rate reports on stderr, 0 to only report at exit (default: 10).")
 
     args = parser.parse_args()
+    metrics = args.metrics or args.metrics_file is not None
+    if args.all:
+        #These write to a single file or shared memory ring, so they only work with one meter
+        single = [option for option, value in (('--pd', args.pd), ('--pd-log', args.pd_log), ('--pyramid', args.pyramid),
+                                               ('--ripple', args.ripple), ('--shm', args.shm), ('--journal', args.journal))
+                  if value is not None]
+        if single:
+            parser.error(f"{', '.join(single)} cannot be combined with --all")
 
     try:
-        with PowerZ_KM003C() as power_meter:
-            log_data(power_meter, output_file=args.output, rate=args.rate)
+        if args.all:
+            with Fleet() as fleet:
+                if metrics:
+                    for power_meter in fleet.meters.values():
+                        power_meter.metrics = Metrics()
+                log_all(fleet, output_file=args.output, rate=Rate(args.rate), report_interval=args.report_interval,
+                        format=args.format, statistics=args.stats, metrics_file=args.metrics_file,
+                        trigger=trigger_spec(args), flush_interval=args.flush_interval,
+                        compression=args.compression, block_age=args.block_age)
+        else:
+            journal = JournalWriter(args.journal) if args.journal else None
+            with PowerZ_KM003C(journal=journal, metrics=Metrics() if metrics else None) as power_meter:
+                log_data(power_meter, output_file=args.output, rate=Rate(args.rate), report_interval=args.report_interval,
+                         format=args.format, pd_output=args.pd, statistics=args.stats,
+                         pyramid=args.pyramid, metrics_file=args.metrics_file, shm=args.shm,
+                         ripple=args.ripple, ripple_window=args.ripple_window, pd_log=args.pd_log,
+                         trigger=trigger_spec(args), flush_interval=args.flush_interval,
+                         compression=args.compression, block_age=args.block_age)
     except KeyboardInterrupt: pass
     except Exception:
         traceback.print_exc()
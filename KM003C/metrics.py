@@ -0,0 +1,209 @@
+import bisect
+import os
+import time
+from .defs import *
+
+#Upper bucket bounds in seconds for USB and parse latencies, the last bucket is unbounded
+LATENCY_BOUNDS = (25e-6, 50e-6, 100e-6, 250e-6, 500e-6, 1e-3, 2.5e-3, 5e-3, 10e-3, 25e-3, 50e-3, 100e-3, 250e-3)
+#Upper bucket bounds in entries for the device queue fill of every ADC queue response
+CHUNK_BOUNDS = (0, 1, 2, 4, 8, 16, 32, 48, QUEUE_CHUNK_MAX - 1, QUEUE_CHUNK_MAX)
+
+class Histogram:
+    """
+    Fixed bucket histogram with Prometheus style upper bounds, O(log buckets) per observation.
+    """
+
+    def __init__(self, bounds):
+        self.bounds = tuple(bounds)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q):
+        """
+        Returns the upper bound of the bucket holding quantile q, None when empty or past the last bound.
+        """
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.bounds, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return None
+
+    def snapshot(self):
+        return {
+            'count': self.count,
+            'mean': self.sum / self.count if self.count else None,
+            'p50': self.quantile(0.5),
+            'p90': self.quantile(0.9),
+            'p99': self.quantile(0.99),
+            'buckets': list(zip(self.bounds + (float('inf'),), self.counts)),
+        }
+
+class Metrics:
+    """
+    Counters and histograms filled in by PowerZ_KM003C while a Metrics instance is assigned to its
+    metrics attribute. Without one, the hot path only pays for an attribute check.
+
+    Updates come from the polling thread and snapshots may be taken from any other thread, which
+    can see a counter one update behind but never blocks the polling.
+    """
+
+    def __init__(self):
+        self.usb_write = Histogram(LATENCY_BOUNDS)   # Seconds per dev.write()
+        self.usb_read = Histogram(LATENCY_BOUNDS)    # Seconds per response, extended frame included
+        self.parse = Histogram(LATENCY_BOUNDS)       # Seconds per parse_data() call
+        self.queue_fill = Histogram(CHUNK_BOUNDS)    # ADC queue entries per response
+        self.bytes_out = 0
+        self.bytes_in = 0
+        self.samples = 0
+        self.gaps = 0                # Timestamp steps longer than expected at the current rate
+        self.missing_samples = 0     # Samples estimated lost in those gaps
+        self.backlog = 0             # Batches waiting for the writer at the last push
+        self.backlog_max = 0
+        self._period_ms = 1000 / RATE_SPS[Rate._2SPS]
+        self._last_timestamp = None
+        self._start = self._window_time = time.monotonic()
+        self._window_bytes = self._window_samples = 0
+
+    def set_rate(self, rate: Rate):
+        """
+        Sets the sample period that timestamp gaps are measured against.
+        """
+        self._period_ms = 1000 / RATE_SPS[rate]
+        self._last_timestamp = None
+
+    def observe_batch(self, batch):
+        """
+        Counts the samples of an ADC queue batch and the timestamp gaps since the previous one.
+        """
+        n = len(batch)
+        self.samples += n
+        self.queue_fill.observe(n)
+        if not n:
+            return
+        timestamps = batch.timestamp_ms
+        #Timestamps have 1 ms resolution, so at 10KSPS only steps of more than 1 ms are gaps
+        threshold = max(1.5 * self._period_ms, 1.0)
+        if np is not None:
+            ts = np.asarray(timestamps, dtype=np.uint32)
+            steps = np.diff(ts)  # uint32 subtraction wraps across the rollover
+            long_steps = steps[steps > threshold]
+            self.gaps += len(long_steps)
+            self.missing_samples += int(np.rint(long_steps / self._period_ms).sum()) - len(long_steps)
+            first, last = int(ts[0]), int(ts[-1])
+        else:
+            previous = timestamps[0]
+            for t in timestamps[1:]:
+                self._gap((t - previous) & 0xFFFFFFFF, threshold)
+                previous = t
+            first, last = timestamps[0], timestamps[-1]
+        if self._last_timestamp is not None:
+            self._gap((first - self._last_timestamp) & 0xFFFFFFFF, threshold)
+        self._last_timestamp = last
+
+    def _gap(self, step, threshold):
+        if step > threshold:
+            self.gaps += 1
+            self.missing_samples += round(step / self._period_ms) - 1
+
+    def observe_backlog(self, fill):
+        self.backlog = fill
+        if fill > self.backlog_max:
+            self.backlog_max = fill
+
+    def snapshot(self):
+        """
+        Returns every counter and histogram as a dict. bytes_per_s and samples_per_s cover the
+        time since the previous snapshot, or since the start for the first one.
+        """
+        now = time.monotonic()
+        elapsed = now - self._window_time
+        bytes_total = self.bytes_out + self.bytes_in
+        result = {
+            'uptime_s': now - self._start,
+            'bytes_out': self.bytes_out,
+            'bytes_in': self.bytes_in,
+            'samples': self.samples,
+            'bytes_per_s': (bytes_total - self._window_bytes) / elapsed if elapsed > 0 else 0.0,
+            'samples_per_s': (self.samples - self._window_samples) / elapsed if elapsed > 0 else 0.0,
+            'gaps': self.gaps,
+            'missing_samples': self.missing_samples,
+            'backlog': self.backlog,
+            'backlog_max': self.backlog_max,
+            'usb_write_s': self.usb_write.snapshot(),
+            'usb_read_s': self.usb_read.snapshot(),
+            'parse_s': self.parse.snapshot(),
+            'queue_fill': self.queue_fill.snapshot(),
+        }
+        self._window_time, self._window_bytes, self._window_samples = now, bytes_total, self.samples
+        return result
+
+    def __str__(self):
+        """
+        Returns a one line summary, taking a snapshot.
+        """
+        s = self.snapshot()
+        def ms(histogram, key):
+            value = histogram[key]
+            return f'{1000 * value:.2g}' if value is not None else '-'
+        return (
+            f"{s['samples_per_s']:.0f} SPS, {s['bytes_per_s'] / 1000:.1f} kB/s, "
+            f"write p50/p99 {ms(s['usb_write_s'], 'p50')}/{ms(s['usb_write_s'], 'p99')} ms, "
+            f"read p50/p99 {ms(s['usb_read_s'], 'p50')}/{ms(s['usb_read_s'], 'p99')} ms, "
+            f"parse p50/p99 {ms(s['parse_s'], 'p50')}/{ms(s['parse_s'], 'p99')} ms, "
+            f"queue fill p50 {s['queue_fill']['p50']}, "
+            f"gaps {s['gaps']} ({s['missing_samples']} samples), backlog {s['backlog']}/{s['backlog_max']}"
+        )
+
+    def prometheus(self, labels=None):
+        """
+        Returns the metrics in the Prometheus text exposition format.
+        """
+        label = ','.join(f'{key}="{value}"' for key, value in (labels or {}).items())
+        def name(metric, extra=''):
+            inner = ','.join(part for part in (label, extra) if part)
+            return f'{metric}{{{inner}}}' if inner else metric
+
+        lines = []
+        for metric, kind, help, value in (
+            ('km003c_usb_bytes_out_total', 'counter', 'Bytes written to the meter.', self.bytes_out),
+            ('km003c_usb_bytes_in_total', 'counter', 'Bytes read from the meter.', self.bytes_in),
+            ('km003c_samples_total', 'counter', 'ADC queue samples received.', self.samples),
+            ('km003c_timestamp_gaps_total', 'counter', 'Timestamp steps longer than the sample period.', self.gaps),
+            ('km003c_missing_samples_total', 'counter', 'Samples estimated lost in timestamp gaps.', self.missing_samples),
+            ('km003c_writer_backlog', 'gauge', 'Batches waiting for the writer.', self.backlog),
+            ('km003c_writer_backlog_max', 'gauge', 'Highest writer backlog seen.', self.backlog_max),
+        ):
+            lines += [f'# HELP {metric} {help}', f'# TYPE {metric} {kind}', f'{name(metric)} {value}']
+        for metric, help, histogram in (
+            ('km003c_usb_write_seconds', 'USB write latency.', self.usb_write),
+            ('km003c_usb_read_seconds', 'USB read latency of a response.', self.usb_read),
+            ('km003c_parse_seconds', 'parse_data time per response.', self.parse),
+            ('km003c_queue_fill_entries', 'ADC queue entries per response.', self.queue_fill),
+        ):
+            lines += [f'# HELP {metric} {help}', f'# TYPE {metric} histogram']
+            cumulative = 0
+            for bound, count in zip(histogram.bounds + ('+Inf',), histogram.counts):
+                cumulative += count
+                le = 'le="%s"' % bound
+                lines.append(f'{name(metric + "_bucket", le)} {cumulative}')
+            lines += [f'{name(metric + "_sum")} {histogram.sum}', f'{name(metric + "_count")} {histogram.count}']
+        return '\n'.join(lines) + '\n'
+
+    def write_prometheus(self, path, labels=None):
+        """
+        Atomically replaces path with the Prometheus text, for the node_exporter textfile collector.
+        """
+        temporary = f'{path}.tmp'
+        with open(temporary, 'w') as f:
+            f.write(self.prometheus(labels))
+        os.replace(temporary, path)
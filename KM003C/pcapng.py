@@ -0,0 +1,149 @@
+import struct
+
+#Streaming reader for USB captures in pcapng or classic pcap files, without tshark.
+#Supported link types are Linux usbmon (with or without the mmapped header) and Windows USBPcap.
+
+LINKTYPE_USB_LINUX = 189
+LINKTYPE_USB_LINUX_MMAPPED = 220
+LINKTYPE_USBPCAP = 249
+
+BLOCK_SHB = 0x0A0D0D0A
+BLOCK_IDB = 0x00000001
+BLOCK_SPB = 0x00000003
+BLOCK_EPB = 0x00000006
+BYTE_ORDER_MAGIC = 0x1A2B3C4D
+OPTION_IF_TSRESOL = 9
+
+PCAP_MAGIC = {
+    b'\xd4\xc3\xb2\xa1': ('<', 1e-6),
+    b'\xa1\xb2\xc3\xd4': ('>', 1e-6),
+    b'\x4d\x3c\xb2\xa1': ('<', 1e-9),
+    b'\xa1\xb2\x3c\x4d': ('>', 1e-9),
+}
+
+#usbmon packet header: id, urb type, transfer type, endpoint, device, bus, setup flag, data flag,
+#seconds, microseconds, status, urb length, data length, setup
+USBMON_STRUCT = struct.Struct('<QBBBBHBBqiiII8s')
+USBMON_HEADER_SIZE = {LINKTYPE_USB_LINUX: 48, LINKTYPE_USB_LINUX_MMAPPED: 64}
+URB_SUBMIT = ord('S')
+URB_COMPLETE = ord('C')
+
+#USBPcap packet header: header length, irp id, status, function, info, bus, device, endpoint, transfer, data length
+USBPCAP_STRUCT = struct.Struct('<HQIHBHHBBI')
+USBPCAP_INFO_PDO_TO_FDO = 0x01  # Set on completions travelling back to the host
+
+TRANSFER_BULK = 3
+DIRECTION_IN = 0x80
+
+def _ts_resolution(options, endian):
+    offset = 0
+    while offset + 4 <= len(options):
+        code, length = struct.unpack_from(endian + 'HH', options, offset)
+        if code == 0:
+            break
+        if code == OPTION_IF_TSRESOL and length >= 1:
+            value = options[offset + 4]
+            return 2.0 ** -(value & 0x7F) if value & 0x80 else 10.0 ** -value
+        offset += 4 + ((length + 3) & ~3)
+    return 1e-6
+
+def iter_packets(f):
+    """
+    Yields (timestamp, linktype, packet) for every packet of a pcapng or pcap file object.
+    """
+    magic = f.read(4)
+    if magic in PCAP_MAGIC:
+        endian, resolution = PCAP_MAGIC[magic]
+        header = f.read(20)
+        linktype = struct.unpack(endian + 'HHiIII', header)[5] & 0x0FFFFFFF
+        record = struct.Struct(endian + 'IIII')
+        while True:
+            head = f.read(record.size)
+            if len(head) < record.size:
+                return
+            seconds, fraction, captured, _ = record.unpack(head)
+            packet = f.read(captured)
+            if len(packet) < captured:
+                return
+            yield seconds + fraction * resolution, linktype, packet
+
+    if len(magic) < 4 or struct.unpack('<I', magic)[0] != BLOCK_SHB:
+        raise ValueError('Not a pcapng or pcap file')
+    endian = '<'
+    interfaces = []  # (linktype, timestamp resolution)
+    block_type = BLOCK_SHB
+    while True:
+        length_raw = f.read(4)
+        if len(length_raw) < 4:
+            return
+        if block_type == BLOCK_SHB:
+            #The byte order of a section is only known from its byte order magic
+            bom = f.read(4)
+            endian = '<' if struct.unpack('<I', bom)[0] == BYTE_ORDER_MAGIC else '>'
+            total = struct.unpack(endian + 'I', length_raw)[0]
+            body = bom + f.read(total - 16)
+            interfaces = []
+        else:
+            total = struct.unpack(endian + 'I', length_raw)[0]
+            body = f.read(total - 12)
+        if len(body) < total - 12 or len(f.read(4)) < 4:
+            return
+
+        if block_type == BLOCK_EPB:
+            interface, high, low, captured = struct.unpack_from(endian + 'IIII', body)
+            linktype, resolution = interfaces[interface]
+            yield ((high << 32) | low) * resolution, linktype, body[20:20 + captured]
+        elif block_type == BLOCK_SPB:
+            linktype, resolution = interfaces[0]
+            original = struct.unpack_from(endian + 'I', body)[0]
+            yield None, linktype, body[4:4 + original]
+        elif block_type == BLOCK_IDB:
+            linktype = struct.unpack_from(endian + 'H', body)[0]
+            interfaces.append((linktype, _ts_resolution(body[8:], endian)))
+
+        head = f.read(4)
+        if len(head) < 4:
+            return
+        block_type = struct.unpack(endian + 'I', head)[0]
+
+def usb_frames(path, endpoint=1, device=None, min_device=5):
+    """
+    Yields (timestamp, bus, device, endpoint, direction, data) for the bulk transfers of endpoint, endpoint being
+    the address including the direction bit and direction 'OUT' or 'IN'.
+
+    Like the Wireshark filter
+        usb.device_address > 4 && !(usb.urb_type == 'S' && usb.endpoint_address.direction == IN) &&
+        !(usb.urb_type == 'C' && usb.endpoint_address.direction == OUT) && usb.endpoint_address.number == 1
+    only OUT submissions and IN completions with data are kept. device selects one address,
+    otherwise every address >= min_device is kept.
+    """
+    with open(path, 'rb') as f:
+        for timestamp, linktype, packet in iter_packets(f):
+            if linktype in USBMON_HEADER_SIZE:
+                if len(packet) < USBMON_STRUCT.size:
+                    continue
+                (_, urb_type, transfer, ep, address, bus, _, _, seconds, micros,
+                 _, _, _, _) = USBMON_STRUCT.unpack_from(packet)
+                data = packet[USBMON_HEADER_SIZE[linktype]:]
+                completed = urb_type == URB_COMPLETE
+                if urb_type not in (URB_SUBMIT, URB_COMPLETE):
+                    continue
+                if timestamp is None:
+                    timestamp = seconds + micros * 1e-6
+            elif linktype == LINKTYPE_USBPCAP:
+                if len(packet) < USBPCAP_STRUCT.size:
+                    continue
+                header_size, _, _, _, info, bus, address, ep, transfer, _ = USBPCAP_STRUCT.unpack_from(packet)
+                data = packet[header_size:]
+                completed = bool(info & USBPCAP_INFO_PDO_TO_FDO)
+            else:
+                continue
+
+            if transfer != TRANSFER_BULK or ep & 0x7F != endpoint or not data:
+                continue
+            if address != device if device is not None else address < min_device:
+                continue
+            incoming = bool(ep & DIRECTION_IN)
+            if incoming != completed:
+                continue
+            yield timestamp, bus, address, ep, 'IN' if incoming else 'OUT', data
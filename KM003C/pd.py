@@ -0,0 +1,525 @@
+#! /usr/bin/env python3
+
+from .defs import *
+from .recording import TimestampUnwrapper, Recording
+from .archive import Archive, is_archive
+from bisect import bisect_left
+from heapq import merge
+import argparse
+import mmap
+import queue
+import struct
+import sys
+import time
+
+#ATT_PD_PACKET payloads are not documented. The decoder assumes they are a sequence of records:
+#  size     u8, the low 6 bits count the bytes after it, the top 2 bits are kept as flags
+#  time     u32, device timestamp_ms, on the clock of the ADC queue
+#  sop      u8, SOP* of the message (0 SOP, 1 SOP', 2 SOP'', ...)
+#followed by size - 5 bytes of USB PD message: the 16 bit message header, its data objects and, for
+#extended messages, the extended header and data. Records too short for a message header are kept
+#as events. split_records() is the only place relying on this framing, and the logged messages
+#hold every byte of the record after the sop, so a log can be decoded again if it turns out wrong.
+RECORD_STRUCT = struct.Struct('<BIB')  # size and flags, timestamp_ms, sop
+RECORD_SIZE_MASK = 0x3F
+
+#Message kinds: the PD message type in the low 5 bits, the category above it
+CATEGORY_CONTROL = 0
+CATEGORY_DATA = 1
+CATEGORY_EXTENDED = 2
+PD_EVENT = 3 << 5
+
+class PdControlType(IntEnum):
+    GoodCRC = 1
+    GotoMin = 2
+    Accept = 3
+    Reject = 4
+    Ping = 5
+    PS_RDY = 6
+    Get_Source_Cap = 7
+    Get_Sink_Cap = 8
+    DR_Swap = 9
+    PR_Swap = 10
+    VCONN_Swap = 11
+    Wait = 12
+    Soft_Reset = 13
+    Data_Reset = 14
+    Data_Reset_Complete = 15
+    Not_Supported = 16
+    Get_Source_Cap_Extended = 17
+    Get_Status = 18
+    FR_Swap = 19
+    Get_PPS_Status = 20
+    Get_Country_Codes = 21
+    Get_Sink_Cap_Extended = 22
+    Get_Source_Info = 23
+    Get_Revision = 24
+
+class PdDataType(IntEnum):
+    Source_Capabilities = 1
+    Request = 2
+    BIST = 3
+    Sink_Capabilities = 4
+    Battery_Status = 5
+    Alert = 6
+    Get_Country_Info = 7
+    Enter_USB = 8
+    EPR_Request = 9
+    EPR_Mode = 10
+    Source_Info = 11
+    Revision = 12
+    Vendor_Defined = 15
+
+class PdExtendedType(IntEnum):
+    Source_Capabilities_Extended = 1
+    Status = 2
+    Get_Battery_Cap = 3
+    Get_Battery_Status = 4
+    Battery_Capabilities = 5
+    Get_Manufacturer_Info = 6
+    Manufacturer_Info = 7
+    Security_Request = 8
+    Security_Response = 9
+    Firmware_Update_Request = 10
+    Firmware_Update_Response = 11
+    PPS_Status = 12
+    Country_Info = 13
+    Country_Codes = 14
+    Sink_Capabilities_Extended = 15
+    Extended_Control = 16
+    EPR_Source_Capabilities = 17
+    EPR_Sink_Capabilities = 18
+    Vendor_Defined_Extended = 19
+
+CATEGORY_TYPES = {CATEGORY_CONTROL: PdControlType, CATEGORY_DATA: PdDataType, CATEGORY_EXTENDED: PdExtendedType}
+KIND_NAMES = {category << 5 | member: member.name
+              for category, types in CATEGORY_TYPES.items() for member in types}
+KIND_NAMES[PD_EVENT] = 'Event'
+KINDS = {name.lower(): kind for kind, name in KIND_NAMES.items()}
+SOP_NAMES = ("SOP", "SOP'", "SOP''", "SOP'_Debug", "SOP''_Debug")
+
+def message_kind(name):
+    """
+    Returns the kind of a message type name such as Request or ps_rdy, or of a kind number.
+    """
+    if isinstance(name, int):
+        return name
+    try:
+        return KINDS[name.lower()] if not name.isdigit() else int(name)
+    except KeyError:
+        raise ValueError(f'Unknown PD message type {name}') from None
+
+def message_header(category, type, data_objects=0, message_id=0, power_role=0, data_role=0, revision=2):
+    """
+    Packs a PD message header. revision is the spec revision field, 2 for PD 3.x.
+    """
+    return struct.pack('<H', (type & 0x1F) | (data_role & 1) << 5 | (revision & 3) << 6 | (power_role & 1) << 8 |
+                       (message_id & 7) << 9 | (data_objects & 7) << 12 | (category == CATEGORY_EXTENDED) << 15)
+
+def pack_record(timestamp_ms, sop, message, flags=0):
+    """
+    Packs one record of the assumed ATT_PD_PACKET framing.
+    """
+    return RECORD_STRUCT.pack((flags & 0xC0) | (5 + len(message)), timestamp_ms & 0xFFFFFFFF, sop) + message
+
+def describe_pdo(pdo):
+    """
+    Returns a short description of a power data object of a capabilities message.
+    """
+    supply = pdo >> 30
+    if supply == 0:
+        return f'{(pdo >> 10 & 0x3FF) * 0.05:g}V {(pdo & 0x3FF) * 0.01:g}A'
+    if supply == 1:
+        return f'battery {(pdo >> 10 & 0x3FF) * 0.05:g}-{(pdo >> 20 & 0x3FF) * 0.05:g}V {(pdo & 0x3FF) * 0.25:g}W'
+    if supply == 2:
+        return f'variable {(pdo >> 10 & 0x3FF) * 0.05:g}-{(pdo >> 20 & 0x3FF) * 0.05:g}V {(pdo & 0x3FF) * 0.01:g}A'
+    if pdo >> 28 & 3 == 0:
+        return f'PPS {(pdo >> 8 & 0xFF) * 0.1:g}-{(pdo >> 17 & 0xFF) * 0.1:g}V {(pdo & 0x7F) * 0.05:g}A'
+    return f'APDO 0x{pdo:08x}'
+
+class PdMessage:
+    """
+    One PD message or event, with its timestamp unwrapped past the uint32 rollover.
+    data holds the bytes of the record after the sop, the message header first.
+    """
+
+    def __init__(self, timestamp_ms, sop, data, flags=0, host_time=None):
+        self.timestamp_ms = timestamp_ms
+        self.sop = sop
+        self.data = bytes(data)
+        self.flags = flags
+        self.host_time = host_time  # Host time.monotonic() of the poll, None when read from a log
+        self.header = struct.unpack_from('<H', self.data)[0] if len(self.data) >= 2 else None
+
+    @property
+    def extended(self):
+        return self.header is not None and bool(self.header >> 15)
+
+    @property
+    def data_objects(self):
+        return 0 if self.header is None else self.header >> 12 & 7
+
+    @property
+    def message_id(self):
+        return None if self.header is None else self.header >> 9 & 7
+
+    @property
+    def kind(self):
+        if self.header is None:
+            return PD_EVENT
+        if self.extended:
+            category = CATEGORY_EXTENDED
+        else:
+            category = CATEGORY_DATA if self.data_objects else CATEGORY_CONTROL
+        return category << 5 | self.header & 0x1F
+
+    @property
+    def name(self):
+        return KIND_NAMES.get(self.kind, f'Reserved_{self.kind:#04x}')
+
+    @property
+    def objects(self):
+        """
+        The 32 bit data objects of a data message.
+        """
+        if self.extended:
+            return []
+        count = min(self.data_objects, (len(self.data) - 2) // 4)
+        return list(struct.unpack_from(f'<{count}I', self.data, 2))
+
+    def describe(self, source_capabilities=None):
+        """
+        Returns a readable summary of the message. Requests are decoded against the PDO they select
+        when the preceding Source_Capabilities message is given.
+        """
+        if self.header is None:
+            return f'Event {self.data.hex()}'
+        kind = self.kind
+        objects = self.objects
+        if kind in (CATEGORY_DATA << 5 | PdDataType.Source_Capabilities, CATEGORY_DATA << 5 | PdDataType.Sink_Capabilities):
+            return f"{self.name} {', '.join(describe_pdo(pdo) for pdo in objects)}"
+        if kind == CATEGORY_DATA << 5 | PdDataType.Request and objects:
+            rdo = objects[0]
+            position = rdo >> 28 & 0xF
+            selected = None
+            if source_capabilities is not None and 0 < position <= len(source_capabilities.objects):
+                selected = source_capabilities.objects[position - 1]
+            if selected is not None and selected >> 30 == 3:
+                return f'Request #{position} PPS {(rdo >> 9 & 0xFFF) * 0.02:g}V {(rdo & 0x7F) * 0.05:g}A'
+            text = f'Request #{position} {(rdo >> 10 & 0x3FF) * 0.01:g}A (max {(rdo & 0x3FF) * 0.01:g}A)'
+            return f'{text} of {describe_pdo(selected)}' if selected is not None else text
+        if objects:
+            return f"{self.name} {' '.join(f'{obj:08x}' for obj in objects)}"
+        return self.name
+
+    def format(self, source_capabilities=None):
+        """
+        Returns the timestamp, SOP* and description of the message.
+        """
+        sop = SOP_NAMES[self.sop] if self.sop < len(SOP_NAMES) else f'SOP{self.sop}'
+        return f'{self.timestamp_ms} ms {sop} {self.describe(source_capabilities)}'
+
+    def __str__(self):
+        return self.format()
+
+def split_records(data):
+    """
+    Splits a buffer into (flags, timestamp_ms, sop, message bytes) records of the assumed framing.
+    Returns the records and the number of bytes consumed, a trailing partial record is left over.
+    """
+    records = []
+    offset = 0
+    while offset < len(data):
+        size = data[offset] & RECORD_SIZE_MASK
+        if size < RECORD_STRUCT.size - 1:
+            #Too short for a timestamp, treated as padding
+            offset += 1
+            continue
+        end = offset + 1 + size
+        if end > len(data):
+            break
+        flags, timestamp, sop = RECORD_STRUCT.unpack_from(data, offset)
+        records.append((flags & ~RECORD_SIZE_MASK, timestamp, sop, bytes(data[offset + RECORD_STRUCT.size:end])))
+        offset = end
+    return records, offset
+
+class PdDecoder:
+    """
+    Incremental decoder of ATT_PD_PACKET payloads into PdMessage objects.
+    A record split across payloads is completed by the next one.
+    """
+
+    def __init__(self):
+        self._pending = b''
+        self._unwrap = TimestampUnwrapper()
+        self.messages = 0
+
+    def feed(self, payload, host_time=None):
+        data = self._pending + bytes(payload) if self._pending else bytes(payload)
+        records, consumed = split_records(data)
+        self._pending = data[consumed:]
+        self.messages += len(records)
+        return [PdMessage(self._unwrap(timestamp), sop, message, flags, host_time)
+                for flags, timestamp, sop, message in records]
+
+#PD log layout: HEADER_STRUCT, then entries of ENTRY_STRUCT followed by their message bytes.
+#The index sidecar (path + INDEX_SUFFIX) holds one fixed width INDEX_STRUCT per entry. It is only
+#written after the entries it points at, and is completed from the log if it is missing or behind.
+MAGIC = b'KM003CP\x00'
+VERSION = 1
+HEADER_STRUCT = struct.Struct('<8sHd')     # magic, version, start time
+ENTRY_STRUCT = struct.Struct('<qdBBH')     # unwrapped timestamp_ms, host time, sop, flags, message size
+INDEX_STRUCT = struct.Struct('<qQH')       # unwrapped timestamp_ms, entry offset, kind
+INDEX_SUFFIX = '.idx'
+
+class PdLogWriter:
+    """
+    Appends PdMessage objects to a PD log and its index. Entries are buffered until flush().
+    """
+
+    def __init__(self, path):
+        self._file = open(path, 'wb')
+        self._file.write(HEADER_STRUCT.pack(MAGIC, VERSION, time.time()))
+        self._index = open(path + INDEX_SUFFIX, 'wb')
+        self._offset = HEADER_STRUCT.size
+        self._entries = []
+        self._index_entries = []
+        self.count = 0
+
+    def write(self, message: PdMessage):
+        host_time = message.host_time if message.host_time is not None else float('nan')
+        entry = ENTRY_STRUCT.pack(message.timestamp_ms, host_time, message.sop, message.flags, len(message.data))
+        self._entries += (entry, message.data)
+        self._index_entries.append(INDEX_STRUCT.pack(message.timestamp_ms, self._offset, message.kind))
+        self._offset += len(entry) + len(message.data)
+        self.count += 1
+
+    def flush(self):
+        if not self._entries:
+            return
+        self._file.write(b''.join(self._entries))
+        self._file.flush()
+        self._index.write(b''.join(self._index_entries))
+        self._index.flush()
+        self._entries = []
+        self._index_entries = []
+
+    def close(self):
+        self.flush()
+        self._file.close()
+        self._index.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+class PdLog:
+    """
+    Memory maps a PD log for time range and message type queries.
+
+    Only the index is read when opening, into a sorted timestamp list and a list of entry numbers
+    per message kind, so a query costs a few bisections and decodes just the entries it returns.
+    Timestamps are assumed not to go backwards, as they come from one device clock.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, 'rb')
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, start_time = HEADER_STRUCT.unpack_from(self._map)
+        if magic != MAGIC:
+            raise ValueError(f'{path} is not a KM003C PD log')
+        if version != VERSION:
+            raise ValueError(f'Unsupported PD log version {version}')
+        self.start_time = start_time  # Host time.time() when logging started
+        self._load_index()
+
+    def _load_index(self):
+        try:
+            with open(self.path + INDEX_SUFFIX, 'rb') as f:
+                data = f.read()
+            data = data[:len(data) - len(data) % INDEX_STRUCT.size]
+            entries = list(INDEX_STRUCT.iter_unpack(data))
+        except OSError:
+            entries = []
+        #Entries past the end of a truncated log are dropped, entries missing from the index are added
+        while entries and entries[-1][1] + ENTRY_STRUCT.size > len(self._map):
+            entries.pop()
+        offset = HEADER_STRUCT.size
+        if entries:
+            offset = entries[-1][1] + ENTRY_STRUCT.size + ENTRY_STRUCT.unpack_from(self._map, entries[-1][1])[4]
+        while offset + ENTRY_STRUCT.size <= len(self._map):
+            size = ENTRY_STRUCT.unpack_from(self._map, offset)[4]
+            if offset + ENTRY_STRUCT.size + size > len(self._map):
+                break
+            message = self._read(offset)
+            entries.append((message.timestamp_ms, offset, message.kind))
+            offset += ENTRY_STRUCT.size + size
+        self._timestamps = [entry[0] for entry in entries]
+        self._offsets = [entry[1] for entry in entries]
+        self._by_kind = {}
+        for number, entry in enumerate(entries):
+            self._by_kind.setdefault(entry[2], []).append(number)
+
+    def _read(self, offset):
+        timestamp, host_time, sop, flags, size = ENTRY_STRUCT.unpack_from(self._map, offset)
+        start = offset + ENTRY_STRUCT.size
+        return PdMessage(timestamp, sop, self._map[start:start + size], flags)
+
+    def __len__(self):
+        return len(self._offsets)
+
+    def __getitem__(self, number):
+        return self._read(self._offsets[number])
+
+    @property
+    def kinds(self):
+        """
+        Number of messages per message type name.
+        """
+        return {KIND_NAMES.get(kind, f'Reserved_{kind:#04x}'): len(numbers) for kind, numbers in self._by_kind.items()}
+
+    def entries(self, t0=None, t1=None, types=None):
+        """
+        Returns the entry numbers of the messages with t0 <= timestamp_ms < t1, of the given
+        types (names or kinds) if any, in log order.
+        """
+        start = 0 if t0 is None else bisect_left(self._timestamps, t0)
+        stop = len(self._timestamps) if t1 is None else bisect_left(self._timestamps, t1)
+        if types is None:
+            return list(range(start, stop))
+        selected = []
+        for kind in {message_kind(name) for name in types}:
+            numbers = self._by_kind.get(kind, [])
+            selected.append(numbers[bisect_left(numbers, start):bisect_left(numbers, stop)])
+        return list(merge(*selected))
+
+    def query(self, t0=None, t1=None, types=None):
+        """
+        Returns the messages with t0 <= timestamp_ms < t1, of the given types if any.
+        """
+        return [self[number] for number in self.entries(t0, t1, types)]
+
+    def latest(self, t, types):
+        """
+        Returns the last message of the given types at or before timestamp t, or None.
+        """
+        stop = bisect_left(self._timestamps, t + 1)
+        last = -1
+        for kind in {message_kind(name) for name in types}:
+            numbers = self._by_kind.get(kind, [])
+            position = bisect_left(numbers, stop)
+            if position:
+                last = max(last, numbers[position - 1])
+        return self[last] if last >= 0 else None
+
+    def around(self, t, before_ms=1000, after_ms=1000, types=None):
+        """
+        Returns the messages from before_ms before to after_ms after timestamp t.
+        """
+        return self.query(t - before_ms, t + after_ms + 1, types)
+
+    def join(self, recording, t0=None, t1=None, types=None, before_ms=10, after_ms=100):
+        """
+        Yields every selected message with the ADC samples from before_ms before to after_ms after it,
+        read from recording (a Recording of the same capture, or anything with time_range()).
+        """
+        for message in self.query(t0, t1, types):
+            yield message, recording.time_range(message.timestamp_ms - before_ms, message.timestamp_ms + after_ms + 1)
+
+    def close(self):
+        self._map.close()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+class PdCapture:
+    """
+    Decodes the ATT_PD_PACKET segments of every streamed poll into a PD log.
+
+    on_response() runs on the polling thread and only queues the payloads, which write_pending()
+    decodes and appends on the logging thread, like SegmentLog.
+    """
+    att = AttributeDataType.ATT_PD_PACKET
+
+    def __init__(self, path):
+        self._queue = queue.SimpleQueue()
+        self._decoder = PdDecoder()
+        self.writer = PdLogWriter(path)
+
+    def on_response(self, response):
+        if response.pd_packet:
+            self._queue.put((response.host_time, response.pd_packet))
+
+    def write_pending(self):
+        while not self._queue.empty():
+            host_time, payload = self._queue.get_nowait()
+            for message in self._decoder.feed(payload, host_time):
+                self.writer.write(message)
+        self.writer.flush()
+
+    def close(self):
+        self.write_pending()
+        self.writer.close()
+
+def describe(log, message, batch=None):
+    """
+    Returns a message summary, with a Request decoded against the preceding Source_Capabilities
+    and followed by the vbus and ibus range of the ADC samples in batch if given.
+    """
+    caps = None
+    if message.kind == CATEGORY_DATA << 5 | PdDataType.Request:
+        caps = log.latest(message.timestamp_ms, ['Source_Capabilities'])
+    text = message.format(caps)
+    if batch is None:
+        return text
+    if not len(batch):
+        return f'{text}  (no samples)'
+    vbus, ibus = batch.vbus, batch.ibus
+    return (f'{text}  vbus {min(vbus) / 1e6:.3f}-{max(vbus) / 1e6:.3f} V, '
+            f'ibus {min(ibus) / 1e6:.3f}-{max(ibus) / 1e6:.3f} A over {len(batch)} samples')
+
+def main():
+    parser = argparse.ArgumentParser(description="Query a KM003C PD log")
+    parser.add_argument('log', type=str, help="PD log written by km003c_logger --pd-log.")
+    parser.add_argument('--type', '-t', action='append', default=None,
+                        help="Only show messages of this type, e.g. Request, Accept or PS_RDY. May be repeated.")
+    parser.add_argument('--start', type=int, default=None, help="First timestamp_ms to show (unwrapped).")
+    parser.add_argument('--end', type=int, default=None, help="Timestamp_ms to stop at, exclusive (unwrapped).")
+    parser.add_argument('--at', type=int, default=None,
+                        help="Show the messages around this timestamp_ms instead, within --window.")
+    parser.add_argument('--window', type=int, default=1000, help="Milliseconds before and after --at (default: 1000).")
+    parser.add_argument('--recording', type=str, default=None,
+                        help="Binary recording or archive of the same capture, to show the vbus and ibus range around every message.")
+    parser.add_argument('--summary', action='store_true', help="Only count the messages per type.")
+
+    args = parser.parse_args()
+    with PdLog(args.log) as log:
+        if args.summary:
+            for name, count in sorted(log.kinds.items(), key=lambda item: -item[1]):
+                print(f'{count:8d} {name}')
+            return
+        t0, t1 = args.start, args.end
+        if args.at is not None:
+            t0, t1 = args.at - args.window, args.at + args.window + 1
+        try:
+            if args.recording:
+                with (Archive if is_archive(args.recording) else Recording)(args.recording) as recording:
+                    for message, batch in log.join(recording, t0, t1, args.type):
+                        print(describe(log, message, batch))
+                        del batch
+            else:
+                for message in log.query(t0, t1, args.type):
+                    print(describe(log, message))
+        except ValueError as e:
+            print(e, file=sys.stderr)
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,249 @@
+#! /usr/bin/env python3
+
+from .defs import *
+from .recording import Recording, TimestampUnwrapper, MAGIC as RECORDING_MAGIC
+import argparse
+import csv
+import mmap
+import os
+import struct
+
+#Every level stores one BUCKET_STRUCT record per non-empty bucket of width ms, ordered by time:
+#bucket start (unwrapped timestamp_ms), sample count, vbus min/max/sum, ibus min/max/sum.
+BUCKET_STRUCT = struct.Struct('<qIiiqiiq')
+LEVELS_MS = (10, 1000, 60000)
+
+class PyramidLevel:
+    """
+    Min/max/sum aggregates of vbus and ibus over fixed width buckets.
+    Completed buckets are kept in a bytearray or written to a file, which mode 'w' truncates
+    and mode 'r' opens read-only for queries.
+    """
+
+    def __init__(self, width_ms, path=None, mode='w'):
+        if mode not in ('r', 'w'):
+            raise ValueError(f'Unknown mode {mode}')
+        self.width = width_ms
+        self.path = path
+        self.mode = mode
+        self._buffer = bytearray() if path is None else None
+        #Appending to the files of an earlier run would break the time order the queries bisect
+        self._file = open(path, 'wb') if path is not None and mode == 'w' else None
+        self._open = None  # [bucket id, count, vmin, vmax, vsum, imin, imax, isum] still filling up
+
+    def _emit(self, buckets):
+        data = b''.join(BUCKET_STRUCT.pack(bucket[0] * self.width, *bucket[1:]) for bucket in buckets)
+        if self._file is not None:
+            self._file.write(data)
+        else:
+            self._buffer += data
+
+    def update(self, timestamps, vbus, ibus):
+        """
+        Folds samples with unwrapped timestamps in, emitting every bucket that is complete.
+        """
+        if self.mode == 'r':
+            raise ValueError('Pyramid level opened read-only')
+        if np is not None and isinstance(timestamps, np.ndarray):
+            ids = timestamps // self.width
+            starts = np.concatenate(([0], np.flatnonzero(ids[1:] != ids[:-1]) + 1))
+            counts = np.diff(np.append(starts, len(ids)))
+            groups = list(zip(ids[starts].tolist(), counts.tolist(),
+                              np.minimum.reduceat(vbus, starts).tolist(), np.maximum.reduceat(vbus, starts).tolist(),
+                              np.add.reduceat(vbus.astype(np.int64), starts).tolist(),
+                              np.minimum.reduceat(ibus, starts).tolist(), np.maximum.reduceat(ibus, starts).tolist(),
+                              np.add.reduceat(ibus.astype(np.int64), starts).tolist()))
+        else:
+            groups = []
+            for t, v, i in zip(timestamps, vbus, ibus):
+                bucket = t // self.width
+                if groups and groups[-1][0] == bucket:
+                    g = groups[-1]
+                    g[1] += 1
+                    g[2], g[3], g[4] = min(g[2], v), max(g[3], v), g[4] + v
+                    g[5], g[6], g[7] = min(g[5], i), max(g[6], i), g[7] + i
+                else:
+                    groups.append([bucket, 1, v, v, v, i, i, i])
+        if not groups:
+            return
+
+        first = list(groups[0])
+        if self._open is not None:
+            if self._open[0] == first[0]:
+                o = self._open
+                first = [o[0], o[1] + first[1], min(o[2], first[2]), max(o[3], first[3]), o[4] + first[4],
+                         min(o[5], first[5]), max(o[6], first[6]), o[7] + first[7]]
+            else:
+                self._emit([self._open])
+        groups[0] = first
+        self._emit(groups[:-1])
+        self._open = list(groups[-1])
+
+    def flush(self):
+        if self._file is not None:
+            self._file.flush()
+
+    def close(self):
+        """
+        Emits the bucket still filling up and closes the level file.
+        """
+        if self._open is not None:
+            self._emit([self._open])
+            self._open = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def buckets(self):
+        """
+        Returns a buffer holding the completed bucket records.
+        """
+        if self._buffer is not None:
+            return self._buffer
+        if self._file is not None:
+            self._file.flush()
+        if not os.path.getsize(self.path):
+            return b''
+        with open(self.path, 'rb') as f:
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+def _bisect(buffer, count, t):
+    """
+    Returns the first bucket record starting at or after t.
+    """
+    low, high = 0, count
+    while low < high:
+        middle = (low + high) // 2
+        if struct.unpack_from('<q', buffer, middle * BUCKET_STRUCT.size)[0] < t:
+            low = middle + 1
+        else:
+            high = middle
+    return low
+
+class Pyramid:
+    """
+    Multi-resolution vbus/ibus min/max/mean aggregates for fast envelope queries.
+
+    With path, level files path.<width>ms are written from scratch, so they can be built while
+    logging, and are queried later with mode 'r'. Timestamps are unwrapped past the uint32 rollover.
+    """
+
+    def __init__(self, path=None, levels=LEVELS_MS, mode='w'):
+        self.path = path
+        self.levels = [PyramidLevel(width, f'{path}.{width}ms' if path else None, mode) for width in sorted(levels)]
+        self._unwrap = TimestampUnwrapper()
+
+    def update_columns(self, timestamps, vbus, ibus):
+        if not len(timestamps):
+            return
+        if np is not None:
+            timestamps, vbus, ibus = np.asarray(timestamps), np.asarray(vbus), np.asarray(ibus)
+        timestamps = self._unwrap.unwrap(timestamps)
+        for level in self.levels:
+            level.update(timestamps, vbus, ibus)
+
+    def write(self, batch):
+        self.update_columns(batch.timestamp_ms, batch.vbus, batch.ibus)
+
+    def flush(self):
+        for level in self.levels:
+            level.flush()
+
+    def close(self):
+        for level in self.levels:
+            level.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def envelope(self, t0, t1, points):
+        """
+        Returns the vbus/ibus min/max/mean envelope between the unwrapped timestamps t0 and t1 at
+        up to points points, as a dict of lists. Empty points are left out. Point boundaries are
+        rounded to the buckets of the level read.
+
+        The coarsest level still giving at least one bucket per point is read, so the work is
+        bounded by points times the level ratio rather than by the number of raw samples.
+        """
+        step = max(1, (t1 - t0) / points)
+        level = self.levels[0]
+        for candidate in self.levels:
+            if candidate.width <= step:
+                level = candidate
+        buffer = level.buckets()
+        count = len(buffer) // BUCKET_STRUCT.size
+        first = _bisect(buffer, count, t0 - t0 % level.width)
+        last = _bisect(buffer, count, t1)
+
+        result = {name: [] for name in ('time_ms', 'count', 'vbus_min', 'vbus_max', 'vbus_mean',
+                                        'ibus_min', 'ibus_max', 'ibus_mean')}
+        current = None
+        for index in range(first, last):
+            start, n, vmin, vmax, vsum, imin, imax, isum = BUCKET_STRUCT.unpack_from(buffer, index * BUCKET_STRUCT.size)
+            point = int((max(start, t0) - t0) // step)
+            if current is None or current[0] != point:
+                if current is not None:
+                    self._append(result, current, t0, step)
+                current = [point, n, vmin, vmax, vsum, imin, imax, isum]
+            else:
+                current[1] += n
+                current[2], current[3], current[4] = min(current[2], vmin), max(current[3], vmax), current[4] + vsum
+                current[5], current[6], current[7] = min(current[5], imin), max(current[6], imax), current[7] + isum
+        if current is not None:
+            self._append(result, current, t0, step)
+        if isinstance(buffer, mmap.mmap):
+            buffer.close()
+        return result
+
+    @staticmethod
+    def _append(result, point, t0, step):
+        index, n, vmin, vmax, vsum, imin, imax, isum = point
+        result['time_ms'].append(t0 + index * step)
+        result['count'].append(n)
+        result['vbus_min'].append(vmin)
+        result['vbus_max'].append(vmax)
+        result['vbus_mean'].append(vsum / n)
+        result['ibus_min'].append(imin)
+        result['ibus_max'].append(imax)
+        result['ibus_mean'].append(isum / n)
+
+def build_pyramid(source, path, levels=LEVELS_MS, block_records=65536):
+    """
+    Builds the level files of path from an existing binary recording or logger CSV file.
+    """
+    with open(source, 'rb') as f:
+        binary = f.read(len(RECORDING_MAGIC)) == RECORDING_MAGIC
+
+    with Pyramid(path, levels) as pyramid:
+        if binary:
+            with Recording(source) as recording:
+                for start in range(0, len(recording), block_records):
+                    pyramid.write(recording.batch(start, start + block_records))
+            return
+        with open(source, newline='') as f:
+            reader = csv.reader(f)
+            next(reader)
+            rows = []
+            for row in reader:
+                rows.append(row)
+                if len(rows) == block_records:
+                    _update_rows(pyramid, rows)
+                    rows = []
+            _update_rows(pyramid, rows)
+
+def _update_rows(pyramid, rows):
+    pyramid.update_columns([int(row[0]) for row in rows], [int(row[1]) for row in rows], [int(row[2]) for row in rows])
+
+def main():
+    parser = argparse.ArgumentParser(description="Build the min/max pyramid of an existing KM003C capture")
+    parser.add_argument('input', type=str, help="Binary recording or CSV file written by km003c_logger.")
+    parser.add_argument('output', type=str, help="Path prefix of the pyramid level files.")
+
+    args = parser.parse_args()
+    build_pyramid(args.input, args.output)
+
+if __name__ == '__main__':
+    main()
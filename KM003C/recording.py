@@ -0,0 +1,283 @@
+#! /usr/bin/env python3
+
+from .defs import *
+from .export import CsvWriter
+from bisect import bisect_left
+import argparse
+import json
+import mmap
+import struct
+import time
+
+#Binary recording layout:
+#  header   HEADER_STRUCT followed by a JSON document with the column names, units and rate
+#  records  fixed width AdcQueueEntry records (AdcQueueEntry.STRUCT_FORMAT), appended in chunks
+#
+#The sparse index lives in a sidecar file (path + INDEX_SUFFIX). Every INDEX_STRIDE records it
+#holds the record number and the timestamp unwrapped past the uint32 rollover. It is rebuilt
+#from the records if it is missing or behind the data file.
+
+MAGIC = b'KM003CR\x00'
+VERSION = 1
+HEADER_STRUCT = struct.Struct('<8sHHIdII')  # magic, version, record size, rate, start time, data offset, meta size
+INDEX_STRUCT = struct.Struct('<QQ')         # record number, unwrapped timestamp_ms
+INDEX_SUFFIX = '.idx'
+INDEX_STRIDE = 1024
+RECORD_STRUCT = struct.Struct(AdcQueueEntry.STRUCT_FORMAT)
+
+UNITS = {
+    'timestamp_ms': 'ms',
+    'vbus': 'µV',
+    'ibus': 'µA',
+    'vcc1': '0.1 mV',
+    'vcc2': '0.1 mV',
+    'vdp': 'mV',
+    'vdm': 'mV',
+}
+
+class TimestampUnwrapper:
+    """
+    Extends uint32 millisecond timestamps past their rollover.
+    """
+
+    def __init__(self):
+        self.last = None
+        self.offset = 0
+
+    def __call__(self, timestamp_ms):
+        if self.last is not None and self.last - timestamp_ms > 0x80000000:
+            self.offset += 0x100000000
+        self.last = timestamp_ms
+        return timestamp_ms + self.offset
+
+    def unwrap(self, timestamps):
+        """
+        Unwraps a sequence of timestamps continuing from the previous calls, vectorized into an int64
+        array with numpy and otherwise into a list.
+        """
+        if np is None:
+            return [self(t) for t in timestamps]
+        ts = np.asarray(timestamps, dtype=np.int64)
+        if not len(ts):
+            return ts
+        previous = np.concatenate(([ts[0] if self.last is None else self.last], ts[:-1]))
+        wraps = np.cumsum((previous - ts) > 0x80000000) * 0x100000000 + self.offset
+        self.last = int(ts[-1])
+        self.offset = int(wraps[-1])
+        return ts + wraps
+
+def batch_to_bytes(batch):
+    """
+    Packs a batch into consecutive fixed width records.
+    """
+    if batch.records is not None and batch.records.dtype == AdcQueueBatch.DTYPE:
+        return batch.records.tobytes()
+    return b''.join(RECORD_STRUCT.pack(*values) for values in zip(*batch.lists()))
+
+class RecordingWriter:
+    """
+    Appends AdcQueueBatch objects to a binary recording.
+    Records are buffered and written in chunks of chunk_records.
+    """
+
+    def __init__(self, path, rate: Rate, chunk_records=4096, index_stride=INDEX_STRIDE):
+        meta = json.dumps({
+            'columns': list(AdcQueueBatch.COLUMNS),
+            'units': UNITS,
+            'format': AdcQueueEntry.STRUCT_FORMAT,
+            'rate': Rate(rate).name,
+            'sps': RATE_SPS[rate],
+            'index_stride': index_stride,
+        }).encode()
+        self._file = open(path, 'wb')
+        self._file.write(HEADER_STRUCT.pack(MAGIC, VERSION, RECORD_STRUCT.size, rate, time.time(),
+                                            HEADER_STRUCT.size + len(meta), len(meta)))
+        self._file.write(meta)
+        self._index = open(path + INDEX_SUFFIX, 'wb')
+        self._chunk = []
+        self._chunk_records = 0
+        self.chunk_records = chunk_records
+        self.index_stride = index_stride
+        self.count = 0
+        self._unwrap = TimestampUnwrapper()
+
+    def write(self, batch):
+        n = len(batch)
+        if not n:
+            return
+        timestamps = batch.timestamp_ms
+        first = self.count
+        #Unwrapping the batch ends and the indexed records is enough to catch every rollover
+        self._unwrap(int(timestamps[0]))
+        position = -first % self.index_stride
+        while position < n:
+            self._index.write(INDEX_STRUCT.pack(first + position, self._unwrap(int(timestamps[position]))))
+            position += self.index_stride
+        self._unwrap(int(timestamps[n-1]))
+
+        self._chunk.append(batch_to_bytes(batch))
+        self._chunk_records += n
+        self.count += n
+        if self._chunk_records >= self.chunk_records:
+            self._write_chunk()
+
+    def _write_chunk(self):
+        #The index may only point at records already in the data file
+        self._file.write(b''.join(self._chunk))
+        self._file.flush()
+        self._index.flush()
+        self._chunk = []
+        self._chunk_records = 0
+
+    def flush(self):
+        if self._chunk:
+            self._write_chunk()
+
+    def close(self):
+        self.flush()
+        self._file.close()
+        self._index.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+class Recording:
+    """
+    Memory maps a binary recording for reading.
+
+    With numpy, batches are zero-copy views into the mapping, so they must not be used after close().
+    Without numpy the requested records are decoded into array columns.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, 'rb')
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, record_size, rate, start_time, data_offset, meta_size = HEADER_STRUCT.unpack_from(self._map)
+        if magic != MAGIC:
+            raise ValueError(f'{path} is not a KM003C recording')
+        if version != VERSION:
+            raise ValueError(f'Unsupported recording version {version}')
+        self.record_size = record_size
+        self.rate = Rate(rate)
+        self.start_time = start_time  # Host time.time() when recording started
+        self.meta = json.loads(self._map[HEADER_STRUCT.size:HEADER_STRUCT.size+meta_size])
+        self.units = self.meta['units']
+        self._data_offset = data_offset
+        #A crash may leave a partial record behind, it is ignored
+        self.count = (len(self._map) - data_offset) // record_size
+        self.records = None
+        if np is not None:
+            self.records = np.frombuffer(self._map, dtype=AdcQueueBatch.DTYPE, count=self.count, offset=data_offset)
+        self._load_index()
+
+    def _load_index(self):
+        stride = self.meta.get('index_stride', INDEX_STRIDE)
+        entries = []
+        try:
+            with open(self.path + INDEX_SUFFIX, 'rb') as f:
+                data = f.read()
+            data = data[:len(data) - len(data) % INDEX_STRUCT.size]
+            entries = [entry for entry in INDEX_STRUCT.iter_unpack(data) if entry[0] < self.count]
+        except OSError:
+            entries = []
+        if len(entries) != (self.count + stride - 1) // stride:
+            entries = self._build_index(stride)
+        self._index_records = [entry[0] for entry in entries]
+        self._index_times = [entry[1] for entry in entries]
+
+    def _build_index(self, stride, chunk_records=1 << 20):
+        unwrap = TimestampUnwrapper()
+        if self.records is not None:
+            #Unwraps whole chunks at a time, each a multiple of stride so entries start at their first record
+            chunk_records = max(1, chunk_records // stride) * stride
+            entries = []
+            for start in range(0, self.count, chunk_records):
+                timestamps = unwrap.unwrap(self.records['timestamp_ms'][start:start + chunk_records])
+                entries += zip(range(start, start + len(timestamps), stride), timestamps[::stride].tolist())
+            return entries
+        entries = []
+        for i in range(self.count):
+            timestamp = unwrap(self._timestamp(i))
+            if i % stride == 0:
+                entries.append((i, timestamp))
+        return entries
+
+    def _timestamp(self, i):
+        return struct.unpack_from('<I', self._map, self._data_offset + i * self.record_size)[0]
+
+    def __len__(self):
+        return self.count
+
+    def batch(self, start=0, stop=None):
+        """
+        Returns records start to stop as an AdcQueueBatch.
+        """
+        start, stop, _ = slice(start, stop).indices(self.count)
+        stop = max(start, stop)
+        if self.records is not None:
+            return AdcQueueBatch.from_records(self.records[start:stop])
+        begin = self._data_offset + start * self.record_size
+        return AdcQueueBatch.from_bytes(memoryview(self._map)[begin:begin + (stop - start) * self.record_size],
+                                        stop - start, self.record_size)
+
+    def _find(self, t):
+        """
+        Returns the first record whose unwrapped timestamp is >= t.
+        """
+        if not self._index_times:
+            return 0
+        #The last entry before t, as with repeated timestamps the first record >= t may precede an entry == t
+        block = max(0, bisect_left(self._index_times, t) - 1)
+        position = self._index_records[block]
+        end = self._index_records[block + 1] if block + 1 < len(self._index_records) else self.count
+        unwrap = TimestampUnwrapper()
+        unwrap.offset = self._index_times[block] - self._timestamp(position)
+        timestamps = [unwrap(self._timestamp(i)) for i in range(position, end)]
+        return position + bisect_left(timestamps, t)
+
+    def time_range(self, t0=None, t1=None):
+        """
+        Returns the records with t0 <= unwrapped timestamp_ms < t1 as an AdcQueueBatch.
+        Only the index and at most two index strides of timestamps are read.
+        """
+        start = 0 if t0 is None else self._find(t0)
+        stop = self.count if t1 is None else self._find(t1)
+        return self.batch(start, stop)
+
+    def close(self):
+        self.records = None
+        self._map.close()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+def convert_to_csv(path, output, t0=None, t1=None, block_records=65536):
+    """
+    Writes the records of a binary recording between t0 and t1 as logger CSV.
+    """
+    with Recording(path) as recording, CsvWriter(output) as writer:
+        batch = recording.time_range(t0, t1)
+        for start in range(0, len(batch), block_records):
+            writer.write(batch[start:start+block_records])
+        del batch
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert a KM003C binary recording to CSV")
+    parser.add_argument('input', type=str, help="Binary recording written by km003c_logger --format bin.")
+    parser.add_argument('output', type=str, help="Path of the CSV file to write.")
+    parser.add_argument('--start', type=int, default=None, help="First timestamp_ms to convert (unwrapped).")
+    parser.add_argument('--end', type=int, default=None, help="Timestamp_ms to stop at, exclusive (unwrapped).")
+
+    args = parser.parse_args()
+    convert_to_csv(args.input, args.output, args.start, args.end)
+
+if __name__ == '__main__':
+    main()
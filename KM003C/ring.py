@@ -0,0 +1,96 @@
+import threading
+
+class BatchRing:
+    """
+    Bounded single-producer/single-consumer ring of decoded batches.
+
+    The slots are preallocated and each side only ever advances its own index. A condition guards
+    the indices and the closed flag, so a consumer waiting on an empty ring never misses a push or
+    close(). When the ring is full, new batches are dropped and counted as overruns.
+    """
+
+    def __init__(self, capacity=1024):
+        if capacity < 1:
+            raise ValueError("Capacity must be at least 1.")
+        self.capacity = capacity
+        self._slots = [None] * capacity
+        self._head = 0          # Next slot to write, only advanced by the producer
+        self._tail = 0          # Next slot to read, only advanced by the consumer
+        self._changed = threading.Condition(threading.Lock())
+        self.closed = False
+        self.pushed = 0         # Batches accepted
+        self.overruns = 0       # Batches dropped because the ring was full
+        self.dropped_samples = 0
+        self.high_water = 0     # Highest fill level seen
+
+    def __len__(self):
+        return self._head - self._tail
+
+    def push(self, batch):
+        """
+        Appends a batch, returns False if it was dropped because the ring is full.
+        """
+        with self._changed:
+            fill = self._head - self._tail
+            if fill >= self.capacity:
+                self.overruns += 1
+                self.dropped_samples += len(batch)
+                return False
+            self._slots[self._head % self.capacity] = batch
+            self._head += 1
+            self.pushed += 1
+            if fill + 1 > self.high_water:
+                self.high_water = fill + 1
+            self._changed.notify()
+        return True
+
+    def pop(self, timeout=None):
+        """
+        Removes and returns the oldest batch.
+        Returns None if nothing arrived within timeout or the ring was closed while empty.
+        """
+        with self._changed:
+            if self._tail == self._head and timeout != 0:
+                #The predicate is checked under the lock, so a push or close() in between cannot be lost
+                self._changed.wait_for(lambda: self._tail != self._head or self.closed, timeout)
+            if self._tail == self._head:
+                return None
+            index = self._tail % self.capacity
+            batch = self._slots[index]
+            self._slots[index] = None
+            self._tail += 1
+            return batch
+
+    def close(self):
+        """
+        Marks the end of the stream and wakes up a waiting consumer.
+        """
+        with self._changed:
+            self.closed = True
+            self._changed.notify_all()
+
+    def __iter__(self):
+        """
+        Yields batches until the ring is closed and drained.
+        """
+        while True:
+            batch = self.pop()
+            if batch is None:
+                with self._changed:
+                    if self.closed and self._tail == self._head:
+                        return
+                continue
+            yield batch
+
+    def stats(self):
+        """
+        Returns the fill level and overrun counters as a dict.
+        """
+        return {
+            'capacity': self.capacity,
+            'fill': len(self),
+            'high_water': self.high_water,
+            'pushed': self.pushed,
+            'overruns': self.overruns,
+            'dropped_samples': self.dropped_samples,
+        }
@@ -0,0 +1,55 @@
+import time
+from .defs import *
+
+class PollScheduler:
+    """
+    Picks the ADC queue poll interval from the sample rate and the fill level of the returned chunks.
+
+    The interval starts at the time the device needs to fill half a chunk. It is shortened when
+    responses come back nearly full, so the device queue cannot overflow, and lengthened when they
+    come back nearly empty, so no requests are wasted.
+    """
+
+    def __init__(self, rate: Rate, capacity=QUEUE_CHUNK_MAX, low=0.25, high=0.75,
+                 min_interval=0.001, max_interval=1.0):
+        self.sps = RATE_SPS[rate]
+        self.capacity = capacity  # Entries a single response can carry
+        self.low = low
+        self.high = high
+        self.min_interval = min_interval
+        #Never wait longer than it takes to fill the high water mark
+        self.max_interval = max(min_interval, min(max_interval, capacity * high / self.sps))
+        self.interval = self._clamp(capacity / 2 / self.sps)
+        self.polls = 0
+        self.samples = 0
+        self.start = time.monotonic()
+
+    def _clamp(self, interval):
+        return min(self.max_interval, max(self.min_interval, interval))
+
+    def update(self, entries):
+        """
+        Records a response with entries samples and returns the interval until the next poll.
+        """
+        self.polls += 1
+        self.samples += entries
+        fill = entries / self.capacity
+        if fill >= self.high:
+            self.interval = self._clamp(self.interval * 0.5)
+        elif fill <= self.low:
+            self.interval = self._clamp(self.interval * 1.25)
+        return self.interval
+
+    def stats(self):
+        """
+        Returns the achieved poll rate and requests per sample as a dict.
+        """
+        elapsed = time.monotonic() - self.start
+        return {
+            'interval': self.interval,
+            'polls': self.polls,
+            'samples': self.samples,
+            'poll_rate': self.polls / elapsed if elapsed > 0 else 0.0,
+            'requests_per_sample': self.polls / self.samples if self.samples else 0.0,
+            'mean_fill': self.samples / self.polls / self.capacity if self.polls else 0.0,
+        }
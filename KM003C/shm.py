@@ -0,0 +1,246 @@
+from .defs import *
+from .recording import RECORD_STRUCT, batch_to_bytes
+from multiprocessing import resource_tracker, shared_memory
+import os
+import struct
+import sys
+
+#Shared memory layout: HEADER_STRUCT, padded to DATA_OFFSET, then capacity AdcQueueEntry records.
+#Record number n (its sequence number) lives in slot n % capacity. Like a seqlock, every write first
+#raises claim to the sequence number after its last record, then copies the records in, and only then
+#advances head to claim. Records from claim - capacity up to head are therefore never torn, and a
+#reader that copied a record knows it is intact if the record is still above claim - capacity after.
+MAGIC = b'KM003CS\x00'
+HEADER_STRUCT = struct.Struct('<8sHHIQQI')  # magic, record size, rate, capacity, head, claim, producer pid
+HEAD_OFFSET = 16
+CLAIM_OFFSET = 24
+DATA_OFFSET = 64
+
+class SharedRing:
+    """
+    Single producer ring of ADC queue records in a multiprocessing.shared_memory block.
+
+    write() takes AdcQueueBatch objects, so it can be passed as a stream callback or logger sink.
+    Readers in any process attach by name with SharedRingReader. Nothing waits for them: a reader
+    falling more than capacity records behind loses the overwritten ones.
+
+    A ring of the same name left behind by a producer that died without close() is replaced.
+    """
+
+    def __init__(self, capacity=1 << 20, rate: Rate = Rate._1KSPS, name=None):
+        self.capacity = capacity
+        self.rate = rate
+        size = DATA_OFFSET + capacity * RECORD_STRUCT.size
+        try:
+            self._shm = _open(name, True, size)
+        except FileExistsError:
+            _unlink_stale(name)
+            self._shm = _open(name, True, size)
+        HEADER_STRUCT.pack_into(self._shm.buf, 0, MAGIC, RECORD_STRUCT.size, rate, capacity, 0, 0, os.getpid())
+        self._data = self._shm.buf[DATA_OFFSET:]
+        self.head = 0
+
+    @property
+    def name(self):
+        return self._shm.name
+
+    def write(self, batch):
+        n = len(batch)
+        if not n:
+            return
+        data = batch_to_bytes(batch)
+        size = RECORD_STRUCT.size
+        if n > self.capacity:
+            data = data[(n - self.capacity) * size:]
+            self.head += n - self.capacity
+            n = self.capacity
+        slot = self.head % self.capacity
+        first = min(n, self.capacity - slot)
+        struct.pack_into('<Q', self._shm.buf, CLAIM_OFFSET, self.head + n)  # Claim the slots before the copy
+        self._data[slot * size:(slot + first) * size] = data[:first * size]
+        if first < n:
+            self._data[:(n - first) * size] = data[first * size:]
+        self.head += n
+        struct.pack_into('<Q', self._shm.buf, HEAD_OFFSET, self.head)  # Publish only after the records
+
+    def flush(self):
+        pass
+
+    def close(self):
+        """
+        Closes and removes the shared memory block. Attached readers keep their mapping until they close.
+        """
+        if self._shm is None:
+            return
+        self._data.release()
+        self._shm.close()
+        _unlink(self._shm)
+        self._shm = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+def _open(name, create=False, size=0):
+    """
+    Creates or attaches a shared memory block that the resource tracker leaves alone,
+    so neither a reader exiting nor a pool worker can unlink the ring under the producer.
+    """
+    try:
+        return shared_memory.SharedMemory(name, create, size, track=False)
+    except TypeError:
+        #Before Python 3.13 every SharedMemory registers with the tracker
+        shm = shared_memory.SharedMemory(name, create, size)
+        resource_tracker.unregister(shm._name, 'shared_memory')
+        return shm
+
+def _unlink(shm):
+    if not hasattr(shm, '_track'):
+        #Before Python 3.13 unlink() unregisters the block, which _open() already did
+        resource_tracker.register(shm._name, 'shared_memory')
+    shm.unlink()
+
+def _unlink_stale(name):
+    """
+    Removes the ring name if its producer is no longer running, otherwise raises FileExistsError.
+    """
+    shm = _open(name)
+    magic = pid = None
+    if shm.size >= HEADER_STRUCT.size:
+        magic, *_, pid = HEADER_STRUCT.unpack_from(shm.buf)
+    shm.close()
+    if magic != MAGIC:
+        raise FileExistsError(f'Shared memory block {name} exists and is not a KM003C sample ring')
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        print(f'Removing shared memory ring {name} left behind by process {pid}', file=sys.stderr)
+        _unlink(shm)
+        return
+    except PermissionError:
+        pass
+    raise FileExistsError(f'Shared memory ring {name} is in use by process {pid}')
+
+class SharedRingReader:
+    """
+    Attaches to a SharedRing by name, in the same or another process.
+
+    With numpy, batches are zero-copy column views into the shared block as long as they do not wrap
+    around the end of the ring, so they must be dropped before close(). The producer may overwrite them
+    at any time: check valid() with the first sequence number once done to know whether the results hold.
+    Batches that are copied, without numpy or across the end of the ring, are checked by batch() itself.
+    """
+
+    def __init__(self, name, start=None):
+        self._shm = _open(name)
+        magic, record_size, rate, capacity, head, _, _ = HEADER_STRUCT.unpack_from(self._shm.buf)
+        if magic != MAGIC or record_size != RECORD_STRUCT.size:
+            self._shm.close()
+            raise ValueError(f'{name} is not a KM003C sample ring')
+        self.name = name
+        self.rate = Rate(rate)
+        self.capacity = capacity
+        self.records = None
+        if np is not None:
+            self.records = np.ndarray(capacity, dtype=AdcQueueBatch.DTYPE, buffer=self._shm.buf, offset=DATA_OFFSET)
+        self.position = head if start is None else start  # Sequence number read() continues from
+        self.lost = 0
+
+    @property
+    def head(self):
+        return struct.unpack_from('<Q', self._shm.buf, HEAD_OFFSET)[0]
+
+    @property
+    def claim(self):
+        return struct.unpack_from('<Q', self._shm.buf, CLAIM_OFFSET)[0]
+
+    @property
+    def oldest(self):
+        """
+        Sequence number of the oldest record still in the ring and not being overwritten.
+        """
+        return max(0, self.claim - self.capacity)
+
+    def valid(self, sequence):
+        """
+        Returns whether the record with this sequence number has not been overwritten yet, nor is being
+        overwritten, so anything read of it before this call is intact.
+        """
+        return sequence >= self.claim - self.capacity
+
+    def batch(self, start, stop):
+        """
+        Returns the records with sequence numbers start to stop as a batch.
+        """
+        head = self.head
+        oldest = self.oldest
+        if start < oldest or stop > head or start > stop:
+            raise IndexError(f'Records {start}-{stop} are not in the ring ({oldest}-{head})')
+        first, last = start % self.capacity, (stop - 1) % self.capacity + 1
+        if self.records is not None:
+            if start == stop or first < last:
+                return AdcQueueBatch.from_records(self.records[first:first + stop - start])
+            records = np.concatenate((self.records[first:], self.records[:last]))
+        else:
+            size = RECORD_STRUCT.size
+            data = self._shm.buf[DATA_OFFSET:]
+            try:
+                if start == stop or first < last:
+                    records = bytes(data[first * size:(first + stop - start) * size])
+                else:
+                    records = bytes(data[first * size:]) + bytes(data[:last * size])
+            finally:
+                data.release()
+        if not self.valid(start):
+            raise IndexError(f'Records {start}-{stop} were overwritten while being copied')
+        if self.records is not None:
+            return AdcQueueBatch.from_records(records)
+        return AdcQueueBatch.from_bytes(records, stop - start)
+
+    def read(self, max_records=None):
+        """
+        Returns the records written since the previous read, up to max_records and the end of the
+        ring so the batch is never a copy, or None if there is nothing new. Records overwritten
+        before they were read are skipped and counted in lost.
+        """
+        while True:
+            head = self.head
+            oldest = self.oldest
+            if self.position < oldest:
+                self.lost += oldest - self.position
+                self.position = oldest
+            stop = min(head, self.position + self.capacity - self.position % self.capacity)
+            if max_records is not None:
+                stop = min(stop, self.position + max_records)
+            if stop <= self.position:
+                return None
+            try:
+                batch = self.batch(self.position, stop)
+            except IndexError:
+                continue  # Overtaken by the producer, skip ahead to what is left
+            self.position = stop
+            return batch
+
+    def close(self):
+        self.records = None
+        self._shm.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+_readers = {}
+
+def attach(name):
+    """
+    Returns a SharedRingReader for name that is kept open for the life of the process,
+    so pool workers map each ring once however many tasks they run.
+    """
+    reader = _readers.get(name)
+    if reader is None:
+        reader = _readers[name] = SharedRingReader(name)
+    return reader
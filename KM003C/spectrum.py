@@ -0,0 +1,162 @@
+from .defs import *
+from collections import deque
+import csv
+
+#Columns that can be analyzed, with the unit and scale of the results
+COLUMN_UNITS = {'vbus': ('V', 1e-6), 'ibus': ('A', 1e-6)}
+RESULT_FIELDS = ('mean', 'pp', 'rms', 'peak_hz', 'peak')
+
+class RippleAnalyzer:
+    """
+    Streaming ripple and spectrum analysis of vbus and ibus over overlapping windows.
+
+    Batches are appended to a buffer holding less than one window plus a batch. Every complete
+    window of window samples, advanced by window * (1 - overlap) samples, is Hann tapered and
+    transformed in one vectorized rfft per batch. For each window and column the result holds the
+    mean, the ripple peak-to-peak and AC RMS, and the frequency and amplitude of the strongest
+    spectral line at or above min_hz, interpolated between FFT bins.
+
+    Timestamp gaps are not filled in, so windows spanning lost samples are slightly distorted.
+    Requires numpy. It has the write/flush/close interface of the writers, and with path every
+    result is written as a CSV row.
+    """
+
+    def __init__(self, rate: Rate, window=1024, overlap=0.5, columns=('vbus', 'ibus'), min_hz=0.0, path=None,
+                 history=1024):
+        if np is None:
+            raise RuntimeError('Ripple analysis requires numpy')
+        for column in columns:
+            if column not in COLUMN_UNITS:
+                raise ValueError(f'Unknown column {column}')
+        if not 0 <= overlap < 1:
+            raise ValueError('overlap must be in [0, 1)')
+        if window < 4:
+            raise ValueError('window must hold at least 4 samples')
+        self.sps = RATE_SPS[rate]
+        if min_hz >= self.sps / 2:
+            raise ValueError(f'min_hz {min_hz} must be below the Nyquist frequency of {self.sps / 2} Hz at {Rate(rate).name}')
+        self.window = window
+        self.hop = max(1, int(round(window * (1 - overlap))))
+        self.columns = tuple(columns)
+        self.frequencies = np.fft.rfftfreq(window, 1 / self.sps)
+        self._first_bin = max(1, int(np.searchsorted(self.frequencies, min_hz)))
+        self._taper = np.hanning(window)
+        self._scale = np.array([COLUMN_UNITS[column][1] for column in self.columns])
+        self._timestamps = np.empty(0, dtype=np.uint32)
+        self._values = np.empty((len(self.columns), 0))
+        self.results = deque(maxlen=history)  # Most recent results, oldest first
+        self.spectrum = None                    # Amplitude spectrum of the last window per column, in V or A
+        self.windows = 0
+        self._file = None
+        if path is not None:
+            self._file = open(path, 'w', newline='')
+            self._writer = csv.writer(self._file)
+            self._writer.writerow(['timestamp_ms'] + [
+                f'{column}_peak_Hz' if field == 'peak_hz' else f'{column}_{field}_{COLUMN_UNITS[column][0]}'
+                for column in self.columns for field in RESULT_FIELDS])
+
+    @property
+    def latest(self):
+        return self.results[-1] if self.results else None
+
+    def update(self, batch):
+        """
+        Adds a batch and returns the results of the windows it completed.
+        """
+        if not len(batch):
+            return []
+        values = np.stack([np.asarray(getattr(batch, column), dtype=np.float64) for column in self.columns])
+        self._timestamps = np.concatenate((self._timestamps, np.asarray(batch.timestamp_ms, dtype=np.uint32)))
+        self._values = np.concatenate((self._values, values), axis=1)
+        available = self._values.shape[1]
+        if available < self.window:
+            return []
+
+        count = (available - self.window) // self.hop + 1
+        frames = np.lib.stride_tricks.sliding_window_view(self._values, self.window, axis=1)[:, :count * self.hop:self.hop]
+        starts = self._timestamps[:count * self.hop:self.hop]
+        results = self._analyze(frames, starts)
+        #Copies, so the consumed samples are released
+        self._values = self._values[:, count * self.hop:].copy()
+        self._timestamps = self._timestamps[count * self.hop:].copy()
+        return results
+
+    def _analyze(self, frames, starts):
+        """
+        Analyzes frames of shape (columns, windows, window) starting at the timestamps starts.
+        """
+        scale = self._scale[:, None]
+        means = frames.mean(axis=2)
+        ac = frames - means[..., None]
+        pp = frames.max(axis=2) - frames.min(axis=2)
+        rms = np.sqrt(np.mean(ac * ac, axis=2))
+        #Single sided amplitude of a sine, corrected for the coherent gain of the taper
+        amplitudes = np.abs(np.fft.rfft(ac * self._taper, axis=2)) * (2 / self._taper.sum())
+
+        bins = amplitudes.shape[2]
+        if self._first_bin >= bins:
+            #No bin at or above min_hz, so there is no peak to report
+            peak = np.full(amplitudes.shape[:2], -1)
+        else:
+            peak = amplitudes[..., self._first_bin:].argmax(axis=2) + self._first_bin
+        k = np.clip(peak, 1, bins - 2)
+        a = np.take_along_axis(amplitudes, (k - 1)[..., None], axis=2)[..., 0]
+        b = np.take_along_axis(amplitudes, k[..., None], axis=2)[..., 0]
+        c = np.take_along_axis(amplitudes, (k + 1)[..., None], axis=2)[..., 0]
+        #Parabolic interpolation of the peak between its neighbouring bins
+        denominator = a - 2 * b + c
+        delta = np.divide(0.5 * (a - c), denominator, out=np.zeros_like(b), where=denominator != 0)
+        delta = np.where(peak == k, np.clip(delta, -0.5, 0.5), 0.0)
+        peak_hz = np.where(peak >= 0, (k + delta) * self.sps / self.window, np.nan)
+        peak_amplitude = np.where(peak >= 0, b - 0.25 * (a - c) * delta, np.nan)
+
+        means, pp, rms, peak_amplitude = means * scale, pp * scale, rms * scale, peak_amplitude * scale
+        self.spectrum = {column: amplitudes[i, -1] * self._scale[i] for i, column in enumerate(self.columns)}
+        results = []
+        for w in range(frames.shape[1]):
+            result = {'timestamp_ms': int(starts[w])}
+            for i, column in enumerate(self.columns):
+                result[column] = {
+                    'mean': float(means[i, w]),
+                    'pp': float(pp[i, w]),
+                    'rms': float(rms[i, w]),
+                    'peak_hz': float(peak_hz[i, w]),
+                    'peak': float(peak_amplitude[i, w]),
+                }
+            results.append(result)
+            if self._file is not None:
+                self._writer.writerow([result['timestamp_ms']] + [
+                    f'{result[column][field]:.6g}' for column in self.columns for field in RESULT_FIELDS])
+        self.results.extend(results)
+        self.windows += len(results)
+        return results
+
+    def write(self, batch):
+        self.update(batch)
+
+    def flush(self):
+        if self._file is not None:
+            self._file.flush()
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+def format_result(result):
+    """
+    Returns a one line summary of an analysis result.
+    """
+    parts = []
+    for column, (unit, _) in COLUMN_UNITS.items():
+        if column in result:
+            r = result[column]
+            parts.append(f"{column} ripple {1000 * r['pp']:.2f} m{unit}pp / {1000 * r['rms']:.2f} m{unit}rms, "
+                         f"peak {r['peak_hz']:.1f} Hz at {1000 * r['peak']:.2f} m{unit}")
+    return '; '.join(parts)
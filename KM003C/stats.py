@@ -0,0 +1,120 @@
+import math
+from .defs import *
+
+class MeasurementStats:
+    """
+    Streaming min/max/mean/RMS of vbus and ibus plus energy and charge integration.
+
+    Batches are folded in with O(1) work per sample, vectorized per batch when numpy is available.
+    Power and current are integrated with the trapezoidal rule over the device timestamp_ms,
+    whose uint32 rollover is handled by taking every step modulo 2**32.
+    """
+
+    def __init__(self):
+        self.samples = 0
+        self.duration_ms = 0
+        self.energy_uj = 0.0         # Integrated vbus * ibus in µJ
+        self.charge_uc = 0.0         # Integrated ibus in µC
+        self._sums = {'vbus': [0.0, 0.0], 'ibus': [0.0, 0.0]}  # sum, sum of squares
+        self._min = {'vbus': None, 'ibus': None}
+        self._max = {'vbus': None, 'ibus': None}
+        self._last = None            # (timestamp_ms, power in W, ibus in A) of the previous sample
+
+    def update(self, batch):
+        n = len(batch)
+        if not n:
+            return
+        if np is not None:
+            self._update_numpy(batch)
+        else:
+            self._update_python(batch)
+        self.samples += n
+
+    def _fold(self, name, total, squares, low, high):
+        sums = self._sums[name]
+        sums[0] += total
+        sums[1] += squares
+        if self._min[name] is None or low < self._min[name]:
+            self._min[name] = low
+        if self._max[name] is None or high > self._max[name]:
+            self._max[name] = high
+
+    def _update_numpy(self, batch):
+        timestamps = np.asarray(batch.timestamp_ms, dtype=np.uint32)
+        vbus = np.asarray(batch.vbus, dtype=np.float64)
+        ibus = np.asarray(batch.ibus, dtype=np.float64)
+        for name, column in (('vbus', vbus), ('ibus', ibus)):
+            self._fold(name, float(column.sum()), float(np.dot(column, column)), int(column.min()), int(column.max()))
+
+        power = vbus * ibus * 1e-12  # µV * µA in W
+        current = ibus * 1e-6
+        #uint32 subtraction wraps around, which is exactly the step across a rollover
+        steps = np.diff(timestamps).astype(np.float64)
+        energy = float(np.dot(steps, power[1:] + power[:-1])) / 2
+        charge = float(np.dot(steps, current[1:] + current[:-1])) / 2
+        duration = float(steps.sum())
+        if self._last is not None:
+            step = (int(timestamps[0]) - self._last[0]) & 0xFFFFFFFF
+            energy += step * (self._last[1] + float(power[0])) / 2
+            charge += step * (self._last[2] + float(current[0])) / 2
+            duration += step
+        self.energy_uj += energy * 1e3   # W * ms in µJ
+        self.charge_uc += charge * 1e3   # A * ms in µC
+        self.duration_ms += int(duration)
+        self._last = (int(timestamps[-1]), float(power[-1]), float(current[-1]))
+
+    def _update_python(self, batch):
+        timestamps, vbus, ibus = batch.timestamp_ms, batch.vbus, batch.ibus
+        for name, column in (('vbus', vbus), ('ibus', ibus)):
+            self._fold(name, float(sum(column)), float(sum(v * v for v in column)), min(column), max(column))
+
+        last = self._last
+        energy = charge = 0.0
+        duration = 0
+        for timestamp, v, i in zip(timestamps, vbus, ibus):
+            power = v * i * 1e-12
+            current = i * 1e-6
+            if last is not None:
+                step = (timestamp - last[0]) & 0xFFFFFFFF
+                energy += step * (last[1] + power) / 2
+                charge += step * (last[2] + current) / 2
+                duration += step
+            last = (timestamp, power, current)
+        self.energy_uj += energy * 1e3
+        self.charge_uc += charge * 1e3
+        self.duration_ms += duration
+        self._last = last
+
+    def snapshot(self):
+        """
+        Returns the statistics in V, A, Wh and mAh as a dict.
+        """
+        result = {
+            'samples': self.samples,
+            'duration_s': self.duration_ms / 1000,
+            'energy_Wh': self.energy_uj / 3.6e9,
+            'charge_mAh': self.charge_uc / 3.6e6,
+        }
+        for name in ('vbus', 'ibus'):
+            unit = 'V' if name == 'vbus' else 'A'
+            total, squares = self._sums[name]
+            count = self.samples or 1
+            result[f'{name}_min_{unit}'] = self._min[name] * 1e-6 if self._min[name] is not None else None
+            result[f'{name}_max_{unit}'] = self._max[name] * 1e-6 if self._max[name] is not None else None
+            result[f'{name}_mean_{unit}'] = total / count * 1e-6
+            result[f'{name}_rms_{unit}'] = math.sqrt(squares / count) * 1e-6
+        return result
+
+    def __str__(self):
+        """
+        Returns a one line summary of the statistics.
+        """
+        s = self.snapshot()
+        if not s['samples']:
+            return 'No samples'
+        return (
+            f"{s['samples']} samples over {s['duration_s']:.1f} s: "
+            f"{s['energy_Wh']:.6f} Wh, {s['charge_mAh']:.4f} mAh, "
+            f"Vbus {s['vbus_min_V']:.4f}/{s['vbus_mean_V']:.4f}/{s['vbus_max_V']:.4f} V (rms {s['vbus_rms_V']:.4f}), "
+            f"Ibus {s['ibus_min_A']:.4f}/{s['ibus_mean_A']:.4f}/{s['ibus_max_A']:.4f} A (rms {s['ibus_rms_A']:.4f})"
+        )
@@ -0,0 +1,240 @@
+from .defs import *
+from collections import deque
+import csv
+
+class Condition:
+    """
+    Base of the trigger conditions. Calling a condition with a batch returns the indices of
+    the samples it fires on. Conditions keep the last sample of the previous batch, so edges
+    across batch boundaries are caught.
+    """
+    name = 'condition'
+
+    def __init__(self, column):
+        if column not in AdcQueueBatch.COLUMNS:
+            raise ValueError(f'Unknown column {column}')
+        self.column = column
+        self._last = None  # (timestamp_ms, value) of the previous sample
+
+    def _with_previous(self, batch):
+        """
+        Returns the timestamps and values of the batch, each preceded by the previous sample.
+        """
+        timestamps, values = batch.timestamp_ms, getattr(batch, self.column)
+        last = self._last if self._last is not None else (int(timestamps[0]), int(values[0]))
+        self._last = (int(timestamps[-1]), int(values[-1]))
+        if np is not None:
+            return (np.concatenate(([last[0]], np.asarray(timestamps, dtype=np.uint32))).astype(np.uint32),
+                    np.concatenate(([last[1]], np.asarray(values, dtype=np.int64))))
+        return [last[0]] + list(timestamps), [last[1]] + list(values)
+
+    def __call__(self, batch, period_ms):
+        if not len(batch):
+            return []
+        timestamps, values = self._with_previous(batch)
+        if np is not None:
+            return np.flatnonzero(self._fire_numpy(timestamps, values, period_ms)).tolist()
+        return [i for i in range(len(batch)) if self._fire(timestamps, values, i + 1, period_ms)]
+
+    def __str__(self):
+        return self.name
+
+class Threshold(Condition):
+    """
+    Fires when column crosses level, upwards with rising or downwards otherwise.
+    """
+
+    def __init__(self, column, level, rising=True):
+        super().__init__(column)
+        self.level = level
+        self.rising = rising
+        self.name = f"{column} {'>' if rising else '<'} {level}"
+
+    def _fire_numpy(self, timestamps, values, period_ms):
+        if self.rising:
+            return (values[:-1] < self.level) & (values[1:] >= self.level)
+        return (values[:-1] > self.level) & (values[1:] <= self.level)
+
+    def _fire(self, timestamps, values, i, period_ms):
+        if self.rising:
+            return values[i - 1] < self.level <= values[i]
+        return values[i - 1] > self.level >= values[i]
+
+class Slope(Condition):
+    """
+    Fires on every sample where column changes by at least limit per ms, in either direction.
+    At 10KSPS timestamps only have 1 ms resolution, so the nominal sample period is used instead.
+    """
+
+    def __init__(self, column, limit):
+        super().__init__(column)
+        self.limit = limit
+        self.name = f'|d{column}/dt| >= {limit}/ms'
+
+    def _fire_numpy(self, timestamps, values, period_ms):
+        if period_ms < 1:
+            dt = period_ms
+        else:
+            dt = np.maximum(np.diff(timestamps).astype(np.float64), period_ms)  # uint32 diff wraps with the rollover
+        return np.abs(np.diff(values)) >= self.limit * dt
+
+    def _fire(self, timestamps, values, i, period_ms):
+        dt = period_ms if period_ms < 1 else max((timestamps[i] - timestamps[i - 1]) & 0xFFFFFFFF, period_ms)
+        return abs(values[i] - values[i - 1]) >= self.limit * dt
+
+class Change(Condition):
+    """
+    Fires when column differs from the previous sample by at least delta, e.g. vdp or vdm
+    moving when a charger negotiates BC1.2, QC or another protocol over the data lines.
+    """
+
+    def __init__(self, column, delta):
+        super().__init__(column)
+        self.delta = delta
+        self.name = f'|{column} change| >= {delta}'
+
+    def _fire_numpy(self, timestamps, values, period_ms):
+        return np.abs(np.diff(values)) >= self.delta
+
+    def _fire(self, timestamps, values, i, period_ms):
+        return abs(values[i] - values[i - 1]) >= self.delta
+
+class TriggerEngine:
+    """
+    Writes only the samples around trigger events to writer.
+
+    Every batch is checked against conditions. Up to pre_s seconds of samples are held in a
+    bounded pre-trigger ring, and a trigger writes them followed by everything up to post_s
+    seconds after the last trigger, so triggers within a window extend it. Once a window
+    closes, triggers are ignored for holdoff_s seconds.
+
+    It has the write/flush/close interface of the other writers, so it can wrap one of them.
+    With events_path, every window is listed in a CSV file with its first trigger.
+    """
+
+    def __init__(self, writer, rate: Rate, conditions, pre_s=1.0, post_s=2.0, holdoff_s=0.0, events_path=None):
+        sps = RATE_SPS[rate]
+        self.writer = writer
+        self.conditions = list(conditions)
+        self.period_ms = 1000 / sps
+        self.pre_samples = int(pre_s * sps)
+        self.post_samples = max(1, int(post_s * sps))
+        self.holdoff_samples = int(holdoff_s * sps)
+        self._pre = deque()
+        self._pre_count = 0
+        self._remaining = 0   # Samples still to be written in the open window
+        self._holdoff = 0     # Samples still to be ignored after the last window
+        self._window = None   # [first trigger timestamp, condition, window start timestamp, samples, triggers]
+        self._last_written = None
+        self.windows = 0
+        self.triggers = 0
+        self.samples_written = 0
+        self._events = None
+        if events_path is not None:
+            self._events_file = open(events_path, 'w', newline='')
+            self._events = csv.writer(self._events_file)
+            self._events.writerow(['trigger_ms', 'condition', 'start_ms', 'end_ms', 'samples', 'triggers'])
+
+    def _fires(self, batch):
+        fires = {}
+        for condition in self.conditions:
+            for index in condition(batch, self.period_ms):
+                fires.setdefault(index, condition)
+        return sorted(fires.items())
+
+    def _push_pre(self, batch):
+        if not self.pre_samples or not len(batch):
+            return
+        self._pre.append(batch)
+        self._pre_count += len(batch)
+        while self._pre_count - len(self._pre[0]) >= self.pre_samples:
+            self._pre_count -= len(self._pre.popleft())
+
+    def _emit(self, batch):
+        if not len(batch):
+            return
+        if self._window[2] is None:
+            self._window[2] = int(batch.timestamp_ms[0])
+        self._window[3] += len(batch)
+        self._last_written = int(batch.timestamp_ms[-1])
+        self.samples_written += len(batch)
+        self.writer.write(batch)
+
+    def _open(self, batch, index, condition):
+        self.windows += 1
+        self.triggers += 1
+        self._window = [int(batch.timestamp_ms[index]), condition, None, 0, 1]
+        skip = self._pre_count - self.pre_samples
+        for pre in self._pre:
+            if skip >= len(pre):
+                skip -= len(pre)
+                continue
+            self._emit(pre[max(skip, 0):])
+            skip = 0
+        self._pre.clear()
+        self._pre_count = 0
+        self._remaining = self.post_samples
+
+    def _close(self):
+        trigger, condition, start, samples, triggers = self._window
+        if self._events is not None:
+            self._events.writerow([trigger, str(condition), start, self._last_written, samples, triggers])
+        self._window = None
+        self._holdoff = self.holdoff_samples
+
+    def write(self, batch):
+        n = len(batch)
+        fires = self._fires(batch) if n else []
+        position = 0
+        next_fire = 0
+        while position < n:
+            if self._remaining:
+                end = position + self._remaining
+                while next_fire < len(fires) and fires[next_fire][0] < end:
+                    if fires[next_fire][0] >= position:
+                        end = fires[next_fire][0] + self.post_samples
+                        self._window[4] += 1
+                        self.triggers += 1
+                    next_fire += 1
+                stop = min(end, n)
+                self._emit(batch[position:stop])
+                self._remaining = end - stop
+                position = stop
+                if not self._remaining:
+                    self._close()
+                continue
+
+            armed = position + min(self._holdoff, n - position)
+            self._holdoff -= armed - position
+            while next_fire < len(fires) and fires[next_fire][0] < armed:
+                next_fire += 1
+            if next_fire == len(fires):
+                self._push_pre(batch[position:])
+                return
+            index, condition = fires[next_fire]
+            self._push_pre(batch[position:index])
+            self._open(batch, index, condition)
+            position = index
+            next_fire += 1
+
+    def flush(self):
+        self.writer.flush()
+        if self._events is not None:
+            self._events_file.flush()
+
+    def close(self):
+        """
+        Closes an open window early and closes the wrapped writer.
+        """
+        if self._window is not None:
+            self._close()
+        if self._events is not None:
+            self._events_file.close()
+            self._events = None
+        self.writer.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
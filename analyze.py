@@ -1,12 +1,14 @@
 #!/bin/env python3
 
 from KM003C.defs import *
-import pyshark
+from KM003C.pcapng import usb_frames
+import argparse
+import struct
+import time
 
 #Wireshark filter:
 #usb.device_address > 4 && !(usb.urb_type == 'S' && usb.endpoint_address.direction == IN) && !(usb.urb_type == 'C' && usb.endpoint_address.direction == OUT) && usb.endpoint_address.number == 1
-
-cap = pyshark.FileCapture("capture.pcapng")
+#usb_frames applies the same filter while reading the capture
 
 def interpret_response(data):
     header = MsgHeader.from_bytes(data[:4])
@@ -28,22 +30,97 @@ def interpret_response(data):
 
     return header
 
-extend = False
-for packet in cap:
-    if 'USB' in packet:
-        usb = packet.usb
+def type_name(type):
+    #Data message types start at 64, like in MsgHeader
+    return enum_name(CmdDataMsgType if type > 63 else CmdCtrlMsgType, type)
 
-        if not hasattr(packet, 'data'):
-            continue
-        data = bytes.fromhex(packet.data.usb_capdata.replace(":", ""))
-        print(usb.endpoint_address_number, 'IN' if usb.endpoint_address_direction == '1' else 'OUT', f'SIZE={len(data)}')
-        if extend:
+def dump(frames):
+    extend = set()  # (bus, device, direction) of the frames waiting for their extended continuation
+    for timestamp, bus, device, endpoint, direction, data in frames:
+        print(endpoint & 0x7f, direction, f'SIZE={len(data)}')
+        key = (bus, device, direction)
+        if key in extend:
             print('extended')
             print("-" * 30)
-            extend = False
+            extend.discard(key)
             continue
-        #print(repr(data))
 
-        extend = interpret_response(data).extend
+        if interpret_response(data).extend:
+            extend.add(key)
+
+        print("-" * 30)
+
+def summarize(frames):
+    """
+    Decodes every response with parse_data and prints message, attribute and sample statistics.
+    """
+    start = time.perf_counter()
+    counts = {}
+    attributes = {}
+    frame_count = bytes_count = samples = errors = 0
+    first = last = None
+    pending = {}  # PUT_DATA waiting for its extended continuation, by bus and device
+
+    def decode(header, payload):
+        nonlocal samples, errors
+        try:
+            for att, obj in parse_data(payload):
+                attributes[att] = attributes.get(att, 0) + 1
+                if att in (AttributeDataType.ATT_ADC_QUEUE, AttributeDataType.ATT_ADC_QUEUE_10K):
+                    samples += len(obj)
+        except (ValueError, struct.error):
+            errors += 1
+
+    for timestamp, bus, device, endpoint, direction, data in frames:
+        frame_count += 1
+        bytes_count += len(data)
+        if timestamp is not None:
+            first = timestamp if first is None else first
+            last = timestamp
+        if direction == 'IN' and (bus, device) in pending:
+            header, payload = pending.pop((bus, device))
+            decode(header, payload + data)
+            continue
+        if len(data) < 4:
+            errors += 1
+            continue
+        header = MsgHeader.from_bytes(data[:4])
+        key = (direction, type_name(header.type))
+        counts[key] = counts.get(key, 0) + 1
+        if direction == 'IN' and header.type == CmdDataMsgType.CMD_PUT_DATA:
+            if header.extend:
+                pending[(bus, device)] = (header, data[4:])
+            else:
+                decode(header, data[4:])
+
+    elapsed = time.perf_counter() - start
+    duration = last - first if first is not None else 0.0
+    print(f'{frame_count} frames, {bytes_count} bytes, capture span {duration:.3f} s')
+    for (direction, name), count in sorted(counts.items()):
+        print(f'  {direction:3} {name:20} {count}')
+    print('Segments:')
+    for att, count in sorted(attributes.items()):
+        print(f'  {enum_name(AttributeDataType, att):20} {count}')
+    print(f'Samples: {samples}' + (f' ({samples / duration:.1f} SPS)' if duration > 0 else ''))
+    if errors:
+        print(f'Undecodable frames: {errors}')
+    print(f'Decoded in {elapsed:.3f} s ({frame_count / elapsed if elapsed > 0 else 0:.0f} frames/s)')
+
+def main():
+    parser = argparse.ArgumentParser(description="Decode KM003C traffic from a usbmon or USBPcap capture")
+    parser.add_argument('capture', type=str, nargs='?', default='capture.pcapng',
+                        help="pcapng or pcap capture file (default: capture.pcapng).")
+    parser.add_argument('--summary', '-s', action='store_true',
+                        help="Print message, segment and sample statistics instead of every frame.")
+    parser.add_argument('--device', '-d', type=int, default=None,
+                        help="Only decode this USB device address (default: every address above 4).")
+
+    args = parser.parse_args()
+    frames = usb_frames(args.capture, device=args.device)
+    if args.summary:
+        summarize(frames)
+    else:
+        dump(frames)
 
-        print("-" * 30)
\ No newline at end of file
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,316 @@
+#!/bin/env python3
+
+from KM003C import *
+from KM003C.emulator import EmulatedKM003C
+from KM003C.export import TextExportWriter, format_csv
+from KM003C.archive import Archive, ArchiveWriter
+import legacy_codec
+import argparse
+import csv
+import io
+import math
+import random
+import json
+import os
+import struct
+import sys
+import tempfile
+import threading
+import time
+import timeit
+import tracemalloc
+
+BASELINES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baselines.json')
+
+#Direction of every metric: True when higher is better
+HIGHER_IS_BETTER = {
+    'parse_samples_per_s': True,
+    'send_latency_p50_us': False,
+    'send_latency_p90_us': False,
+    'send_latency_p99_us': False,
+    'logger_samples_per_s': True,
+    'header_decode_ns': False,
+    'segment_header_decode_ns': False,
+    'adc_decode_ns': False,
+    'entry_decode_ns': False,
+    'command_encode_ns': False,
+    'adc_object_bytes': False,
+    'entry_object_bytes': False,
+    'legacy_header_decode_ns': False,
+    'legacy_segment_header_decode_ns': False,
+    'legacy_adc_decode_ns': False,
+    'legacy_entry_decode_ns': False,
+    'legacy_command_encode_ns': False,
+    'legacy_adc_object_bytes': False,
+    'legacy_entry_object_bytes': False,
+    'archive_csv_ratio': True,
+    'archive_decode_samples_per_s': True,
+    'csv_parse_samples_per_s': True,
+}
+
+#Baselines are stored relative to calibration_ns(), measured in the same run, so they hold on faster and
+#slower machines alike. Every metric is multiplied by the calibration time to this power: -1 for times,
+#1 for rates and 0 for sizes and ratios, which do not depend on the speed of the machine.
+CALIBRATION_POWER = {
+    'parse_samples_per_s': 1,
+    'send_latency_p50_us': -1,
+    'send_latency_p90_us': -1,
+    'send_latency_p99_us': -1,
+    'logger_samples_per_s': 1,
+    'header_decode_ns': -1,
+    'segment_header_decode_ns': -1,
+    'adc_decode_ns': -1,
+    'entry_decode_ns': -1,
+    'command_encode_ns': -1,
+    'adc_object_bytes': 0,
+    'entry_object_bytes': 0,
+    'legacy_header_decode_ns': -1,
+    'legacy_segment_header_decode_ns': -1,
+    'legacy_adc_decode_ns': -1,
+    'legacy_entry_decode_ns': -1,
+    'legacy_command_encode_ns': -1,
+    'legacy_adc_object_bytes': 0,
+    'legacy_entry_object_bytes': 0,
+    'archive_csv_ratio': 0,
+    'archive_decode_samples_per_s': 1,
+    'csv_parse_samples_per_s': 1,
+}
+
+def queue_frame(count=QUEUE_CHUNK_MAX):
+    """
+    Returns the PUT_DATA payload of a full ADC_QUEUE chunk as the meter sends it.
+    """
+    dev = EmulatedKM003C(free_run=True, chunk=count)
+    meter = PowerZ_KM003C(dev)
+    meter.set_rate(Rate._1KSPS)
+    dev.write(meter.out_endpoint, command_frame(CmdCtrlMsgType.CMD_GET_DATA, 0, AttributeDataType.ATT_ADC_QUEUE))
+    return bytes(dev.read(meter.in_endpoint, RX_BUFFER_SIZE))[4:]
+
+def bench_parse(duration):
+    data = queue_frame()
+    samples = 0
+    start = time.perf_counter()
+    while time.perf_counter() - start < duration:
+        for _ in range(100):
+            samples += len(parse_data(data)[0][1])
+    return {'parse_samples_per_s': samples / (time.perf_counter() - start)}
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(p / 100 * len(values)))]
+
+def bench_send(duration):
+    meter = PowerZ_KM003C(EmulatedKM003C(free_run=True))
+    meter.set_rate(Rate._1KSPS)
+    latencies = []
+    start = time.perf_counter()
+    while time.perf_counter() - start < duration:
+        t = time.perf_counter()
+        meter.get_data()
+        latencies.append(1e6 * (time.perf_counter() - t))
+    meter.close()
+    return {f'send_latency_p{p}_us': percentile(latencies, p) for p in (50, 90, 99)}
+
+def bench_logger(duration):
+    meter = PowerZ_KM003C(EmulatedKM003C(free_run=True))
+    meter.start_stream(Rate._1KSPS, interval=0)
+    timer = threading.Timer(duration, meter.stop_stream)
+    samples = 0
+    with tempfile.TemporaryDirectory() as tmp:
+        start = time.perf_counter()
+        with TextExportWriter(os.path.join(tmp, 'bench.csv')) as writer:
+            timer.start()
+            for batch in meter.iter_stream():
+                writer.write(batch)
+                samples += len(batch)
+        elapsed = time.perf_counter() - start
+    timer.join()
+    meter.close()
+    return {'logger_samples_per_s': samples / elapsed}
+
+def per_call_ns(function, duration):
+    """
+    Returns the best time of function in ns over repeats of about a tenth of duration.
+    """
+    timer = timeit.Timer(function)
+    number, elapsed = timer.autorange()
+    number = max(1, int(number * duration / 10 / max(elapsed, 1e-9)))
+    return 1e9 * min(timer.repeat(5, number)) / number
+
+def paired_ns(functions, duration, repeats=15):
+    """
+    Returns the best time in ns of each of functions, timed in alternating repeats so that
+    they all see the same disturbances of the machine.
+    """
+    timers = [timeit.Timer(function) for function in functions]
+    numbers = []
+    for timer in timers:
+        number, elapsed = timer.autorange()
+        numbers.append(max(1, int(number * duration / (2 * repeats) / max(elapsed, 1e-9))))
+    best = [float('inf')] * len(timers)
+    for _ in range(repeats):
+        for i, (timer, number) in enumerate(zip(timers, numbers)):
+            best[i] = min(best[i], timer.timeit(number) / number)
+    return [1e9 * t for t in best]
+
+def allocated_bytes(make, count=10000):
+    """
+    Returns the memory allocated per object by make(), including the int objects of its fields.
+    """
+    tracemalloc.start()
+    objects = [make() for _ in range(count)]
+    size = tracemalloc.get_traced_memory()[0] - sys.getsizeof(objects)
+    tracemalloc.stop()
+    return size / count
+
+def calibration_ns(duration):
+    """
+    Returns the time in ns of a fixed pure Python workload of struct unpacking, integer arithmetic and
+    attribute access, the unit the timing baselines are stored in.
+    """
+    record = struct.Struct('<I2i4H')
+    data = bytes(20 * 50)
+    def work():
+        total = 0
+        for offset in range(0, len(data), record.size):
+            timestamp, vbus, ibus, vcc1, vcc2, vdp, vdm = record.unpack_from(data, offset)
+            total += timestamp + vbus * ibus + vdp - vdm
+        return total
+    return per_call_ns(work, duration)
+
+def bench_codec(duration):
+    """
+    Per message cost of the protocol codec: decoding every message type, encoding a command frame,
+    and the memory held by decoded objects. The same is measured for the codec of legacy_codec, with
+    format strings and dict backed objects, under legacy_ names.
+    """
+    header = MsgHeader(CmdDataMsgType.CMD_PUT_DATA, 0, 7, obj=130).to_bytes()
+    segment_header = MsgHeaderHeader(AttributeDataType.ATT_ADC, 0, 0, 40).to_bytes()
+    adc = bytes(memoryview(EmulatedKM003C()._adc_data()))
+    entry = queue_frame(1)[4:24]
+    codecs = (('', sys.modules[__name__]), ('legacy_', legacy_codec))
+    calls = {
+        'header_decode_ns': lambda codec: lambda: codec.MsgHeader.from_bytes(header),
+        'segment_header_decode_ns': lambda codec: lambda: codec.MsgHeaderHeader.from_bytes(segment_header),
+        'adc_decode_ns': lambda codec: lambda: codec.AdcData.from_bytes(adc),
+        'entry_decode_ns': lambda codec: lambda: codec.AdcQueueEntry.from_bytes(entry),
+        'command_encode_ns': lambda codec: lambda: codec.command_frame(CmdCtrlMsgType.CMD_GET_DATA, 9,
+                                                                       AttributeDataType.ATT_ADC_QUEUE),
+    }
+    results = {}
+    for name, call in calls.items():
+        times = paired_ns([call(codec) for _, codec in codecs], duration)
+        results.update({prefix + name: t for (prefix, _), t in zip(codecs, times)})
+    for prefix, codec in codecs:
+        results[prefix + 'adc_object_bytes'] = allocated_bytes(lambda: codec.AdcData.from_bytes(adc))
+        results[prefix + 'entry_object_bytes'] = allocated_bytes(lambda: codec.AdcQueueEntry.from_bytes(entry))
+    return results
+
+def print_codec_gain(results):
+    """
+    Prints the cost of every codec metric before and after precompiled structs and slots.
+    """
+    print('Codec, legacy -> current:')
+    for name, value in results.items():
+        legacy = results.get('legacy_' + name)
+        if legacy is not None:
+            print(f'  {name:24} {legacy:10.1f} -> {value:10.1f}  x{legacy / value:.2f}')
+
+def synthetic_batch(count, seed=0):
+    """
+    Returns count 1 kSPS samples of a 5 V supply with 120 Hz ripple and a stepping load, with fresh
+    noise on every sample, unlike the emulator which repeats one load cycle.
+    """
+    rng = random.Random(seed)
+    entries = []
+    for n in range(count):
+        vbus = 5000000 + int(20000 * math.sin(2 * math.pi * 120 * n / 1000)) + int(rng.gauss(0, 500))
+        ibus = (500000, 1500000)[n // 1000 % 2] + int(rng.gauss(0, 500))
+        entries.append(AdcQueueEntry(n, vbus, ibus, 3300 + rng.randint(-1, 1), 0, 600 + rng.randint(-1, 1), 600))
+    return AdcQueueBatch.from_entries(entries)
+
+def bench_archive(duration):
+    """
+    Archive size against logger CSV, and decoding the archive against parsing the CSV.
+    """
+    batch = synthetic_batch(200000)
+    text = format_csv(batch)
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'bench.kma')
+        with ArchiveWriter(path, Rate._1KSPS) as writer:
+            writer.write(batch)
+        size = os.path.getsize(path)
+        with Archive(path) as archive:
+            decode = min(timeit.repeat(archive.time_range, number=1, repeat=max(1, int(duration))))
+
+    def parse():
+        reader = csv.reader(io.StringIO(text))
+        next(reader, None)
+        return [(int(t), int(vbus), int(ibus), float(vcc1), float(vcc2), int(vdp), int(vdm))
+                for t, vbus, ibus, vcc1, vcc2, vdp, vdm in reader]
+    parse_time = min(timeit.repeat(parse, number=1, repeat=max(1, int(duration))))
+    return {
+        'archive_csv_ratio': len(text.encode()) / size,
+        'archive_decode_samples_per_s': len(batch) / decode,
+        'csv_parse_samples_per_s': len(batch) / parse_time,
+    }
+
+def normalize(results, calibration):
+    """
+    Returns the results relative to the calibration time, as they are stored in the baselines.
+    """
+    return {name: value * calibration ** CALIBRATION_POWER[name] for name, value in results.items()}
+
+def compare(results, baselines, calibration, tolerance):
+    """
+    Prints every metric, and where there is a baseline the ratio of the normalized metric to it.
+    Returns the names of the regressed metrics.
+    """
+    regressions = []
+    normalized = normalize(results, calibration)
+    print(f'{"calibration_ns":24} {calibration:14.1f}')
+    for name, value in results.items():
+        baseline = baselines.get(name)
+        if baseline is None:
+            print(f'{name:24} {value:14.1f}')
+            continue
+        ratio = normalized[name] / baseline if baseline else float('inf')
+        better = ratio if HIGHER_IS_BETTER[name] else 1 / ratio if ratio else float('inf')
+        flag = ''
+        if better < 1 - tolerance:
+            flag = '  REGRESSION'
+            regressions.append(name)
+        print(f'{name:24} {value:14.1f}  x{better:.2f} of baseline{flag}')
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="KM003C parser, send() and logger benchmarks against the emulator")
+    parser.add_argument('--duration', '-d', type=float, default=2.0, help="Seconds per benchmark (default: 2).")
+    parser.add_argument('--tolerance', '-t', type=float, default=0.25,
+                        help="Allowed relative slowdown before a metric counts as regressed (default: 0.25).")
+    parser.add_argument('--update', action='store_true', help="Store the results as the new baselines.")
+    args = parser.parse_args()
+
+    calibration = calibration_ns(args.duration)
+    results = {}
+    for bench in (bench_parse, bench_send, bench_logger, bench_codec, bench_archive):
+        results.update(bench(args.duration))
+    #Timed again once the machine is warmed up, the faster of both is the least disturbed
+    calibration = min(calibration, calibration_ns(args.duration))
+
+    baselines = {}
+    if os.path.exists(BASELINES):
+        with open(BASELINES) as f:
+            baselines = json.load(f)
+    regressions = compare(results, baselines, calibration, args.tolerance)
+    print_codec_gain(results)
+
+    if args.update:
+        with open(BASELINES, 'w') as f:
+            json.dump({name: float(f'{value:.4g}') for name, value in normalize(results, calibration).items()}, f, indent=4)
+            f.write('\n')
+    elif regressions:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
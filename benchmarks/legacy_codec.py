@@ -0,0 +1,103 @@
+#The protocol codec as it was before precompiled structs, slots and cached command frames,
+#kept so bench.py can time both paths side by side in the same run.
+
+import struct
+
+class MsgHeader:
+    def __init__(self, type, extend, id, att=None, obj=None):
+        self.type = type
+        self.extend = extend
+        self.id = id
+        self.att = att
+        self.obj = obj
+
+    @classmethod
+    def from_bytes(cls, data):
+        if len(data) != 4:
+            raise ValueError("Data must be exactly 4 bytes.")
+        packed = struct.unpack('<I', data)[0]
+        type = packed & 0x7F
+        extend = (packed >> 7) & 0x1
+        id = (packed >> 8) & 0xFF
+        if type > 63:
+            obj = (packed >> 22) & 0x03FF
+            return cls(type, extend, id, obj=obj)
+        else:
+            att = (packed >> 17) & 0x7FFF
+            return cls(type, extend, id, att=att)
+
+    def to_bytes(self):
+        if self.type > 63:
+            header = (self.type & 0x7F) | ((self.extend & 0x1) << 7) | ((self.id & 0xFF) << 8) | ((self.obj & 0x03FF) << 22)
+        else:
+            header = (self.type & 0x7F) | ((self.extend & 0x1) << 7) | ((self.id & 0xFF) << 8) | ((self.att & 0x7FFF) << 17)
+        return struct.pack('<I', header)
+
+def command_frame(type, id, att=0):
+    return MsgHeader(type, 0, id, att=att).to_bytes()
+
+class MsgHeaderHeader:
+    STRUCT_FORMAT = '<I'
+
+    def __init__(self, att, next_flag, chunk, size):
+        self.att = att
+        self.next_flag = next_flag
+        self.chunk = chunk
+        self.size = size
+
+    @classmethod
+    def from_bytes(cls, data):
+        if len(data) != 4:
+            raise ValueError("Data must be exactly 4 bytes.")
+        packed = struct.unpack(cls.STRUCT_FORMAT, data)[0]
+        return cls(packed & 0x7FFF, (packed >> 15) & 0x1, (packed >> 16) & 0x3F, (packed >> 22) & 0x03FF)
+
+class AdcData:
+    STRUCT_FORMAT = '<6ih5HI'
+
+    def __init__(self, vbus, ibus, vbus_avg, ibus_avg, vbus_ori_avg, ibus_ori_avg,
+                 temp, vcc1, vcc2, vdp, vdm, vdd, rate):
+        self.vbus = vbus
+        self.ibus = ibus
+        self.vbus_avg = vbus_avg
+        self.ibus_avg = ibus_avg
+        self.vbus_ori_avg = vbus_ori_avg
+        self.ibus_ori_avg = ibus_ori_avg
+        self.temp_raw = temp
+        msb = (temp >> 8) & 0xFF
+        lsb = temp & 0xFF
+        self.temp = (msb*2000 + lsb*1000/128)/1000
+        self.vcc1 = vcc1
+        self.vcc2 = vcc2
+        self.vdp = vdp
+        self.vdm = vdm
+        self.vdd = vdd
+        self.rate = (rate >> 16) & 0x3
+
+    @classmethod
+    def from_bytes(cls, data):
+        if len(data) < struct.calcsize(cls.STRUCT_FORMAT):
+            raise ValueError(f"Data size ({len(data)}) is smaller than expected for AdcData ({struct.calcsize(cls.STRUCT_FORMAT)}).")
+        unpacked = struct.unpack(cls.STRUCT_FORMAT, data[:40])
+        return cls(*unpacked)
+
+class AdcQueueEntry:
+    STRUCT_FORMAT = '<I2i4H'
+
+    def __init__(self, timestamp_ms, vbus, ibus, vcc1, vcc2, vdp, vdm):
+        self.timestamp_ms = timestamp_ms
+        self.vbus = vbus
+        self.ibus = ibus
+        self.vcc1 = vcc1
+        self.vcc2 = vcc2
+        self.vdp = vdp
+        self.vdm = vdm
+
+    @classmethod
+    def from_bytes(cls, data):
+        if len(data) < struct.calcsize(cls.STRUCT_FORMAT):
+            raise ValueError(
+                f"Data size ({len(data)}) is smaller than expected for AdcQueueEntry ({struct.calcsize(cls.STRUCT_FORMAT)})."
+            )
+        unpacked = struct.unpack(cls.STRUCT_FORMAT, data)
+        return cls(*unpacked)